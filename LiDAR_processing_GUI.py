@@ -8,13 +8,58 @@ Things to consider adding:
 """
 
 from file_functions import *
+from pipeline import Stage, StageGraph, CoreBudget, run_tasks, process_pool
+import manifest
+from las_io import read_header, readable
+from point_ops import split_classes, mergeable, merge_tiles, remove_buffer, tile_files
+from profiling import extrapolate
+import quarantine
+from quarantine import run_tiles
+from tiling import DensityRaster, plan_tile_size, plan_quadtree, stratified_sample
+from poly_clip import polygon_index, clip_file
+from retention import Retention, uncompressed_size
+from resources import Planner
+from height import height_above_ground
+from ground import classify_ground
+from classify import classify_objects, GROUND_OFFSET, PLANAR, RUGGED, SCATTER, NEIGHBOURS
 import os
 import sys
+import json
 import shutil
+import tempfile
 import numpy as np
 import logging
 
 
+# class types separated into subdirectories of the 'separated' folders
+CLASSES = ['01-Default',
+           '02-Ground',
+           '05-Vegetation',
+           '06-Building'
+           ]
+
+# directory of the lasground_new parameter sweeps (see sweep.py)
+SWEEP_NAME = 'ground_sweep'
+
+# directory of the runs on a sample of the tiles (see lidar_workflow), and its summary
+PREVIEW_NAME = 'preview'
+PREVIEW_SUMMARY = 'preview.json'
+
+# ground classifications: LAStools, or in-process with a progressive morphological filter (see ground.py)
+GROUND_ENGINES = ['lasground_new', 'pmf']
+
+# ways to measure the height above ground: LAStools, or in-process from a TIN or a grid of the ground (see height.py)
+HEIGHT_ENGINES = ['lasheight', 'tin', 'grid']
+
+# classifications of vegetation and buildings: lasheight followed by lasclassify, or in-process from the eigenvalues of
+# the neighbourhoods of the points, measuring the heights in the same pass (see classify.py)
+CLASSIFY_ENGINES = ['lasclassify', 'eigen']
+
+# tilings of the original points: tiles of different sizes, split only where they hold too many points, or one tile
+# size for all tiles (see tiling.py)
+TILINGS = ['uniform', 'adaptive']
+
+
 ##########################
 # first let's define some functions that will be helpful
 
@@ -28,37 +73,34 @@ def las_files(directory):
     return l
 
 
-# input working directory for LAStools and directory containing .las/.laz files
+# input working directory and directory containing .las/.laz files
 # creates a .txt file for LAStools containing list of .las/.laz file names
 # returns the name of the .txt file.
-def lof_text(pwd, src):
-    """creates a .txt file in pwd (LAStools bin) containing a list of .las/.laz filenames from src directory"""
-    filename = pwd + 'file_list.txt'
-    f = open(filename, 'w+')
+def lof_text(pwd, src, name='file_list'):
+    """creates a .txt file in pwd (e.g. the scratch directory of the run) containing a list of .las/.laz filenames
+    from src directory
+
+    src may also be a list of directories and/or .las/.laz files. The name of the .txt file starts with name and is
+    unique, so lists written at the same time (by concurrent stages or runs) never overwrite each other.
+    """
+    fd, filename = tempfile.mkstemp(prefix=name + '_', suffix='.txt', dir=pwd)
+    f = os.fdopen(fd, 'w')
 
     if type(src) == str:
         for i in las_files(src):
             f.write('%s\n' % i)
     else:
-        # this is the case when there are multiple source folders
-        for i in [name for source in src for name in las_files(source)]:
+        # this is the case when there are multiple source folders (or a list of files)
+        for i in [name for source in src for name in ([source] if os.path.isfile(source) else las_files(source))]:
             f.write('%s\n' % i)
     f.close()
     return filename
 
 
-# input .las/.laz filename, outputs point density (after running lasinfo)
+# input .las/.laz filename, outputs point density
 def pd(filename):
-    """returns point density from lasinfo output .txt file"""
-    # name of txt output file from lasinfo
-    filename = filename[:-4] + '.txt'
-    f = open(filename, 'r')
-    text = f.readlines()
-    for line in text:
-        if line.startswith('point density:'):
-            d = line.split(' ')
-            d = d[d.index('returns') + 1]
-            return float(d)
+    """returns point density (all returns) from the .las/.laz file header"""
+    return read_header(filename).density
 
 
 def get_largest(directory):
@@ -74,558 +116,752 @@ def get_largest(directory):
     return os.path.join(directory, filename)
 
 
-def pts(filename, lastoolsdir):
-    """returns number of points in las file"""
-
-    # call lasinfo on the file
-    cmd('%slasinfo.exe -i %s -otxt -histo number_of_returns 1' % (lastoolsdir, filename))
-    # name of txt output file from lasinfo
-    txt = filename[:-4] + '.txt'
-    f = open(txt, 'r')
-    text = f.readlines()
-    for line in text:
-        if line.endswith('element(s)\n'):
-            d = line.split(' ')
-            d = d[d.index('for') + 1]
-            return int(d)
-
-
-# the main function that runs when 'run' button is clicked
-@err_info
-def process_lidar(lastoolsdir,
-                  lidardir,
-                  ground_poly,
-                  cores,
-                  units_code,
-                  keep_orig_pts,
-                  coarse_step,
-                  coarse_bulge,
-                  coarse_spike,
-                  coarse_down_spike,
-                  coarse_offset,
-                  fine_step,
-                  fine_bulge,
-                  fine_spike,
-                  fine_down_spike,
-                  fine_offset
-                  ):
-    """Executes main LAStools processing workflow. See readme for more info."""
-
-    classes = ['01-Default',
-               '02-Ground',
-               '05-Vegetation',
-               '06-Building'
-               ]
-
-    if (ground_poly != '') and (keep_orig_pts == True):
-        # run on coarse and fine settings, need to clip and remove duplicates after merging
-        outdirs = ['00_separated',
-                   '00_declassified',
-                   '01_tiled',
-                   '02a_lasground_new_coarse',
-                   '02b_lasground_new_fine',
-                   '03a_lasheight_coarse',
-                   '03b_lasheight_fine',
-                   '04a_lasclassify_coarse',
-                   '04b_lasclassify_fine',
-                   '05a_lastile_rm_buffer_coarse',
-                   '05b_lastile_rm_buffer_fine',
-                   '06a_separated_coarse',
-                   '06b_separated_fine',
-                   '07a_ground_clipped_coarse',
-                   '07b_ground_clipped_fine',
-                   '08_ground_merged',
-                   '09_ground_rm_duplicates',
-                   '10_veg_new_merged',
-                   '11_veg_new_clipped',
-                   '12_veg_merged',
-                   '13_veg_rm_duplicates'
-                   ]
-
-    elif (ground_poly == '') and (keep_orig_pts == True):
-        # only classify with coarse settings, no clipping, but need to remove duplicates
-        outdirs = ['00_separated',
-                   '00_declassified',
-                   '01_tiled',
-                   '02_lasground_new',
-                   '03_lasheight',
-                   '04_lasclassify',
-                   '05_lastile_rm_buffer',
-                   '06_separated',
-                   '08_ground_merged',
-                   '09_ground_rm_duplicates',
-                   '12_veg_merged',
-                   '13_veg_rm_duplicates'
-                   ]
-
-    elif (ground_poly == '') and (keep_orig_pts == False):
-        # only classify with coarse setting, no clipping or removing duplicates necessary
-        outdirs = ['00_separated',
-                   '00_declassified',
-                   '01_tiled',
-                   '02_lasground_new',
-                   '03_lasheight',
-                   '04_lasclassify',
-                   '05_lastile_rm_buffer',
-                   '06_separated'
-                   ]
-
-    elif (ground_poly != '') and (keep_orig_pts == False):
-        # run on coarse and fine settings, clip, but no removing duplicates needed
-        outdirs = ['00_separated',
-                   '00_declassified',
-                   '01_tiled',
-                   '02a_lasground_new_coarse',
-                   '02b_lasground_new_fine',
-                   '03a_lasheight_coarse',
-                   '03b_lasheight_fine',
-                   '04a_lasclassify_coarse',
-                   '04b_lasclassify_fine',
-                   '05a_lastile_rm_buffer_coarse',
-                   '05b_lastile_rm_buffer_fine',
-                   '06a_separated_coarse',
-                   '06b_separated_fine',
-                   '07a_ground_clipped_coarse',
-                   '07b_ground_clipped_fine',
-                   '08_ground_merged',
-                   '10_veg_new_merged',
-                   '11_veg_new_clipped',
-                   '12_veg_merged'
-                   ]
-
-
-
-    # make new directories for output from each step in processing
-    for outdir in outdirs:
-        if os.path.isdir(lidardir + outdir) == False:
-            os.mkdir(lidardir + outdir)
-
-    if len(os.listdir(lidardir + outdirs[0])) != 0:
-        msg = 'Output directories must initially be empty. Move or delete the data currently in output directories.'
+def pts(filename, lastoolsdir=None):
+    """returns number of points in las file (read from the file header, lastoolsdir is not used anymore)"""
+    return read_header(filename).point_count
+
+
+def most_points(directory):
+    """returns name and number of points of the .las/.laz file with the most points in directory"""
+    counts = [(pts(filename), filename) for filename in las_files(directory)]
+    num, filename = max(counts)
+    return filename, num
+
+
+def branch_dirs(setting, split):
+    """
+    Returns the output directories of the lasground_new -> lasclip chain for one classification setting
+
+    Args:
+        setting (str): 'coarse' or 'fine'
+        split (bool): True if coarse and fine settings are run side by side (i.e. a ground polygon is given)
+    """
+    tag = {'coarse': 'a', 'fine': 'b'}[setting] if split else ''
+    end = '_' + setting if split else ''
+    names = [('ground', '02', 'lasground_new'),
+             ('height', '03', 'lasheight'),
+             ('classify', '04', 'lasclassify'),
+             ('rm_buffer', '05', 'lastile_rm_buffer'),
+             ('separated', '06', 'separated'),
+             ('clipped', '07', 'ground_clipped')
+             ]
+    return {key: '%s%s_%s%s' % (num, tag, name, end) for key, num, name in names}
+
+
+def output_dirs():
+    """returns the names of all output directories process_lidar may create, whatever the settings"""
+    names = ['00_separated', '00_declassified', '01_tiled', '08_ground_merged', '09_ground_rm_duplicates',
+             '10_veg_new_merged', '11_veg_new_clipped', '12_veg_merged', '13_veg_rm_duplicates']
+    for setting, split in [('coarse', False), ('coarse', True), ('fine', True)]:
+        names += list(branch_dirs(setting, split).values())
+    return names
+
+
+def lasground_command(lastoolsdir, filename, units_code, params, odir):
+    """returns the lasground_new command line classifying the ground points of filename with params (step, bulge,
+    spike, down_spike, offset), writing to odir"""
+    step, bulge, spike, down_spike, offset = params
+    return '%slasground_new.exe -i %s %s -step %s -bulge %s -spike %s -down_spike %s -offset %s -hyper_fine -odir %s ' \
+           '-olas' % (lastoolsdir, filename, units_code, step, bulge, spike, down_spike, offset, odir)
+
+
+def separate_classes(lastoolsdir, files, podir, cores=1):
+    """writes the points of each class type in files to a subdirectory of podir
+
+    Uncompressed .las files are split in process, reading every file only once for all class types (see
+    point_ops.split_classes). For .laz files, las2las runs once per file and class type. The outputs are verified,
+    and files are quarantined if they keep failing (see quarantine.py). Returns dict of the reason of failure by
+    quarantined file.
+    """
+    odirs = {int(class_type.split('-')[0]): podir + '/' + class_type + '/' for class_type in CLASSES}
+    native = [f for f in files if readable(f)]
+    name = lambda f: os.path.splitext(os.path.basename(f))[0] + '.las'
+    failed = quarantine.run_native(split_classes, [(f, [odir + name(f) for odir in odirs.values()], (f, odirs))
+                                                   for f in native], cores, conserve=False, processes=False)
+
+    laz = [f for f in files if f not in native]
+    for class_code, odir in odirs.items():
+        if laz and not os.path.isdir(odir):
+            os.makedirs(odir)
+        failed.update(run_tiles([(f, odir + name(f), '%slas2las.exe -i %s -keep_classification %i -odir %s -olas' % (
+            lastoolsdir, f, class_code, odir)) for f in laz if f not in failed], cores, conserve=False))
+    # a file quarantined for one class type drops out of all of them
+    for f in laz:
+        if f in failed:
+            for odir in odirs.values():
+                if os.path.isfile(odir + name(f)):
+                    os.remove(odir + name(f))
+    return failed
+
+
+# the main function, run by process_lidar when the 'run' button is clicked
+def lidar_workflow(lastoolsdir,
+                   lidardir,
+                   ground_poly,
+                   cores,
+                   units_code,
+                   keep_orig_pts,
+                   coarse_step,
+                   coarse_bulge,
+                   coarse_spike,
+                   coarse_down_spike,
+                   coarse_offset,
+                   fine_step,
+                   fine_bulge,
+                   fine_spike,
+                   fine_down_spike,
+                   fine_offset,
+                   per_tile=False,
+                   retention='keep',
+                   disk_budget='',
+                   ground_engine='lasground_new',
+                   height_engine='lasheight',
+                   classify_engine='lasclassify',
+                   ground_offset=GROUND_OFFSET,
+                   planar=PLANAR,
+                   rugged=RUGGED,
+                   scatter=SCATTER,
+                   neighbours=NEIGHBOURS,
+                   tiling='uniform',
+                   preview=0,
+                   budget=None
+                   ):
+    """Executes main LAStools processing workflow. See readme for more info.
+
+    Unlike process_lidar (used by the GUI), errors are raised instead of shown in a message box. Returns the
+    directories with the ground and the vegetation results.
+
+    The workflow is built as a graph of stages (see pipeline.py). Stages without mutual dependencies, such as the
+    coarse and fine classification chains, run concurrently and share the selected number of cores.
+    Every finished stage leaves a manifest in its output directory (see manifest.py). Re-running the workflow on the
+    same directory skips all stages whose inputs and parameters are unchanged and resumes at the first stale stage.
+
+    If per_tile is True, the classification chain (lasground_new -> lasheight -> lasclassify -> remove buffer ->
+    separate -> clip) runs tile by tile instead of directory by directory, so that tiles do not wait for each other
+    between the steps. The merge steps start once all tiles passed the chain.
+
+    retention decides what happens to intermediate outputs once no later stage needs them: 'keep' them, 'delete' them
+    or 'compress' them to LAZ (see retention.py). disk_budget (GB, optional) limits the disk usage of all outputs.
+
+    ground_engine selects how the ground points are classified: with 'lasground_new', or without LAStools with a
+    progressive morphological filter taking the same parameters ('pmf', see ground.py; tiles that are not uncompressed
+    .las files still go through lasground_new).
+
+    height_engine selects how the height above ground is measured: with 'lasheight', or without LAStools from a 'tin'
+    or a 'grid' of the ground points of every tile (see height.py; tiles that are not uncompressed .las files still go
+    through lasheight).
+
+    classify_engine selects how vegetation and buildings are classified: with 'lasclassify' (after lasheight), or
+    without LAStools from the shape of the neighbourhood of every point ('eigen', see classify.py). The eigen classifier
+    measures the heights above ground itself (from the 'tin' if height_engine is 'tin', otherwise from the 'grid') and
+    writes its results directly, without the lasheight directory. Tiles that are not uncompressed .las files still go
+    through lasheight and lasclassify. ground_offset, planar, rugged, scatter and neighbours set its thresholds and the
+    size of the neighbourhoods (see classify.classify_objects).
+
+    tiling selects how the original points are tiled: 'uniform' (default) tiles everything with the tile size the
+    densest spot needs, with lastile. 'adaptive' splits the area into square tiles of different sizes, only where they
+    would hold too many points (see tiling.plan_quadtree), so sparse areas get few large tiles instead of many nearly
+    empty ones. Adaptive tiling falls back to lastile if the original files are not uncompressed .las files, or if its
+    tiles cannot be split finely enough.
+
+    preview (int) runs the workflow on a sample of that many tiles only, to check the classification results before a
+    full run (0: full run). The project is tiled as usual, and tiles representative of the point densities, the relief
+    and the extent of the project are picked (see tiling.stratified_sample). All following stages run on the sampled
+    tiles and write to the preview folder of lidardir, with the same layout as a full run. The time of a full run is
+    estimated from the time the sample took and written to preview.json (see profiling.extrapolate).
+
+    budget (pipeline.CoreBudget) is the pool of cores to draw from, e.g. one shared by several projects (see
+    batch.py). Without a budget, the workflow uses up to cores cores (0 or 'auto': all CPUs of the machine). Every
+    stage runs as many processes at a time as there are tiles, cores and memory for (see resources.Planner).
+    """
+
+    if ground_engine not in GROUND_ENGINES:
+        msg = 'Unknown ground engine %s (use %s)' % (ground_engine, ' or '.join(GROUND_ENGINES))
         logging.error(msg)
         raise Exception(msg)
-
-    # in each 'separated' folder, create subdirs for each class type
-    if ground_poly != '':
-        sepdirs = [lidardir + '00_separated',
-                   lidardir + '06a_separated_coarse',
-                   lidardir + '06b_separated_fine'
-                   ]
+    if height_engine not in HEIGHT_ENGINES:
+        msg = 'Unknown height engine %s (use %s)' % (height_engine, ' or '.join(HEIGHT_ENGINES))
+        logging.error(msg)
+        raise Exception(msg)
+    if classify_engine not in CLASSIFY_ENGINES:
+        msg = 'Unknown classify engine %s (use %s)' % (classify_engine, ' or '.join(CLASSIFY_ENGINES))
+        logging.error(msg)
+        raise Exception(msg)
+    if tiling not in TILINGS:
+        msg = 'Unknown tiling %s (use %s)' % (tiling, ' or '.join(TILINGS))
+        logging.error(msg)
+        raise Exception(msg)
+    try:
+        ground_offset, planar, rugged, scatter = (float(v) for v in (ground_offset, planar, rugged, scatter))
+        neighbours = int(neighbours)
+    except ValueError:
+        valid = False
     else:
-        sepdirs = [lidardir + '00_separated',
-                   lidardir + '06_separated'
-                   ]
-    for sepdir in sepdirs:
-        for class_type in classes:
-            class_dir = sepdir + '/' + class_type
-            if os.path.isdir(class_dir) == False:
-                os.mkdir(class_dir)
-
-    logging.info('Created directories for output data')
-
-    ##################################
-    # create declassified points
-
-    logging.info('Declassifying copy of original point cloud...')
-
-    # get list of filenames for original LiDAR data (all .las and .laz files in lidardir)
-    lidar_files = []
-    for path, subdirs, files in os.walk(lidardir):
-        for name in files:
-            if name.endswith('.las') or name.endswith('.laz'):
-                lidar_files.append(path + '/' + name)
-
-    if lidar_files == []:
-        msg = 'No .las or .laz files in %s or its subdirectories' % lidardir
+        valid = ground_offset >= 0 and 0 < planar < rugged and 0 <= scatter < 1 / 3.0 and neighbours >= 3
+    if not valid:
+        msg = 'Invalid eigen classifier parameters (ground offset %s, planar %s, rugged %s, scatter %s, ' \
+              'neighbours %s)' % (ground_offset, planar, rugged, scatter, neighbours)
         logging.error(msg)
         raise Exception(msg)
 
-    # copy original files into '00_declassified' folder
-    for name in lidar_files:
-        shutil.copyfile(name, lidardir + '00_declassified/' + os.path.basename(name))
+    planner = Planner(cores, lidardir)
+    cores = planner.cores
 
-        # make list of files for LASTools to process
-    lof = lof_text(lastoolsdir, lidardir + '00_declassified/')
-    # call LAStools command to declassify points and get point density
-    cmd('%slasinfo.exe -lof %s -set_classification 1 -otxt -cd' % (lastoolsdir, lof))
+    preview = int(preview or 0)
+    workdir = lidardir + PREVIEW_NAME + '/' if preview else lidardir
+    if preview and not os.path.isdir(workdir):
+        os.mkdir(workdir)
 
-    logging.info('OK')
+    split = ground_poly != ''
+    settings = ['coarse', 'fine'] if split else ['coarse']
+    ground_params = {'coarse': (coarse_step, coarse_bulge, coarse_spike, coarse_down_spike, coarse_offset),
+                     'fine': (fine_step, fine_bulge, fine_spike, fine_down_spike, fine_offset)
+                     }
+    dirs = {setting: branch_dirs(setting, split) for setting in settings}
 
-    # separate original data by class type
+    graph = StageGraph(root=workdir)
 
-    logging.info('Separating original data by class type...')
+    def lof(stage, src):
+        # file lists go to the scratch directory of the run (not the LAStools directory), with unique names, so that
+        # concurrent stages and runs don't overwrite each other's lists
+        return lof_text(scratch, src, 'file_list_' + stage)
 
-    filename = lastoolsdir + 'file_list.txt'
-    f = open(filename, 'w+')
-    for i in lidar_files:
-        f.write('%s\n' % i)
-    f.close()
-    lof = filename
-
-    for class_type in classes:
-        odir = lidardir + '00_separated' + '/' + class_type + '/'
-        class_code = int(class_type.split('-')[0])
-        cmd('%slas2las.exe -lof %s -cores %i -keep_classification %i -odir %s -olas' % (
-            lastoolsdir, lof, cores, class_code, odir))
-
-    logging.info('OK')
-
-    ########################
-    # create tiling (max 1.5M pts per tile)
-
-    logging.info('Creating tiling...')
+    ##################################
+    # create declassified points
 
-    # get point density for each .las file
-    ds = []
-    for filename in las_files(lidardir + '00_declassified/'):
-        ds.append(pd(filename))
-    # use max point density out of all files to determine tile size
-    max_d = max(ds)
+    def declassify(cores):
+        # stage original files in '00_declassified' folder: cloned where the filesystem supports it, copied in
+        # parallel otherwise. Never hardlinked: lasinfo -set_classification edits the files in place
+        stage_files(lidar_files, workdir + '00_declassified/', hardlink=False, workers=cores)
 
-    # width of square tile so we have max of 1.5M pts per tile (assuming same number of points per tile)
-    # throw in another factor of 0.5 to make sure tiles will be small enough, round to nearest 10
-    tile_size = round(0.5 * np.sqrt((1.5 * 10 ** 6) / max_d), -1)
+        # call LAStools command to declassify points
+        cmd('%slasinfo.exe -lof %s -set_classification 1' % (
+            lastoolsdir, lof('declassify', workdir + '00_declassified/')))
 
-    logging.info('Using tile size of %i' % tile_size)
+    if not preview:
+        graph.add(Stage('declassify', declassify, outputs=['00_declassified'], cores=cores,
+                        description='Declassifying copy of original point cloud...',
+                        params={'tool': 'lasinfo', 'args': '-set_classification 1'}))
 
-    odir = lidardir + '01_tiled/'
+    # separate original data by class type
 
-    # call LAStools command to create tiling
-    cmd('%slastile.exe -lof %s -cores %i -o tile.las -tile_size %i -buffer 5 -faf -odir %s -olas' % (
-        lastoolsdir, lof, cores, tile_size, odir))
+    def quarantined(name, failed):
+        # records the quarantined tiles of a stage and returns them as its results (see quarantine.py)
+        quarantine.record(workdir, name, failed)
+        return {'quarantined': sorted(os.path.relpath(t, workdir).replace(os.sep, '/') for t in failed)}
+
+    def separate_original(cores):
+        return quarantined('separate_original', separate_classes(lastoolsdir, lidar_files, workdir + '00_separated',
+                                                                 cores))
+
+    def separate_sample(cores):
+        # the original points of the sampled area: the sampled tiles without their buffers
+        odir = os.path.join(scratch, 'preview_original', '')
+        os.makedirs(odir, exist_ok=True)
+        tiles = las_files(workdir + '01_tiled/')
+        run_tasks(remove_buffer, [(t, odir + os.path.basename(t)) for t in tiles], cores)
+        return quarantined('separate_original', separate_classes(lastoolsdir, las_files(odir), workdir + '00_separated',
+                                                                 cores))
+
+    if not preview:
+        graph.add(Stage('separate_original', separate_original, outputs=['00_separated'], cores=cores,
+                        description='Separating original data by class type...',
+                        params={'tool': 'split_classes', 'classes': CLASSES}))
+    else:
+        graph.add(Stage('separate_original', separate_sample, inputs=['01_tiled'], outputs=['00_separated'],
+                        cores=cores, description='Separating original data of the sampled tiles by class type...',
+                        params={'tool': 'split_classes', 'classes': CLASSES, 'remove_buffer': True}))
 
-    logging.info('OK')
+    ########################
+    # create tiling (max 1.5M pts per tile)
 
-    # check to make sure tiles are small enough
-    logging.info('Checking if largest file has < 1.5M pts (to avoid licensing restrictions)...')
-    largest_file = get_largest(odir)
-    num = pts(largest_file, lastoolsdir)
-    if num < 1500000:
-        logging.info('Largest file has %i points, tiles small enough.' % num)
-    else:
-        logging.info('Tile size not small enough. Retrying with a smaller tile size...')
+    def tile(cores):
+        # tile size for which no tile (including its 5 m buffer) is expected to exceed 1.5M pts, estimated from a
+        # density raster of all original files, so that tiling has to run only once. The merge stages re-tile their
+        # points with it also after adaptive tiling
+        raster = DensityRaster(lidar_files)
+        tile_size = plan_tile_size(lidar_files, max_points=1500000, buffer=5, raster=raster)
+
+        odir = lidardir + '01_tiled/'
+        src = original_lof
+
+        if tiling == 'adaptive' and mergeable(lidar_files):
+            max_points = 1500000
+            tiles = plan_quadtree(lidar_files, max_points=max_points, buffer=5, raster=raster)
+            tile_files(lidar_files, odir, tiles, buffer=5, workers=cores)
+            largest_file, num = most_points(odir)
+            while num >= 1500000:
+                # only happens if the density estimate was far off: split tiles further, down to the raster cells
+                logging.warning('%s has %i points. Retrying with smaller tiles...' % (largest_file, num))
+                max_points = 0.9 * max_points * 1500000.0 / num
+                previous, tiles = tiles, plan_quadtree(lidar_files, max_points=max_points, buffer=5, raster=raster)
+                for filename in las_files(odir):
+                    os.unlink(filename)
+                if tiles == previous:
+                    logging.warning('The tiles cannot be split any further, tiling with lastile.')
+                    break
+                tile_files(lidar_files, odir, tiles, buffer=5, workers=cores)
+                largest_file, num = most_points(odir)
+            else:
+                logging.info('Largest file has %i points (%i tiles of size %g - %g).' % (
+                    num, len(tiles), min(t[1] - t[0] for t in tiles), max(t[1] - t[0] for t in tiles)))
+                return {'tile_size': tile_size, 'tiling': 'adaptive'}
+            # smaller than the smallest adaptive tile, which already held too many points
+            tile_size = max(10, min(tile_size, round(0.9 * min(t[1] - t[0] for t in previous) * np.sqrt(
+                1500000.0 / num), -1)))
+        elif tiling == 'adaptive':
+            logging.info('Not all original files are .las files with the same point format, tiling with lastile.')
+        logging.info('Using tile size of %i' % tile_size)
+
+        # call LAStools command to create tiling
+        cmd('%slastile.exe -lof %s -cores %i -o tile.las -tile_size %i -buffer 5 -faf -odir %s -olas' % (
+            lastoolsdir, src, cores, tile_size, odir))
+
+        # check to make sure tiles are small enough (the point counts of all tiles are read from their headers)
+        logging.info('Checking if largest file has < 1.5M pts (to avoid licensing restrictions)...')
+        largest_file, num = most_points(odir)
         while num >= 1500000:
-            # delete original set of tiles
-            folder = odir
-            for the_file in os.listdir(folder):
-                file_path = os.path.join(folder, the_file)
+            # only happens if the density estimate was far off: delete the tiles and redo tiling with a smaller size
+            logging.warning('%s has %i points. Retrying with a smaller tile size...' % (largest_file, num))
+            for filename in las_files(odir):
                 try:
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                except:
-                    logging.warning('Couldn\'nt delete %s' % file_path)
-            # redo tiling
-            tile_size = int(tile_size * num * 1.0 / 1500000)
+                    os.unlink(filename)
+                except OSError:
+                    logging.warning('Couldn\'t delete %s' % filename)
+            tile_size = max(10, round(0.9 * tile_size * np.sqrt(1500000.0 / num), -1))
             logging.info('Using tile size of %i' % tile_size)
 
             cmd('%slastile.exe -lof %s -cores %i -o tile.las -tile_size %i -buffer 5 -faf -odir %s -olas' % (
-                lastoolsdir, lof, cores, tile_size, odir))
-            # recheck largest tile number of points
-            logging.info('Checking if largest file has < 1.5M pts (to avoid licensing restrictions)...')
-            largest_file = get_largest(odir)
-            num = pts(largest_file, lastoolsdir)
-            if num >= 1500000:
-                logging.info('Tile size not small enough. Retrying with a smaller tile size...')
+                lastoolsdir, src, cores, tile_size, odir))
+            largest_file, num = most_points(odir)
 
-    logging.info('OK')
-
-    ########################
-    # run lasground_new on coarse and fine settings
+        logging.info('Largest file has %i points, tiles small enough.' % num)
 
-    logging.info('Running ground classification on coarse setting...')
+        return {'tile_size': tile_size, 'tiling': 'uniform'}
 
-    lof = lof_text(lastoolsdir, lidardir + '01_tiled/')
+    tile_stage = Stage('tile', tile, outputs=['01_tiled'], cores=cores, description='Creating tiling...',
+                       params={'tool': 'lastile', 'max_points': 1500000, 'buffer': 5, 'planner': 'density_raster',
+                               'tiling': tiling})
 
-    if ground_poly != '':
-        odir = lidardir + '02a_lasground_new_coarse/'
+    if not preview:
+        graph.add(tile_stage)
     else:
-        odir = lidardir + '02_lasground_new'
-
-    cmd(
-        '%slasground_new.exe -lof %s -cores %i %s -step %s -bulge %s -spike %s -down_spike %s -offset %s -hyper_fine -odir %s -olas' % (
-            lastoolsdir,
-            lof,
-            cores,
-            units_code,
-            coarse_step,
-            coarse_bulge,
-            coarse_spike,
-            coarse_down_spike,
-            coarse_offset,
-            odir
-        )
-    )
-
-    logging.info('OK')
-
-    if ground_poly != '':
-        logging.info('Running ground classification on fine setting...')
-
-        odir = lidardir + '02b_lasground_new_fine/'
-
-        cmd(
-            '%slasground_new.exe -lof %s -cores %i %s -step %s -bulge %s -spike %s -down_spike %s -offset %s -hyper_fine -odir %s -olas' % (
-                lastoolsdir,
-                lof,
-                cores,
-                units_code,
-                fine_step,
-                fine_bulge,
-                fine_spike,
-                fine_down_spike,
-                fine_offset,
-                odir
-            )
-        )
-
-        logging.info('OK')
-
-    ##########################
-    # run lasheight on each data set
+        # the project is tiled as for a full run (which then finds 01_tiled up to date), the preview runs on a sample
+        # of the tiles staged into 01_tiled of the preview directory
+        tile_graph = StageGraph(root=lidardir)
+        tile_graph.add(tile_stage)
+
+        def sample(cores):
+            tiles = stratified_sample(las_files(lidardir + '01_tiled/'), preview)
+            if not tiles:
+                msg = 'No tiles to sample in %s' % (lidardir + '01_tiled/')
+                logging.error(msg)
+                raise Exception(msg)
+            stage_files(tiles, workdir + '01_tiled/', workers=cores)
+            return {'tile_size': tile_graph.results['tile']['tile_size'],
+                    'tiles': [os.path.basename(t) for t in tiles]}
+
+        graph.add(Stage('tile', sample, outputs=['01_tiled'], cores=cores,
+                        description='Sampling %i tiles by point density and relief...' % preview,
+                        params={'tool': 'stratified_sample', 'tiles': preview}))
 
-    logging.info('Measuring height above ground for non-ground points...')
-
-    if ground_poly != '':
-        lof = lof_text(lastoolsdir, lidardir + '02a_lasground_new_coarse/')
-        odir = lidardir + '03a_lasheight_coarse/'
+    ########################
+    # classification chain: lasground_new -> lasheight -> lasclassify -> remove buffer -> separate (-> clip)
+    # the coarse and fine chains only depend on 01_tiled and run side by side
+    # every step runs one LAStools process per tile, at most cores at a time (see file_functions.run_commands), or
+    # the native step in a pool of processes. The outputs of every tile are verified, failed tiles are retried and
+    # quarantined if they keep failing (see quarantine.py). These steps return the quarantined tiles
+
+    def tile_tasks(files, odir, command):
+        # (input, output, command(input)) per tile, for LAStools writing to odir with -olas
+        return [(f, odir + os.path.splitext(os.path.basename(f))[0] + '.las', command(f)) for f in files]
+
+    def native_tasks(files, odir, args):
+        # (input, output, (input, output) + args) per tile, for native steps writing to odir
+        return [(f, odir + os.path.basename(f), (f, odir + os.path.basename(f)) + tuple(args)) for f in files]
+
+    def run_ground(setting, files, cores):
+        odir = workdir + dirs[setting]['ground'] + '/'
+        native = [f for f in files if readable(f)] if ground_engine != 'lasground_new' else []
+        failed = quarantine.run_native(classify_ground, native_tasks(native, odir, tuple(ground_params[setting]) +
+                                                                     (units_code,)), cores)
+        files = [f for f in files if f not in native]
+        failed.update(run_tiles(tile_tasks(files, odir, lambda f: lasground_command(lastoolsdir, f, units_code,
+                                                                                     ground_params[setting], odir)),
+                                cores, memory=planner.process_memory('lasground_new', files)))
+        return failed
+
+    def run_height(setting, files, cores):
+        odir = workdir + dirs[setting]['height'] + '/'
+        native = [f for f in files if readable(f)] if height_engine != 'lasheight' else []
+        failed = quarantine.run_native(height_above_ground, native_tasks(native, odir, (height_engine,)), cores)
+        files = [f for f in files if f not in native]
+        failed.update(run_tiles(tile_tasks(files, odir, lambda f: '%slasheight.exe -i %s -odir %s -olas' % (
+            lastoolsdir, f, odir)), cores, memory=planner.process_memory('lasheight', files)))
+        return failed
+
+    # ground surface of the eigen classifier
+    surface = 'tin' if height_engine == 'tin' else 'grid'
+
+    def run_classify(setting, files, cores):
+        odir = workdir + dirs[setting]['classify'] + '/'
+        if classify_engine == 'eigen':
+            native = [f for f in files if readable(f)]
+            failed = quarantine.run_native(classify_objects, native_tasks(native, odir, (
+                surface, ground_offset, planar, rugged, scatter, neighbours, units_code)), cores)
+            files = [f for f in files if f not in native]
+            if not files:
+                return failed
+            # tiles the eigen classifier cannot read get their heights from lasheight in the scratch directory
+            heights = tempfile.mkdtemp(prefix='lasheight_' + setting + '_', dir=scratch) + '/'
+            failed.update(run_tiles(tile_tasks(files, heights, lambda f: '%slasheight.exe -i %s -odir %s -olas' % (
+                lastoolsdir, f, heights)), cores, memory=planner.process_memory('lasheight', files)))
+            tiles = {heights + os.path.splitext(os.path.basename(f))[0] + '.las': f for f in files if f not in failed}
+            classified = run_tiles(tile_tasks(sorted(tiles), odir, lambda f: '%slasclassify.exe -i %s %s -odir %s -olas'
+                                              % (lastoolsdir, f, units_code, odir)),
+                                   cores, memory=planner.process_memory('lasclassify', list(tiles)))
+            failed.update({tiles[f]: reason for f, reason in classified.items()})
+            shutil.rmtree(heights, ignore_errors=True)
+            return failed
+        return run_tiles(tile_tasks(files, odir, lambda f: '%slasclassify.exe -i %s %s -odir %s -olas' % (
+            lastoolsdir, f, units_code, odir)), cores, memory=planner.process_memory('lasclassify', files))
+
+    def run_rm_buffer(setting, files, cores):
+        odir = workdir + dirs[setting]['rm_buffer'] + '/'
+        return run_tiles(tile_tasks(files, odir, lambda f: '%slastile.exe -i %s -remove_buffer -odir %s -olas' % (
+            lastoolsdir, f, odir)), cores, memory=planner.process_memory('lastile', files), conserve=False)
+
+    def run_separate(setting, files, cores):
+        return separate_classes(lastoolsdir, files, workdir + dirs[setting]['separated'], cores)
+
+    def clip(files, odir, interior, cores):
+        # native clipping of .las files (see poly_clip.py), lasclip for anything it cannot read. Returns the
+        # quarantined files
+        native = [f for f in files if readable(f)]
+        failed = {}
+        if native:
+            index = polygon_index(ground_poly)
+            tasks = [(f, [odir + os.path.basename(f)], (f, index, None if interior else odir + os.path.basename(f),
+                                                        odir + os.path.basename(f) if interior else None))
+                     for f in native]
+            failed = quarantine.run_native(clip_file, tasks, cores, conserve=False, processes=False)
+        # lasclip writes no output for a tile without points to keep
+        files = [f for f in files if f not in native]
+        failed.update(run_tiles([(f, [odir + os.path.splitext(os.path.basename(f))[0] + '.las'],
+                                  '%slasclip.exe -i %s -poly %s%s -donuts -odir %s -olas' % (
+                                      lastoolsdir, f, ground_poly, ' -interior' if interior else '', odir))
+                                 for f in files], cores, memory=planner.process_memory('lasclip', files),
+                                conserve=False))
+        return failed
+
+    def run_clip_ground(setting, files, cores):
+        # keep points outside ground polygon for coarse setting (-interior flag), inside for fine setting
+        return clip(files, workdir + dirs[setting]['clipped'] + '/', setting == 'coarse', cores)
+
+    def chain(setting):
+        """returns the steps of the chain as (key, runner, input directory, description, params)"""
+        step, bulge, spike, down_spike, offset = ground_params[setting]
+        ground_step = {'tool': 'lasground_new', 'hyper_fine': True} if ground_engine == 'lasground_new' else \
+            {'tool': 'ground', 'filter': ground_engine}
+        ground_step.update({'units': units_code, 'step': step, 'bulge': bulge, 'spike': spike, 'down_spike': down_spike,
+                            'offset': offset})
+        height_params = {'tool': 'lasheight'} if height_engine == 'lasheight' else \
+            {'tool': 'height', 'surface': height_engine}
+        d = dirs[setting]
+        steps = [('ground', run_ground, '01_tiled', 'Running ground classification on %s setting...',
+                  ground_step)]
+        if classify_engine == 'eigen':
+            # heights and classification in one pass, straight from the ground classification
+            steps.append(('classify', run_classify, d['ground'],
+                          'Classifying non-ground points by height and shape on %s setting...',
+                          {'tool': 'classify', 'features': 'eigen', 'surface': surface, 'units': units_code,
+                           'ground_offset': ground_offset, 'planar': planar, 'rugged': rugged, 'scatter': scatter,
+                           'neighbours': neighbours}))
+        else:
+            steps += [('height', run_height, d['ground'],
+                       'Measuring height above ground for non-ground points on %s setting...',
+                       height_params),
+                      ('classify', run_classify, d['height'], 'Classifying non-ground points on %s setting...',
+                       {'tool': 'lasclassify', 'units': units_code})]
+        steps += [('rm_buffer', run_rm_buffer, d['classify'], 'Removing tile buffers on %s setting...',
+                   {'tool': 'lastile', 'args': '-remove_buffer'}),
+                  ('separated', run_separate, d['rm_buffer'], 'Separating points by class type on %s setting...',
+                   {'tool': 'split_classes', 'classes': CLASSES})]
+        if split:
+            steps.append(('clipped', run_clip_ground, d['separated'] + '/02-Ground',
+                          'Clipping ground points to %s polygon on %%s setting...' % (
+                              'inverse ground' if setting == 'coarse' else 'ground'),
+                          {'tool': 'poly_clip', 'interior': setting == 'coarse', 'donuts': True}))
+        return steps
+
+    # the shapefile is an input of the clipping stages, changing it re-runs them
+    poly_files = [os.path.splitext(ground_poly)[0] + ext for ext in ('.shp', '.shx')] if split else []
+
+    if not per_tile:
+        # one stage per step, each running LAStools on the whole directory
+        def directory_step(runner, setting, idir, name):
+            def run(cores):
+                return quarantined(name, runner(setting, las_files(workdir + idir + '/'), cores) or {})
+            return run
+
+        def directory_plan(tool, idir):
+            # processes at a time, from the number and size of the tiles and the memory of the machine
+            return lambda: planner.workers(tool, las_files(workdir + idir + '/'))
+
+        for setting in settings:
+            for key, runner, idir, description, params in chain(setting):
+                name = {'separated': 'separate', 'clipped': 'clip_ground'}.get(key, key) + '_' + setting
+                graph.add(Stage(name, directory_step(runner, setting, idir, name), inputs=[idir],
+                                outputs=[dirs[setting][key]], cores=cores, description=description % setting,
+                                params=params, sources=poly_files if key == 'clipped' else (),
+                                plan=directory_plan(params['tool'], idir)))
     else:
-        lof = lof_text(lastoolsdir, lidardir + '02_lasground_new/')
-        odir = lidardir + '03_lasheight/'
-
-    cmd('%slasheight.exe -lof %s -cores %i -odir %s -olas' % (lastoolsdir, lof, cores, odir))
-
-    if ground_poly != '':
-        lof = lof_text(lastoolsdir, lidardir + '02b_lasground_new_fine/')
-        odir = lidardir + '03b_lasheight_fine/'
-
-        cmd('%slasheight.exe -lof %s -cores %i -odir %s -olas' % (lastoolsdir, lof, cores, odir))
-
-    logging.info('OK')
+        # every tile flows through the chain on its own: a pool of workers (each driving one LAStools process at a
+        # time) takes the next (tile, setting) task as soon as it finished the previous one, so no step waits for the
+        # slowest tile of the step before. The native steps of all workers run on one shared pool of processes
+        def tile_chain(setting, name):
+            for key, runner, idir, description, params in chain(setting):
+                filename = workdir + idir + '/' + name
+                if not os.path.isfile(filename):
+                    # e.g. a tile without ground points has nothing to clip
+                    break
+                try:
+                    failed = runner(setting, [filename], 1)
+                except Exception as e:
+                    # the step failed on its only tile
+                    failed = {filename: str(e)}
+                if failed:
+                    # quarantined, the tile drops out of the chain
+                    return failed
+            return {}
+
+        def tile_chains(cores):
+            # largest tiles first, so the pool does not end up waiting for one large tile
+            tiles = sorted(las_files(workdir + '01_tiled/'), key=pts, reverse=True)
+            tasks = [(setting, os.path.basename(t)) for t in tiles for setting in settings]
+            failed = {}
+            with process_pool(cores):
+                for f in run_tasks(tile_chain, tasks, cores):
+                    failed.update(f)
+            results = quarantined('tile_chains', failed)
+            if tasks and len(failed) == len(tasks):
+                msg = 'The classification chain failed on all %i tile(s)' % len(tasks)
+                logging.error(msg)
+                raise Exception(msg)
+            return results
+
+        graph.add(Stage('tile_chains', tile_chains, inputs=['01_tiled'],
+                        outputs=[dirs[setting][key] for setting in settings for key, _, _, _, _ in chain(setting)],
+                        cores=cores, description='Running the classification chain tile by tile...',
+                        params={setting: [params for _, _, _, _, params in chain(setting)] for setting in settings},
+                        sources=poly_files,
+                        # lasground_new needs the most memory of the chain
+                        plan=lambda: planner.workers('lasground_new', las_files(workdir + '01_tiled/'))))
 
     ##########################
-    # run lasclassify on each data set
-
-    logging.info('Classifying non-ground points on coarse setting...')
-
-    if ground_poly != '':
-        lof = lof_text(lastoolsdir, lidardir + '03a_lasheight_coarse/')
-        odir = lidardir + '04a_lasclassify_coarse/'
+    # merge (re-tile with the tile size found by the tiling stage)
+
+    def merge(name, sources, odir, lowest_z_only=False):
+        def run(cores):
+            tile_size = graph.results['tile']['tile_size']
+            files = [f for s in sources for f in sorted(las_files(workdir + s + '/'))]
+            if mergeable(files):
+                # every tile is written from the files overlapping it, removing duplicates on the way. Tiles whose
+                # inputs did not change since the last run are kept (see point_ops.merge_tiles)
+                merge_tiles(files, workdir + odir + '/', tile_size, lowest_z_only=lowest_z_only, workers=cores,
+                            incremental=True)
+                return
+
+            # fall back to LAStools for .laz sources or sources with different point formats, from scratch (the merge
+            # stages are incremental, so their outputs are not cleared by the scheduler)
+            manifest.clear_outputs(graph.stage(name), workdir)
+            tiled = workdir + odir + ('/merged/' if lowest_z_only else '/')
+            if not os.path.isdir(tiled):
+                os.mkdir(tiled)
+            cmd('%slastile.exe -lof %s -cores %i -o tile.las -tile_size %i -faf -odir %s -olas' % (
+                lastoolsdir, lof(name, files), cores, tile_size, tiled))
+            if lowest_z_only:
+                cmd('%slasduplicate.exe -lof %s -cores %i -lowest_z -odir %s -olas' % (
+                    lastoolsdir, lof(name + '_rm_duplicates', tiled), cores, workdir + odir + '/'))
+                shutil.rmtree(tiled)
+        return run
+
+    # merge processed ground points with original data set ground points. With the original points, duplicates
+    # (lowest z of all points with the same x and y is kept) are removed while merging.
+    if split:
+        ground_sources = [dirs['coarse']['clipped'], dirs['fine']['clipped']]
     else:
-        lof = lof_text(lastoolsdir, lidardir + '03_lasheight/')
-        odir = lidardir + '04_lasclassify/'
-
-    cmd('%slasclassify.exe -lof %s -cores %i %s -odir %s -olas' % (lastoolsdir, lof, cores, units_code, odir))
-
-    logging.info('OK')
-
-    if ground_poly != '':
-        logging.info('Classifying non-ground points on fine setting...')
-
-        lof = lof_text(lastoolsdir, lidardir + '03b_lasheight_fine/')
-        odir = lidardir + '04b_lasclassify_fine/'
-
-        cmd('%slasclassify.exe -lof %s -cores %i %s -odir %s -olas' % (lastoolsdir, lof, cores, units_code, odir))
-
-        logging.info('OK')
-
-    ##########################
-    # remove tile buffers on each data set
-
-    logging.info('Removing tile buffers...')
-
-    if ground_poly != '':
-        lof = lof_text(lastoolsdir, lidardir + '04a_lasclassify_coarse/')
-        odir = lidardir + '05a_lastile_rm_buffer_coarse/'
+        ground_sources = [dirs['coarse']['separated'] + '/02-Ground']
+    if keep_orig_pts:
+        ground_sources.append('00_separated/02-Ground')
+
+    if keep_orig_pts or split:
+        ground_odir = '09_ground_rm_duplicates' if keep_orig_pts else '08_ground_merged'
+        graph.add(Stage('merge_ground', merge('merge_ground', ground_sources, ground_odir, keep_orig_pts),
+                        inputs=ground_sources + ['01_tiled'], reads=ground_sources, outputs=[ground_odir], cores=cores,
+                        description='Merging new and original ground points, removing duplicates...' if keep_orig_pts
+                        else 'Merging new ground points...',
+                        params={'tool': 'merge_tiles', 'sources': ground_sources, 'lowest_z': keep_orig_pts},
+                        incremental=True))
+        ground_results = workdir + ground_odir + '/'
     else:
-        lof = lof_text(lastoolsdir, lidardir + '04_lasclassify/')
-        odir = lidardir + '05_lastile_rm_buffer/'
-
-    cmd('%slastile.exe -lof %s -cores %i -remove_buffer -odir %s -olas' % (lastoolsdir, lof, cores, odir))
-
-    if ground_poly != '':
-        lof = lof_text(lastoolsdir, lidardir + '04b_lasclassify_fine/')
-        odir = lidardir + '05b_lastile_rm_buffer_fine/'
-
-        cmd('%slastile.exe -lof %s -cores %i -remove_buffer -odir %s -olas' % (lastoolsdir, lof, cores, odir))
-
-    logging.info('OK')
-
-    ##########################
-    # separate into files for each class type
-
-    logging.info('Separating points by class type on coarse setting...')
-
-    # coarse
-    if ground_poly != '':
-        lof = lof_text(lastoolsdir, lidardir + '05a_lastile_rm_buffer_coarse/')
-        podir = lidardir + '06a_separated_coarse'
+        ground_results = workdir + dirs['coarse']['separated'] + '/02-Ground/'
+
+    # merge new veg points from coarse and fine run, then clip them keeping points outside the ground polygon
+    if split:
+        veg_new = [dirs['coarse']['separated'] + '/05-Vegetation', dirs['fine']['separated'] + '/05-Vegetation']
+        graph.add(Stage('merge_veg_new', merge('merge_veg_new', veg_new, '10_veg_new_merged'),
+                        inputs=veg_new + ['01_tiled'], reads=veg_new, outputs=['10_veg_new_merged'], cores=cores,
+                        description='Merging new vegetation points from coarse and fine run...',
+                        params={'tool': 'merge_tiles', 'sources': veg_new},
+                        incremental=True))
+
+        def clip_veg(cores):
+            failed = clip(las_files(workdir + '10_veg_new_merged/'), workdir + '11_veg_new_clipped/', True, cores)
+            return quarantined('clip_veg', failed)
+
+        graph.add(Stage('clip_veg', clip_veg, inputs=['10_veg_new_merged'], outputs=['11_veg_new_clipped'],
+                        cores=cores, description='Clipping new vegetation points...',
+                        params={'tool': 'poly_clip', 'interior': True, 'donuts': True}, sources=poly_files))
+        veg_sources = ['11_veg_new_clipped']
     else:
-        lof = lof_text(lastoolsdir, lidardir + '05_lastile_rm_buffer/')
-        podir = lidardir + '06_separated'
+        veg_sources = [dirs['coarse']['separated'] + '/05-Vegetation']
 
-    for class_type in classes:
-        odir = podir + '/' + class_type + '/'
-        class_code = int(class_type.split('-')[0])
-        cmd('%slas2las.exe -lof %s -cores %i -keep_classification %i -odir %s -olas' % (
-            lastoolsdir, lof, cores, class_code, odir))
-
-    logging.info('OK')
-
-    if ground_poly == '' and (keep_orig_pts == False):
-        ground_results = podir + '/' + '02-Ground' + '/'
-        veg_results = podir + '/' + '05-Vegetation' + '/'
-
-    if ground_poly != '':
-        logging.info('Separating points by class type on fine setting...')
-
-        # fine
-        lof = lof_text(lastoolsdir, lidardir + '05b_lastile_rm_buffer_fine/')
-
-        for class_type in classes:
-            odir = lidardir + '06b_separated_fine' + '/' + class_type + '/'
-            class_code = int(class_type.split('-')[0])
-            cmd('%slas2las.exe -lof %s -cores %i -keep_classification %i -odir %s -olas' % (
-                            lastoolsdir, lof, cores, class_code, odir))
-
-        logging.info('OK')
+    # merge with original veg points, removing duplicates
+    if keep_orig_pts:
+        veg_sources.append('00_separated/05-Vegetation')
+
+    if keep_orig_pts or split:
+        veg_odir = '13_veg_rm_duplicates' if keep_orig_pts else '12_veg_merged'
+        graph.add(Stage('merge_veg', merge('merge_veg', veg_sources, veg_odir, keep_orig_pts),
+                        inputs=veg_sources + ['01_tiled'], reads=veg_sources, outputs=[veg_odir], cores=cores,
+                        description='Merging new and original vegetation points, removing duplicates...'
+                        if keep_orig_pts else 'Retiling new vegetation points...',
+                        params={'tool': 'merge_tiles', 'sources': veg_sources, 'lowest_z': keep_orig_pts},
+                        incremental=True))
+        veg_results = workdir + veg_odir + '/'
+    else:
+        veg_results = workdir + dirs['coarse']['separated'] + '/05-Vegetation/'
 
     ##########################
-    # clip ground data sets with ground polygon
-    if ground_poly != '':
-        logging.info('Clipping ground points to inverse ground polygon on coarse setting...')
-
-        # keep points outside ground polygon for coarse setting (-interior flag)
-        lof = lof_text(lastoolsdir, lidardir + '06a_separated_coarse' + '/' + '02-Ground' + '/')
-        odir = lidardir + '07a_ground_clipped_coarse/'
-
-        cmd('%slasclip.exe -lof %s -cores %i -poly %s -interior -donuts -odir %s -olas' % (
-            lastoolsdir, lof, cores, ground_poly, odir))
+    # prepare directories and input data
 
-        logging.info('OK')
+    outdirs = sorted(graph.outputs())
 
-        logging.info('Clipping ground points to ground polygon on fine setting...')
-
-        # keep points inside ground polygon for fine setting
-        lof = lof_text(lastoolsdir, lidardir + '06b_separated_fine' + '/' + '02-Ground' + '/')
-        odir = lidardir + '07b_ground_clipped_fine/'
-
-        cmd('%slasclip.exe -lof %s -cores %i -poly %s -donuts -odir %s -olas' % (
-            lastoolsdir, lof, cores, ground_poly, odir))
-
-        logging.info('OK')
+    # make new directories for output from each step in processing
+    for outdir in outdirs:
+        if os.path.isdir(workdir + outdir) == False:
+            os.mkdir(workdir + outdir)
 
-    ##########################
-    # merge
+    # in each 'separated' folder, create subdirs for each class type
+    sepdirs = [workdir + '00_separated'] + [workdir + dirs[setting]['separated'] for setting in settings]
+    for sepdir in sepdirs:
+        for class_type in CLASSES:
+            class_dir = sepdir + '/' + class_type
+            if os.path.isdir(class_dir) == False:
+                os.mkdir(class_dir)
 
-    # merge processed ground points with original data set ground points
+    logging.info('Created directories for output data')
 
-    if keep_orig_pts == True:
-        logging.info('Merging new and original ground points...')
-        if ground_poly != '':
-            sources = [lidardir + '07a_ground_clipped_coarse/', lidardir + '07b_ground_clipped_fine/',
-                       lidardir + '00_separated' + '/' + '02-Ground' + '/']
-        else:
-            sources = [lidardir + '06_separated' + '/' + '02-Ground' + '/',
-                       lidardir + '00_separated' + '/' + '02-Ground' + '/']
-    # just use new points
-    elif ground_poly != '':
-        logging.info('Merging new ground points...')
-        sources = [lidardir + '07a_ground_clipped_coarse/', lidardir + '07b_ground_clipped_fine/']
-
-    if (keep_orig_pts == True) or (ground_poly != ''):
-        lof = lof_text(lastoolsdir, sources)
-        odir = lidardir + '08_ground_merged/'
-        ground_results = odir # will be overwritten if rm_duplicates block runs
-        cmd('%slastile.exe -lof %s -cores %i -o tile.las -tile_size %i -faf -odir %s -olas' % (
-            lastoolsdir, lof, cores, tile_size, odir))
-
-        logging.info('OK')
+    # get list of filenames for original LiDAR data (all .las and .laz files in lidardir)
+    # output directories of this or earlier runs (with any settings) are skipped
+    lidar_files = []
+    for path, subdirs, files in os.walk(lidardir):
+        if os.path.normpath(path) == os.path.normpath(lidardir):
+            subdirs[:] = [d for d in subdirs if d not in output_dirs() + [SCRATCH_NAME, SWEEP_NAME, PREVIEW_NAME]]
+        for name in files:
+            if name.endswith('.las') or name.endswith('.laz'):
+                lidar_files.append(path + '/' + name)
+    lidar_files.sort()
 
-    ##########################
-    # remove duplicate ground points
+    if lidar_files == []:
+        msg = 'No .las or .laz files in %s or its subdirectories' % lidardir
+        logging.error(msg)
+        raise Exception(msg)
 
-    if (keep_orig_pts == True):
-        logging.info('Removing duplicate ground points...')
-        lof = lof_text(lastoolsdir, lidardir + '08_ground_merged/')
-        odir = lidardir + '09_ground_rm_duplicates/'
-        ground_results = odir
+    # the original point clouds are inputs of the first stages
+    if not preview:
+        for name in ['declassify', 'separate_original', 'tile']:
+            graph.stage(name).sources = lidar_files
+    else:
+        tile_graph.stage('tile').sources = lidar_files
+        if not os.path.isdir(lidardir + '01_tiled'):
+            os.mkdir(lidardir + '01_tiled')
 
-        cmd('%slasduplicate.exe -lof %s -cores %i -lowest_z -odir %s -olas' % (lastoolsdir, lof, cores, odir))
+    if retention != 'keep' or disk_budget:
+        def compress(files):
+            run_commands(['%slaszip.exe -i %s -olaz' % (lastoolsdir, f) for f in files], cores)
 
-        logging.info('OK')
+        graph.retention = Retention(graph, retention, copy_size=uncompressed_size(lidar_files),
+                                    keep=[os.path.relpath(r, workdir).replace(os.sep, '/')
+                                          for r in (ground_results, veg_results)],
+                                    budget=float(disk_budget) * 2 ** 30 if disk_budget else None, compress=compress)
 
     ##########################
-    # merge new veg points
-
-    if ground_poly != '':
-        logging.info('Merging new vegetation points from coarse and fine run...')
-
-        sources = [lidardir + '06a_separated_coarse' + '/' + '05-Vegetation' + '/',
-                   lidardir + '06b_separated_fine' + '/' + '05-Vegetation' + '/']
-        lof = lof_text(lastoolsdir, sources)
-        odir = lidardir + '10_veg_new_merged/'
-
-        cmd('%slastile.exe -lof %s -cores %i -o tile.las -tile_size %i -faf -odir %s -olas' % (
-            lastoolsdir, lof, cores, tile_size, odir))
+    # run all stages, independent stages in parallel
+    # only one run at a time may process lidardir. Temporary files of the run (such as the file lists for LAStools)
+    # go to a scratch directory in lidardir, so runs of different projects can share one LAStools installation
+
+    with run_lock(lidardir), scratch_dir(lidardir) as scratch:
+        # LAStools reads the original point clouds from a single list
+        original_lof = lof('original', lidar_files)
+        if preview:
+            if manifest.retired(tile_stage, lidardir):
+                # the tiles of a full run were deleted or compressed once the stages reading them finished. As the
+                # tile stage has no consumers in tile_graph, it would count as up to date without them
+                tile_graph.force.add('tile')
+            tile_graph.run(budget or CoreBudget(cores))
+            # re-tiling the project draws a new sample
+            graph.stage('tile').sources = las_files(lidardir + '01_tiled/')
+        graph.run(budget or CoreBudget(cores))
+
+    if preview:
+        preview_summary(workdir, graph, las_files(lidardir + '01_tiled/'), cores)
+
+    quarantine.prune(workdir, [s.name for s in graph.stages])
+    failed = quarantine.quarantined(workdir)
+    if failed:
+        logging.warning('Tiles quarantined after repeated failures, the results lack their points (see '
+                        '%s):\n%s' % (workdir + quarantine.QUARANTINE_NAME,
+                                      '\n'.join('%s: %s (%s)' % (stage, tile, reason) for stage, tiles in
+                                                sorted(failed.items()) for tile, reason in sorted(tiles.items()))))
 
-        logging.info('OK')
-
-        #########################
-        # clip new veg points
-        # keeping points outside the ground polygon
-
-        logging.info('Clipping new vegetation points...')
-
-        lof = lof_text(lastoolsdir, lidardir + '10_veg_new_merged/')
-        odir = lidardir + '11_veg_new_clipped/'
-
-        cmd('%slasclip.exe -lof %s -cores %i -poly %s -interior -donuts -odir %s -olas' % (
-            lastoolsdir, lof, cores, ground_poly, odir))
-
-        logging.info('OK')
-
-    #########################
-    # merge with original veg points
-
-    if (keep_orig_pts == True):
-        logging.info('Merging new and original vegetation points...')
-        if ground_poly != '':
-            sources = [lidardir + '11_veg_new_clipped/', lidardir + '00_separated' + '/' + '05-Vegetation' + '/']
-        else:
-            sources = [lidardir + '06_separated' + '/' + '05-Vegetation' + '/',
-                       lidardir + '00_separated' + '/' + '05-Vegetation' + '/']
-    elif ground_poly != '':
-        logging.info('Retiling new vegetation points...')
-        sources = [lidardir + '11_veg_new_clipped/']
-
-    if (keep_orig_pts == True) or (ground_poly != ''):
-        lof = lof_text(lastoolsdir, sources)
-        odir = lidardir + '12_veg_merged/'
-        veg_results = odir # will be overwritten if rm_duplicates block runs
-
-    cmd('%slastile.exe -lof %s -cores %i -o tile.las -tile_size %i -faf -odir %s -olas' % (
-        lastoolsdir, lof, cores, tile_size, odir))
+    logging.info('Processing finished.')
+    logging.info('Outputs in:')
+    logging.info('%s\n%s' % (ground_results, veg_results))
 
-    logging.info('OK')
+    return ground_results, veg_results
 
-    #########################
-    # remove duplicate veg points
-    if keep_orig_pts:
-        logging.info('Removing duplicate vegetation points...')
 
-        lof = lof_text(lastoolsdir, lidardir + '12_veg_merged/')
-        odir = lidardir + '13_veg_rm_duplicates/'
-        veg_results = odir
+def preview_summary(workdir, graph, tiles, cores):
+    """writes the sampled tiles, their points and the estimated time of a full run to preview.json in workdir"""
+    sampled = [t for t in tiles if os.path.basename(t) in graph.results['tile']['tiles']]
+    points = sum(pts(t) for t in sampled)
+    total_points = sum(pts(t) for t in tiles)
 
-        cmd('%slasduplicate.exe -lof %s -cores %i -lowest_z -odir %s -olas' % (lastoolsdir, lof, cores, odir))
+    # stages skipped in this run (unchanged since the last preview) count with the time they took then
+    try:
+        with open(workdir + PREVIEW_SUMMARY) as f:
+            previous = {r['stage']: r for r in json.load(f)['stages']}
+    except (OSError, ValueError, KeyError):
+        previous = {}
+    records = [previous.get(r['stage'], r) if r['skipped'] else r for r in graph.profile]
+    estimate = extrapolate(records, points, total_points, len(sampled), len(tiles), cores)
 
-        logging.info('OK')
+    summary = {'tiles': [os.path.basename(t) for t in sampled], 'points': points, 'total_tiles': len(tiles),
+               'total_points': total_points, 'cores': cores, 'wall': sum(r['wall'] for r in records),
+               'estimated_wall': estimate,
+               'stages': [{'stage': r['stage'], 'wall': r['wall'], 'cores': r['cores']} for r in records]}
+    with open(workdir + PREVIEW_SUMMARY, 'w') as f:
+        json.dump(summary, f, indent=1)
+    logging.info('Preview on %i of %i tiles (%i of %i points). Estimated time of the classification and merge stages '
+                 'of a full run: %.1f min' % (len(sampled), len(tiles), points, total_points, estimate / 60))
 
-    logging.info('Processing finished.')
-    logging.info('Outputs in:')
-    logging.info('%s\n%s' % (ground_results, veg_results))
 
-    return
+@err_info
+def process_lidar(*args, **kwargs):
+    """Executes main LAStools processing workflow (see lidar_workflow), showing errors in a message box"""
+    lidar_workflow(*args, **kwargs)
 
 
 #####################################################################
@@ -764,7 +1000,10 @@ if __name__ == '__main__':
     R16.grid(row=15, column=2)
     R32 = tk.Radiobutton(root, text='32', variable=core_num, value=32)
     R32.grid(sticky=tk.W, row=15, column=3)
-    core_num.set(16)
+    # 0: all CPUs of the machine, processes per stage planned from tiles and memory (see resources.Planner)
+    Rauto = tk.Radiobutton(root, text='auto', variable=core_num, value=0)
+    Rauto.grid(sticky=tk.W, row=13, column=3)
+    core_num.set(0)
 
     L5 = tk.Label(root, text='Keep original ground/veg points: ')
     L5.grid(sticky=tk.E, row=16, column=1)
@@ -773,6 +1012,70 @@ if __name__ == '__main__':
     C1.grid(sticky=tk.W, row=16, column=2)
     keep_originals.set(True)
 
+    L6 = tk.Label(root, text='Process tiles independently: ')
+    L6.grid(sticky=tk.E, row=17, column=1)
+    per_tile = tk.BooleanVar()
+    C2 = tk.Checkbutton(root, variable=per_tile)
+    C2.grid(sticky=tk.W, row=17, column=2)
+    per_tile.set(False)
+
+    L7 = tk.Label(root, text='Intermediate outputs: ')
+    L7.grid(sticky=tk.E, row=18, column=1)
+    retention_var = tk.StringVar()
+    O1 = tk.OptionMenu(root, retention_var, 'keep', 'delete', 'compress')
+    O1.grid(sticky=tk.W, row=18, column=2)
+    retention_var.set('keep')
+
+    L8 = tk.Label(root, text='Disk budget in GB (optional): ')
+    L8.grid(sticky=tk.E, row=19, column=1)
+    E8 = tk.Entry(root, bd=5)
+    E8.grid(sticky=tk.W, row=19, column=2)
+
+    L12 = tk.Label(root, text='Ground classification: ')
+    L12.grid(sticky=tk.E, row=20, column=1)
+    ground_engine = tk.StringVar()
+    O4 = tk.OptionMenu(root, ground_engine, *GROUND_ENGINES)
+    O4.grid(sticky=tk.W, row=20, column=2)
+    ground_engine.set('lasground_new')
+
+    L9 = tk.Label(root, text='Height above ground: ')
+    L9.grid(sticky=tk.E, row=21, column=1)
+    height_engine = tk.StringVar()
+    O2 = tk.OptionMenu(root, height_engine, *HEIGHT_ENGINES)
+    O2.grid(sticky=tk.W, row=21, column=2)
+    height_engine.set('lasheight')
+
+    L13 = tk.Label(root, text='Vegetation/building classification: ')
+    L13.grid(sticky=tk.E, row=22, column=1)
+    classify_engine = tk.StringVar()
+    O5 = tk.OptionMenu(root, classify_engine, *CLASSIFY_ENGINES)
+    O5.grid(sticky=tk.W, row=22, column=2)
+    classify_engine.set('lasclassify')
+
+    # thresholds and neighbourhood size of the eigen classifier (see classify.py)
+    eigen = {}
+    for row, (key, text, default) in enumerate([('ground_offset', 'Eigen: ground offset (m): ', GROUND_OFFSET),
+                                                ('planar', 'Eigen: planar roughness (m): ', PLANAR),
+                                                ('rugged', 'Eigen: rugged roughness (m): ', RUGGED),
+                                                ('scatter', 'Eigen: scatter: ', SCATTER),
+                                                ('neighbours', 'Eigen: neighbours: ', NEIGHBOURS)], 23):
+        tk.Label(root, text=text).grid(sticky=tk.E, row=row, column=1)
+        eigen[key] = tk.Entry(root, bd=5)
+        eigen[key].insert(tk.END, str(default))
+        eigen[key].grid(sticky=tk.W, row=row, column=2)
+
+    L11 = tk.Label(root, text='Tiling: ')
+    L11.grid(sticky=tk.E, row=28, column=1)
+    tiling_var = tk.StringVar()
+    O3 = tk.OptionMenu(root, tiling_var, *TILINGS)
+    O3.grid(sticky=tk.W, row=28, column=2)
+    tiling_var.set('uniform')
+
+    L10 = tk.Label(root, text='Preview on number of tiles (optional): ')
+    L10.grid(sticky=tk.E, row=29, column=1)
+    E10 = tk.Entry(root, bd=5)
+    E10.grid(sticky=tk.W, row=29, column=2)
+
     # make 'Run' button in GUI to call the process_lidar() function
     b = tk.Button(root, text='    Run    ', command=lambda: process_lidar(lastoolsdir=E1.get(),
                                                                        lidardir=E2.get(),
@@ -789,11 +1092,40 @@ if __name__ == '__main__':
                                                                        fine_bulge=E2b.get(),
                                                                        fine_spike=E3b.get(),
                                                                        fine_down_spike=E4b.get(),
-                                                                       fine_offset=E5b.get()
+                                                                       fine_offset=E5b.get(),
+                                                                       per_tile=per_tile.get(),
+                                                                       retention=retention_var.get(),
+                                                                       disk_budget=E8.get(),
+                                                                       ground_engine=ground_engine.get(),
+                                                                       height_engine=height_engine.get(),
+                                                                       classify_engine=classify_engine.get(),
+                                                                       ground_offset=eigen['ground_offset'].get(),
+                                                                       planar=eigen['planar'].get(),
+                                                                       rugged=eigen['rugged'].get(),
+                                                                       scatter=eigen['scatter'].get(),
+                                                                       neighbours=eigen['neighbours'].get(),
+                                                                       tiling=tiling_var.get(),
+                                                                       preview=E10.get()
                                                                        )
                )
 
-    b.grid(sticky=tk.W, row=17, column=2)
-    root.grid_rowconfigure(17, minsize=80)
+    b.grid(sticky=tk.W, row=30, column=2)
+    root.grid_rowconfigure(30, minsize=80)
+
+    # try every combination of comma-separated values typed into the standard/coarse parameters on a few tiles
+    from sweep import sweep_lidar
+    b_sweep = tk.Button(root, text='    Sweep    ', command=lambda: sweep_lidar(lastoolsdir=E1.get(),
+                                                                             lidardir=E2.get(),
+                                                                             units_code=unit_var.get()[1:-1],
+                                                                             cores=core_num.get(),
+                                                                             step=E1a.get(),
+                                                                             bulge=E2a.get(),
+                                                                             spike=E3a.get(),
+                                                                             down_spike=E4a.get(),
+                                                                             offset=E5a.get(),
+                                                                             ground_engine=ground_engine.get()
+                                                                             )
+                        )
+    b_sweep.grid(sticky=tk.W, row=30, column=3)
 
     root.mainloop()
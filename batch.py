@@ -0,0 +1,187 @@
+"""
+Headless batch processing of many LiDAR projects.
+
+A queue file (JSON) lists the projects to process, each with the arguments of the LiDAR workflow. All projects draw
+from one pool of cores, so several projects can run at the same time without overloading the machine, and share one
+LAStools installation (the temporary files of every run are kept in its project directory). The state of every project
+(queued, running, done or failed) is written to batch_status.json in its LiDAR data directory.
+
+Queue file example::
+
+    {
+        "cores": 16,
+        "parallel": 2,
+        "defaults": {"lastoolsdir": "C:\\\\LAStools\\\\bin\\\\", "keep_orig_pts": true, "units": "meters",
+                     "coarse": {"step": 5, "bulge": 1, "spike": 1, "down_spike": 1, "offset": 0.05}},
+        "projects": [
+            {"lidardir": "D:\\\\surveys\\\\block_01\\\\"},
+            {"lidardir": "D:\\\\surveys\\\\block_02\\\\", "ground_poly": "D:\\\\surveys\\\\block_02\\\\ground.shp",
+             "fine": {"step": 1, "bulge": 0.5, "spike": 0.5, "down_spike": 0.5, "offset": 0.02}},
+            {"lidardir": "D:\\\\surveys\\\\block_03\\\\", "classify_engine": "eigen", "planar": 0.15, "neighbours": 16}
+        ]
+    }
+
+Usage::
+
+    python batch.py queue.json [--cores N] [--parallel N]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import traceback
+from pipeline import CoreBudget, run_tasks
+from resources import cpu_count
+from LiDAR_processing_GUI import lidar_workflow
+from classify import GROUND_OFFSET, PLANAR, RUGGED, SCATTER, NEIGHBOURS
+
+
+logger = logging.getLogger(__name__)
+
+STATUS_NAME = 'batch_status.json'
+
+UNITS = {'meters': '', 'feet': '-feet -elevation_feet'}
+
+GROUND_PARAMS = ('step', 'bulge', 'spike', 'down_spike', 'offset')
+
+# parameters of the eigen classifier (see classify.py) with their defaults
+EIGEN_PARAMS = {'ground_offset': GROUND_OFFSET, 'planar': PLANAR, 'rugged': RUGGED, 'scatter': SCATTER,
+                'neighbours': NEIGHBOURS}
+
+
+def read_queue(filename):
+    """returns the queue file as dict, with the defaults merged into every project"""
+    with open(filename, 'r') as f:
+        queue = json.load(f)
+    defaults = queue.get('defaults', {})
+    projects = []
+    for p in queue.get('projects', []):
+        project = dict(defaults)
+        project.update(p)
+        for setting in ('coarse', 'fine'):
+            project[setting] = dict(defaults.get(setting, {}), **p.get(setting, {}))
+        projects.append(project)
+    # a project directory can only be processed by one run at a time (see file_functions.run_lock)
+    dirs = [os.path.normcase(os.path.abspath(p.get('lidardir', ''))) for p in projects if p.get('lidardir')]
+    for d in set(dirs):
+        if dirs.count(d) > 1:
+            msg = 'Project %s is listed %i times in %s' % (d, dirs.count(d), filename)
+            logger.error(msg)
+            raise Exception(msg)
+    queue['projects'] = projects
+    return queue
+
+
+def workflow_args(project, cores):
+    """returns the keyword arguments of lidar_workflow for a project of the queue"""
+    for key in ('lastoolsdir', 'lidardir'):
+        if not project.get(key):
+            msg = 'Project %s has no %s' % (project.get('lidardir', '?'), key)
+            logger.error(msg)
+            raise Exception(msg)
+    if not os.path.isdir(project['lidardir']):
+        msg = 'LiDAR data directory %s does not exist' % project['lidardir']
+        logger.error(msg)
+        raise Exception(msg)
+    if project.get('units', 'meters') not in UNITS:
+        msg = 'Unknown units %s (use meters or feet)' % project['units']
+        logger.error(msg)
+        raise Exception(msg)
+
+    # the workflow expects directories with a trailing separator
+    kwargs = {key: os.path.join(project[key], '') for key in ('lastoolsdir', 'lidardir')}
+    kwargs.update({'ground_poly': project.get('ground_poly', ''),
+                   'cores': project.get('cores', cores),
+                   'units_code': UNITS[project.get('units', 'meters')],
+                   'keep_orig_pts': project.get('keep_orig_pts', True),
+                   'per_tile': project.get('per_tile', False),
+                   'retention': project.get('retention', 'keep'),
+                   'disk_budget': project.get('disk_budget', ''),
+                   'ground_engine': project.get('ground_engine', 'lasground_new'),
+                   'height_engine': project.get('height_engine', 'lasheight'),
+                   'classify_engine': project.get('classify_engine', 'lasclassify'),
+                   'tiling': project.get('tiling', 'uniform'),
+                   'preview': project.get('preview', 0)})
+    kwargs.update({param: project.get(param, default) for param, default in EIGEN_PARAMS.items()})
+    for setting in ('coarse', 'fine'):
+        for param in GROUND_PARAMS:
+            kwargs['%s_%s' % (setting, param)] = project[setting].get(param, '')
+    return kwargs
+
+
+def write_status(lidardir, state, **info):
+    """writes the state of a project (and further info) to batch_status.json in its data directory"""
+    status = {'state': state, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    status.update(info)
+    with open(os.path.join(lidardir, STATUS_NAME), 'w') as f:
+        json.dump(status, f, indent=1)
+
+
+def run_project(project, budget):
+    """runs the workflow for one project of the queue, returns True if it succeeded"""
+    lidardir = project.get('lidardir', '')
+    start = time.time()
+    try:
+        kwargs = workflow_args(project, budget.total)
+        write_status(lidardir, 'running', started=time.strftime('%Y-%m-%d %H:%M:%S'))
+        logger.info('Processing %s...' % lidardir)
+        ground_results, veg_results = lidar_workflow(budget=budget, **kwargs)
+    except Exception as e:
+        logger.error('Processing %s failed: %s' % (lidardir, e))
+        if os.path.isdir(lidardir):
+            write_status(lidardir, 'failed', error=str(e), traceback=traceback.format_exc(),
+                         duration=time.time() - start)
+        return False
+    write_status(lidardir, 'done', ground_results=ground_results, veg_results=veg_results,
+                 duration=time.time() - start)
+    logger.info('Finished %s' % lidardir)
+    return True
+
+
+def run_queue(queue, cores=None, parallel=None):
+    """
+    Processes all projects of a queue, returns the number of failed projects
+
+    Args:
+        queue (dict): queue as returned by read_queue
+        cores (int): cores shared by all projects (defaults to the queue's 'cores', or all cores of the machine if
+            neither is given or it is 'auto')
+        parallel (int): number of projects processed at the same time (defaults to the queue's 'parallel', or 1)
+    """
+    cores = cores or queue.get('cores')
+    cores = cpu_count() if not cores or cores == 'auto' else int(cores)
+    parallel = parallel or queue.get('parallel') or 1
+    budget = CoreBudget(cores)
+    projects = queue['projects']
+    for project in projects:
+        if os.path.isdir(project.get('lidardir', '')):
+            write_status(project['lidardir'], 'queued')
+
+    logger.info('Processing %i projects, %i at a time, on %i cores' % (len(projects), parallel, cores))
+    results = run_tasks(run_project, [(p, budget) for p in projects], parallel)
+    failed = results.count(False)
+    logger.info('Batch finished: %i done, %i failed' % (len(projects) - failed, failed))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the LiDAR processing workflow for a queue of projects.')
+    parser.add_argument('queue', help='queue file (JSON)')
+    parser.add_argument('--cores', type=int, help='cores shared by all projects')
+    parser.add_argument('--parallel', type=int, help='number of projects processed at the same time')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(filename=os.path.splitext(args.queue)[0] + '.log', filemode='a', level=logging.INFO,
+                        format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
+    stderr_logger = logging.StreamHandler()
+    stderr_logger.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.getLogger().addHandler(stderr_logger)
+
+    return 1 if run_queue(read_queue(args.queue), args.cores, args.parallel) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
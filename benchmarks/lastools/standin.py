@@ -0,0 +1,257 @@
+"""
+Local stand-ins for the LAStools used by the LiDAR workflow.
+
+Every <tool>.exe in this directory is a small launcher calling main(<tool>, arguments). The stand-ins accept the
+command lines process_lidar builds (input with -i or -lof, -cores, -odir, -olas, -o and the tool specific flags) and
+write their outputs with the same names and into the same directories as LAStools. They process uncompressed .las
+files only. The algorithms of lasground_new, lasheight and lasclassify are simple grid-based approximations: they
+produce plausible classes at a comparable cost per point, not the results of LAStools.
+
+Point the LAStools directory of the workflow to this directory to run it without LAStools (POSIX only, the launchers
+are Python scripts).
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from las_io import read_header, point_dtype, LasReader
+from point_ops import merge_tiles, remove_buffer, remove_duplicates
+from poly_clip import polygon_index, clip_file
+from pipeline import run_tasks
+
+# flags followed by a value, and flags followed by a list of values
+VALUE_FLAGS = ('-i', '-lof', '-cores', '-odir', '-o', '-odix', '-tile_size', '-buffer', '-step', '-bulge', '-spike',
+               '-down_spike', '-offset', '-poly', '-set_classification')
+LIST_FLAGS = ('-keep_class', '-keep_classification', '-drop_class')
+
+
+def parse(argv):
+    """returns the command line as dict of flag: value (list for -i and list flags, True for switches)"""
+    args = {'-i': []}
+    i = 0
+    while i < len(argv):
+        flag = argv[i]
+        if flag == '-i':
+            args['-i'].append(argv[i + 1])
+            i += 2
+        elif flag in VALUE_FLAGS:
+            args[flag] = argv[i + 1]
+            i += 2
+        elif flag in LIST_FLAGS:
+            values = []
+            i += 1
+            while i < len(argv) and not argv[i].startswith('-'):
+                values.append(int(argv[i]))
+                i += 1
+            args[flag] = values
+        else:
+            args[flag] = True
+            i += 1
+    return args
+
+
+def input_files(args):
+    """returns the input files given with -i and -lof"""
+    files = list(args['-i'])
+    if '-lof' in args:
+        with open(args['-lof']) as f:
+            files += [line.strip() for line in f if line.strip()]
+    return files
+
+
+def output_file(args, filename):
+    """returns the output file for an input file: same name (plus -odix) in -odir, .las extension"""
+    odir = args.get('-odir', os.path.dirname(filename))
+    name = os.path.splitext(os.path.basename(filename))[0] + args.get('-odix', '')
+    return os.path.join(odir, name + '.las')
+
+
+def log(tool, message):
+    sys.stderr.write('%s: %s\n' % (tool, message))
+    sys.stderr.flush()
+
+
+def set_class(points, fmt, cls):
+    """returns the classification field values for class codes cls, keeping the flag bits of formats 0 - 5"""
+    if fmt < 6:
+        return (points['classification'] & 0xE0) | cls
+    return cls
+
+
+def grid(x, y, cell):
+    """returns column and row index of points in a grid of cell size over their bounding box, and the grid shape"""
+    i = ((x - x.min()) / cell).astype(np.int64)
+    j = ((y - y.min()) / cell).astype(np.int64)
+    return i, j, (j.max() + 1, i.max() + 1)
+
+
+def fill_nearest(values, valid):
+    """fills invalid cells of a raster with the value of the nearest valid cell"""
+    if valid.all() or not valid.any():
+        return values
+    index = ndimage.distance_transform_edt(~valid, return_distances=False, return_indices=True)
+    return values[tuple(index)]
+
+
+def lasinfo(args, filename):
+    h = read_header(filename)
+    if '-set_classification' in args:
+        cls = int(args['-set_classification'])
+        points = np.memmap(filename, dtype=point_dtype(h.point_format, h.record_length), mode='r+',
+                           offset=h.offset_to_points, shape=(h.point_count,))
+        points['classification'] = set_class(points, h.point_format, cls)
+        points.flush()
+        del points
+    log('lasinfo', '%s: version %i.%i, point format %i, %i points, min %s, max %s' % (
+        os.path.basename(filename), h.version[0], h.version[1], h.point_format, h.point_count, h.mins, h.maxs))
+
+
+def lasground_new(args, filename):
+    # ground surface: morphological opening of the lowest point per cell with a window of the step size
+    reader = LasReader(filename)
+    h, points = reader.header, reader.points
+    x, y, z = reader.xyz()
+    cell = 0.5 if '-hyper_fine' in args or '-extra_fine' in args else 1.0
+    step = float(args.get('-step') or 5)
+    i, j, shape = grid(x, y, cell)
+    lowest = np.full(shape, np.inf)
+    np.minimum.at(lowest, (j, i), z)
+    surface = fill_nearest(lowest, np.isfinite(lowest))
+    size = max(3, int(2 * step / cell) + 1)
+    surface = ndimage.grey_opening(surface, size=(size, size))
+    dz = z - surface[j, i]
+    offset = float(args.get('-offset') or 0.05)
+    bulge = float(args.get('-bulge') or step / 10)
+    down_spike = float(args.get('-down_spike') or 1)
+    ground = (dz <= offset + bulge) & (dz >= -down_spike)
+
+    out = np.array(points)
+    out['classification'] = set_class(out, h.point_format, np.where(ground, 2, 1))
+    with reader.writer(output_file(args, filename)) as writer:
+        writer.write(out)
+    return int(ground.sum())
+
+
+def lasheight(args, filename):
+    # height above the mean elevation of the ground points per 1 m cell, stored in decimeters as user data
+    reader = LasReader(filename)
+    h, points = reader.header, reader.points
+    x, y, z = reader.xyz()
+    i, j, shape = grid(x, y, 1.0)
+    ground = reader.classification() == 2
+    total = np.zeros(shape)
+    count = np.zeros(shape)
+    np.add.at(total, (j[ground], i[ground]), z[ground])
+    np.add.at(count, (j[ground], i[ground]), 1)
+    surface = fill_nearest(np.where(count > 0, total / np.maximum(count, 1), 0), count > 0)
+    height = z - surface[j, i] if ground.any() else np.zeros(len(z))
+
+    out = np.array(points)
+    out['user_data'] = np.clip(np.round(height * 10), 0, 255)
+    with reader.writer(output_file(args, filename)) as writer:
+        writer.write(out)
+
+
+def lasclassify(args, filename):
+    # points more than 2 m above ground: building in flat 1 m cells, vegetation otherwise
+    reader = LasReader(filename)
+    h, points = reader.header, reader.points
+    x, y, z = reader.xyz()
+    cls = reader.classification()
+    candidates = (cls == 1) & (points['user_data'] >= 20)
+    out = np.array(points)
+    if candidates.any():
+        i, j, shape = grid(x[candidates], y[candidates], 1.0)
+        zc = z[candidates]
+        n = np.zeros(shape)
+        s = np.zeros(shape)
+        s2 = np.zeros(shape)
+        np.add.at(n, (j, i), 1)
+        np.add.at(s, (j, i), zc)
+        np.add.at(s2, (j, i), zc ** 2)
+        std = np.sqrt(np.maximum(s2 / np.maximum(n, 1) - (s / np.maximum(n, 1)) ** 2, 0))
+        flat = (n >= 3) & (std < 0.15)
+        new = np.where(flat[j, i], 6, 5)
+        out['classification'][candidates] = set_class(out[candidates], h.point_format, new)
+    with reader.writer(output_file(args, filename)) as writer:
+        writer.write(out)
+
+
+def lasclip(args, filename):
+    index = polygon_index(args['-poly'])
+    ofilename = output_file(args, filename)
+    if '-interior' in args:
+        clip_file(filename, index, outside=ofilename)
+    else:
+        clip_file(filename, index, inside=ofilename)
+
+
+def lasduplicate(args, filename):
+    ofilename = output_file(args, filename)
+    if '-lowest_z' in args:
+        remove_duplicates(filename, ofilename)
+        return
+    reader = LasReader(filename)
+    h, points = reader.header, reader.points
+    keys = np.array(points[['X', 'Y', 'Z']])
+    first = np.sort(np.unique(keys, return_index=True)[1])
+    with reader.writer(ofilename) as writer:
+        writer.write(np.array(points[first]))
+
+
+def las2las(args, filename):
+    reader = LasReader(filename)
+    h, points = reader.header, reader.points
+    cls = reader.classification()
+    keep = np.ones(len(points), dtype=bool)
+    for flag in ('-keep_class', '-keep_classification'):
+        if flag in args:
+            keep &= np.isin(cls, args[flag])
+    if '-drop_class' in args:
+        keep &= ~np.isin(cls, args['-drop_class'])
+    with reader.writer(output_file(args, filename)) as writer:
+        writer.write(np.array(points[keep]))
+
+
+def lastile(args, files, cores):
+    if '-remove_buffer' in args:
+        run_tasks(lambda f: remove_buffer(f, output_file(args, f)), [(f,) for f in files], cores)
+        return
+    odir = args.get('-odir', os.path.dirname(files[0]))
+    prefix = os.path.splitext(os.path.basename(args.get('-o', 'tile.las')))[0]
+    written = merge_tiles(files, odir, float(args['-tile_size']), files_are_flightlines='-faf' in args,
+                          prefix=prefix, workers=cores, buffer=float(args.get('-buffer', 0)))
+    log('lastile', 'wrote %i tiles' % len(written))
+
+
+TOOLS = {'lasinfo': lasinfo, 'lasground_new': lasground_new, 'lasheight': lasheight, 'lasclassify': lasclassify,
+         'lasclip': lasclip, 'lasduplicate': lasduplicate, 'las2las': las2las}
+
+
+def main(tool, argv):
+    """runs the stand-in of tool with the command line arguments argv, returns the exit code"""
+    args = parse(argv)
+    files = input_files(args)
+    cores = int(args.get('-cores', 1))
+    if not files:
+        log(tool, 'no input specified')
+        return 1
+    if '-odir' in args and not os.path.isdir(args['-odir']):
+        log(tool, 'output directory %s does not exist' % args['-odir'])
+        return 1
+
+    start = time.time()
+    try:
+        if tool == 'lastile':
+            lastile(args, files, cores)
+        else:
+            run_tasks(lambda f: TOOLS[tool](args, f), [(f,) for f in files], cores)
+    except Exception as e:
+        log(tool, 'ERROR: %s' % e)
+        return 1
+    log(tool, 'done with %i files. total time %.3f sec.' % (len(files), time.time() - start))
+    return 0
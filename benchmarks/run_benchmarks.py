@@ -0,0 +1,123 @@
+"""
+Throughput benchmarks of the LiDAR workflow on synthetic point clouds.
+
+For every point cloud size, a synthetic point cloud is generated once (see synthetic.py) and the full workflow runs on
+it from scratch, by default with the LAStools stand-ins of benchmarks/lastools. The end-to-end and per-stage throughput
+(points per second) is taken from the run profile of the workflow and written to benchmark_results.json in the work
+directory.
+
+Usage::
+
+    python run_benchmarks.py <work directory> --sizes 1e6 1e7 1e8 [--cores 8] [--poly] [--lastoolsdir DIR]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic
+import profiling
+import quarantine
+from LiDAR_processing_GUI import lidar_workflow, output_dirs
+
+
+logger = logging.getLogger(__name__)
+
+RESULTS_NAME = 'benchmark_results.json'
+
+STANDINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lastools', '')
+
+GROUND_PARAMS = {'coarse': (5, 1, 1, 1, 0.05), 'fine': (1, 0.5, 0.5, 0.5, 0.02)}
+
+
+def prepare(workdir, points, density, workers):
+    """returns the data directory with a synthetic point cloud (and ground polygon), generating it if needed"""
+    datadir = os.path.join(workdir, 'points_%i' % points, '')
+    if not os.path.isfile(datadir + 'generated'):
+        if os.path.isdir(datadir):
+            shutil.rmtree(datadir)
+        synthetic.generate(datadir, points, density, workers=workers, poly=True)
+        open(datadir + 'generated', 'w').close()
+    return datadir
+
+
+def clean(datadir):
+    """removes the outputs of earlier runs from a data directory"""
+    for name in output_dirs():
+        if os.path.isdir(datadir + name):
+            shutil.rmtree(datadir + name)
+    for name in (profiling.PROFILE_NAME, quarantine.QUARANTINE_NAME):
+        if os.path.isfile(datadir + name):
+            os.remove(datadir + name)
+
+
+def run(datadir, lastoolsdir, cores, poly, per_tile=False, retention='keep', height_engine='lasheight',
+        tiling='uniform', ground_engine='lasground_new', classify_engine='lasclassify'):
+    """runs the workflow on a data directory from scratch, returns the run profile"""
+    clean(datadir)
+    kwargs = {'%s_%s' % (setting, name): value for setting, values in GROUND_PARAMS.items()
+              for name, value in zip(('step', 'bulge', 'spike', 'down_spike', 'offset'), values)}
+    lidar_workflow(lastoolsdir, datadir, datadir + 'ground_area.shp' if poly else '', cores, '', True,
+                   per_tile=per_tile, retention=retention, height_engine=height_engine, tiling=tiling,
+                   ground_engine=ground_engine, classify_engine=classify_engine, **kwargs)
+    with open(datadir + profiling.PROFILE_NAME) as f:
+        return json.load(f)
+
+
+def summary(points, profile):
+    """returns the benchmark result of a run: end-to-end and per-stage throughput"""
+    return {'points': points,
+            'wall': profile['wall'],
+            'points_per_sec': points / profile['wall'] if profile['wall'] > 0 else 0,
+            'stages': {s['stage']: {'wall': s['wall'], 'cpu': s['user'] + s['system'],
+                                    'points_per_sec': s['points_per_sec'], 'max_rss_mb': s['max_rss_mb']}
+                       for s in profile['stages']}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the LiDAR workflow on synthetic point clouds.')
+    parser.add_argument('workdir', help='directory for the synthetic point clouds and the workflow outputs')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e6, 1e7], help='point cloud sizes')
+    parser.add_argument('--density', type=float, default=8.0, help='points per square meter')
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 1, help='cores of the workflow')
+    parser.add_argument('--poly', action='store_true', help='use a ground polygon (coarse and fine chains)')
+    parser.add_argument('--per-tile', action='store_true', help='run the classification chain tile by tile')
+    parser.add_argument('--retention', default='keep', help='retention of intermediate outputs')
+    parser.add_argument('--ground-engine', default='lasground_new', help='lasground_new or native ground filter')
+    parser.add_argument('--height-engine', default='lasheight', help='lasheight or native height above ground')
+    parser.add_argument('--classify-engine', default='lasclassify',
+                        help='lasclassify or eigen classification of vegetation and buildings')
+    parser.add_argument('--tiling', default='uniform', help='uniform or adaptive tiling of the original points')
+    parser.add_argument('--lastoolsdir', default=STANDINS, help='LAStools bin directory (default: the stand-ins)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    results = []
+    for size in args.sizes:
+        points = int(size)
+        datadir = prepare(args.workdir, points, args.density, args.cores)
+        logger.info('Running the workflow on %i points...' % points)
+        start = time.time()
+        result = summary(points, run(datadir, os.path.join(args.lastoolsdir, ''), args.cores, args.poly,
+                                     args.per_tile, args.retention, args.height_engine, args.tiling,
+                                     args.ground_engine, args.classify_engine))
+        logger.info('%i points in %.1f s (%.0f points/s)' % (points, time.time() - start, result['points_per_sec']))
+        results.append(result)
+
+    report = {'finished': time.strftime('%Y-%m-%d %H:%M:%S'), 'cores': args.cores, 'density': args.density,
+              'poly': args.poly, 'per_tile': args.per_tile, 'ground_engine': args.ground_engine,
+              'height_engine': args.height_engine, 'classify_engine': args.classify_engine, 'tiling': args.tiling,
+              'lastoolsdir': args.lastoolsdir, 'results': results}
+    with open(os.path.join(args.workdir, RESULTS_NAME), 'w') as f:
+        json.dump(report, f, indent=1)
+    for r in results:
+        print('%12i points  %8.1f s  %10.0f points/s' % (r['points'], r['wall'], r['points_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
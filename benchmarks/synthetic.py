@@ -0,0 +1,207 @@
+"""
+Synthetic LiDAR point clouds for benchmarks.
+
+The scene is a gently undulating terrain with trees and flat-roofed buildings. Trees and buildings are placed per
+50 m cell from a seeded random generator, so the scene is continuous across files and reproducible. Points are
+uniformly distributed over the extent and written file by file in chunks, so point clouds of hundreds of millions of
+points can be generated with little memory. Points are classified like a delivered survey (ground 2, vegetation 5,
+building 6, a few unclassified 1).
+
+Usage::
+
+    python synthetic.py <output directory> --points 10000000 --density 8 [--file-size 500] [--poly]
+"""
+
+import os
+import sys
+import struct
+import argparse
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from las_io import create_las, LasWriter, point_dtype
+from pipeline import run_tasks
+
+
+logger = logging.getLogger(__name__)
+
+# size of the cells trees and buildings are placed in
+FEATURE_CELL = 50.0
+
+
+def terrain(x, y):
+    """returns the terrain elevation at x, y (coordinates relative to the scene origin)"""
+    return 100 + 0.02 * x + 0.01 * y + 8 * np.sin(x / 180.0) * np.cos(y / 230.0) + 2 * np.sin(x / 37.0 + y / 53.0)
+
+
+def features(x0, y0, x1, y1, seed=0):
+    """
+    Returns the buildings and trees of the scene within a box
+
+    Returns (buildings, trees): buildings as array of rows (min x, min y, max x, max y, height), trees as array of
+    rows (x, y, crown radius, height).
+    """
+    buildings = []
+    trees = []
+    for i in range(int(np.floor(x0 / FEATURE_CELL)) - 1, int(np.floor(x1 / FEATURE_CELL)) + 1):
+        for j in range(int(np.floor(y0 / FEATURE_CELL)) - 1, int(np.floor(y1 / FEATURE_CELL)) + 1):
+            rng = np.random.default_rng([seed, i & 0xFFFFFFFF, j & 0xFFFFFFFF])
+            cx, cy = i * FEATURE_CELL, j * FEATURE_CELL
+            if rng.random() < 0.25:
+                w, d = rng.uniform(10, 25, 2)
+                bx, by = cx + rng.uniform(0, FEATURE_CELL - w), cy + rng.uniform(0, FEATURE_CELL - d)
+                buildings.append((bx, by, bx + w, by + d, rng.uniform(5, 12)))
+            n = rng.poisson(6)
+            trees += list(zip(cx + rng.uniform(0, FEATURE_CELL, n), cy + rng.uniform(0, FEATURE_CELL, n),
+                              rng.uniform(2, 6, n), rng.uniform(8, 25, n)))
+    return np.array(buildings).reshape(-1, 5), np.array(trees).reshape(-1, 4)
+
+
+def scene_points(x, y, buildings, trees, rng):
+    """returns z, classification and return bits (return number, number of returns) of points at x, y"""
+    n = len(x)
+    ground = terrain(x, y)
+    z = ground + rng.normal(0, 0.03, n)
+    cls = np.full(n, 2, dtype=np.uint8)
+    returns = np.full(n, 1 | 1 << 3, dtype=np.uint8)
+
+    if len(trees):
+        distance, nearest = cKDTree(trees[:, :2]).query(np.c_[x, y])
+        radius, height = trees[nearest, 2], trees[nearest, 3]
+        crown = distance < radius
+        # most pulses hit the crown, the rest reaches the ground as last return
+        canopy = crown & (rng.random(n) < 0.7)
+        depth = rng.random(n) * 0.3 + 0.4 * (distance / radius) ** 2
+        z[canopy] = ground[canopy] + height[canopy] * (1 - depth[canopy])
+        cls[canopy] = 5
+        returns[canopy] = 1 | 2 << 3
+        returns[crown & ~canopy] = 2 | 2 << 3
+
+    for bx0, by0, bx1, by1, h in buildings:
+        roof = (x >= bx0) & (x < bx1) & (y >= by0) & (y < by1)
+        if roof.any():
+            z[roof] = terrain((bx0 + bx1) / 2, (by0 + by1) / 2) + h + rng.normal(0, 0.02, roof.sum())
+            cls[roof] = 6
+            returns[roof] = 1 | 1 << 3
+
+    # a few points the provider left unclassified
+    cls[rng.random(n) < 0.02] = 1
+    return z, cls, returns
+
+
+def write_file(filename, box, points, origin, seed=0, chunk_points=2 ** 21):
+    """
+    Writes a .las file (point format 1) with the given number of points of the scene within box
+
+    Args:
+        filename (str): .las file
+        box (tuple): (min x, min y, max x, max y) relative to the scene origin
+        points (int): number of points
+        origin (tuple): x, y of the scene origin (added to all coordinates)
+    """
+    x0, y0, x1, y1 = box
+    buildings, trees = features(x0, y0, x1, y1, seed)
+    header = create_las(filename, 1, scale=(0.01, 0.01, 0.01), offset=(origin[0], origin[1], 0.0),
+                        system_id='synthetic')
+    dtype = point_dtype(1)
+    rng = np.random.default_rng([seed, int(x0), int(y0)])
+    with LasWriter(filename, header) as writer:
+        for start in range(0, points, chunk_points):
+            n = min(chunk_points, points - start)
+            x = rng.uniform(x0, x1, n)
+            y = rng.uniform(y0, y1, n)
+            z, cls, returns = scene_points(x, y, buildings, trees, rng)
+            chunk = np.zeros(n, dtype=dtype)
+            chunk['X'] = np.round(x / 0.01)
+            chunk['Y'] = np.round(y / 0.01)
+            chunk['Z'] = np.round(z / 0.01)
+            chunk['intensity'] = rng.integers(0, 1000, n)
+            chunk['return_bits'] = returns
+            chunk['classification'] = cls
+            chunk['gps_time'] = start + np.arange(n) * 1e-5
+            writer.write(chunk)
+    return filename
+
+
+def write_polygon(filename, rings):
+    """writes a polygon shapefile (.shp and .shx) with one shape made of rings (lists of (x, y))"""
+    rings = [np.asarray(r, dtype='<f8') for r in rings]
+    points = np.vstack(rings)
+    parts = np.cumsum([0] + [len(r) for r in rings[:-1]])
+    box = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+    content = struct.pack('<i4d2i', 5, *box + (len(rings), len(points)))
+    content += struct.pack('<%ii' % len(rings), *parts) + points.tobytes()
+    record = struct.pack('>2i', 1, len(content) // 2) + content
+
+    def header(length):
+        return struct.pack('>7i', 9994, 0, 0, 0, 0, 0, length // 2) + struct.pack('<2i', 1000, 5) + \
+            struct.pack('<8d', *box + (0, 0, 0, 0))
+
+    base = os.path.splitext(filename)[0]
+    with open(base + '.shp', 'wb') as f:
+        f.write(header(100 + len(record)) + record)
+    with open(base + '.shx', 'wb') as f:
+        f.write(header(108) + struct.pack('>2i', 50, len(content) // 2))
+
+
+def generate(odir, points, density=8.0, file_size=500.0, origin=(500000.0, 4000000.0), seed=0, workers=1,
+             poly=False):
+    """
+    Writes a synthetic point cloud of about the given number of points to odir, as square files of file_size
+
+    Args:
+        odir (str): output directory
+        points (int): total number of points
+        density (float): points per square meter
+        file_size (float): edge length of the files
+        origin (tuple): x, y of the lower left corner of the scene
+        seed (int): seed of the random scene
+        workers (int): number of files written in parallel
+        poly (bool): also write ground_area.shp, a polygon (with a hole) over part of the scene
+
+    Returns list of written files.
+    """
+    side = np.sqrt(points / float(density))
+    n = max(1, int(np.ceil(side / file_size)))
+    size = side / n
+    tasks = []
+    for i in range(n):
+        for j in range(n):
+            box = (i * size, j * size, (i + 1) * size, (j + 1) * size)
+            filename = os.path.join(odir, 'synthetic_%i_%i.las' % (i, j))
+            tasks.append((filename, box, int(points // (n * n)), origin, seed))
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+    logger.info('Writing %i files with %i points each...' % (len(tasks), points // (n * n)))
+    files = run_tasks(write_file, tasks, workers)
+
+    if poly:
+        # a ground area over the middle of the scene, with a hole
+        c = side / 2
+        outer = [(origin[0] + c + c * 0.6 * np.cos(a), origin[1] + c + c * 0.6 * np.sin(a))
+                 for a in np.linspace(2 * np.pi, 0, 200)]
+        hole = [(origin[0] + c + c * 0.1 * np.cos(a), origin[1] + c + c * 0.1 * np.sin(a))
+                for a in np.linspace(0, 2 * np.pi, 50)]
+        write_polygon(os.path.join(odir, 'ground_area.shp'), [outer, hole])
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Writes a synthetic LiDAR point cloud.')
+    parser.add_argument('odir', help='output directory')
+    parser.add_argument('--points', type=float, default=1e6, help='total number of points')
+    parser.add_argument('--density', type=float, default=8.0, help='points per square meter')
+    parser.add_argument('--file-size', type=float, default=500.0, help='edge length of the files')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random scene')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='files written in parallel')
+    parser.add_argument('--poly', action='store_true', help='also write a ground area polygon')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    generate(args.odir, int(args.points), args.density, args.file_size, seed=args.seed, workers=args.workers,
+             poly=args.poly)
+
+
+if __name__ == '__main__':
+    main()
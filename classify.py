@@ -0,0 +1,165 @@
+"""
+Native classification of vegetation and buildings, as an alternative to lasheight followed by lasclassify.
+
+Both steps run in one pass over a tile, without writing the heights to an intermediate directory. The height above
+ground of every point is measured from the ground points (see height.py) and stored in the user data field like
+lasheight does. Unclassified points more than ground_offset above the ground are candidates for vegetation and
+buildings. The candidates are thinned to the mean point per voxel, so that neighbourhoods cover about the same space
+at any point density. For every voxel, its neighbourhood of the nearest voxels is found with a k-d tree, and the
+eigenvalues of the covariance matrix of every neighbourhood are computed in batches. The smallest eigenvalue is the
+variance of the distances from the plane fitted through the neighbourhood: the neighbourhoods of roof points are
+planar (root mean square distance up to planar), those of points in tree crowns rugged (more than rugged) or, where
+dense crowns fill the voxels around a point, scattered in all directions (the smallest eigenvalue is more than scatter
+of their sum). Every voxel then takes the label most of its neighbours have (building 6, high vegetation 5), which
+also labels voxels between planar and rugged, and passes it on to its points. Voxels whose neighbours are neither stay
+unclassified.
+
+Like for lasclassify, ground_offset, planar and rugged are in meters, and converted to the units of the data if the
+elevations are in feet ('-elevation_feet').
+"""
+
+import os
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+from pipeline import run_tasks
+from las_io import LasReader, set_classification
+from height import ground_heights, user_data
+from ground import FOOT
+
+
+logger = logging.getLogger(__name__)
+
+UNCLASSIFIED = 1
+GROUND = 2
+VEGETATION = 5
+BUILDING = 6
+
+# defaults of the thresholds (meters) and the neighbourhood size
+GROUND_OFFSET = 2.0
+PLANAR = 0.1
+RUGGED = 0.4
+# smallest share of the smallest eigenvalue in the sum of the eigenvalues of the neighbourhood of a vegetation point
+SCATTER = 0.02
+NEIGHBOURS = 10
+
+# edge length (meters) of the voxels the neighbourhoods are formed of
+VOXEL = 0.5
+
+# neighbourhoods per batch of the eigenvalue computation
+BATCH = 2 ** 16
+
+
+def eigenvalues(xyz, neighbours, batch=BATCH):
+    """
+    Returns the eigenvalues (ascending) of the covariance matrix of the neighbourhood of every point
+
+    Args:
+        xyz (array): coordinates of the points (n x 3)
+        neighbours (array): indices of the k points of every neighbourhood (m x k)
+        batch (int): neighbourhoods computed at once
+    """
+    values = np.empty((len(neighbours), 3))
+    for start in range(0, len(neighbours), batch):
+        points = xyz[neighbours[start:start + batch]]
+        points = points - points.mean(axis=1, keepdims=True)
+        covariance = np.einsum('nki,nkj->nij', points, points) / points.shape[1]
+        values[start:start + batch] = np.linalg.eigvalsh(covariance)
+    # rounding leaves tiny negative values for perfectly planar neighbourhoods
+    return np.maximum(values, 0)
+
+
+def voxel_means(xyz, voxel):
+    """returns the mean of the points in every occupied voxel (cube of edge voxel) and the voxel of every point"""
+    keys = np.floor((xyz - xyz.min(axis=0)) / voxel).astype(np.int64)
+    keys = (keys[:, 0] << 42) | (keys[:, 1] << 21) | keys[:, 2]
+    _, inverse = np.unique(keys, return_inverse=True)
+    count = np.bincount(inverse)
+    means = np.c_[[np.bincount(inverse, xyz[:, d]) / count for d in range(3)]].T
+    return means, inverse
+
+
+def label_objects(xyz, planar=PLANAR, rugged=RUGGED, scatter=SCATTER, neighbours=NEIGHBOURS, voxel=VOXEL):
+    """
+    Returns the class code (BUILDING, VEGETATION or UNCLASSIFIED) of candidate points
+
+    The neighbourhoods are formed from the means of the candidates per voxel, so that they cover about the same space
+    whatever the point density. Every point takes the class of its voxel.
+
+    Args:
+        xyz (array): coordinates of the candidates (n x 3), in the units of the data
+        planar (float): largest rms distance from the plane of the neighbourhood of a roof point
+        rugged (float): smallest rms distance from the plane of the neighbourhood of a vegetation point
+        scatter (float): smallest share of the smallest eigenvalue in all eigenvalues of the neighbourhood of a
+            vegetation point (whatever its rms distance)
+        neighbours (int): number of voxels of a neighbourhood (including the voxel itself)
+        voxel (float): voxel edge length
+    """
+    codes = np.full(len(xyz), UNCLASSIFIED, dtype=np.uint8)
+    if len(xyz) == 0:
+        return codes
+    centers, inverse = voxel_means(xyz, voxel)
+    if len(centers) < 3:
+        return codes
+    k = min(neighbours, len(centers))
+    neighbourhood = cKDTree(centers).query(centers, k)[1]
+    values = eigenvalues(centers, neighbourhood)
+    rms = np.sqrt(values[:, 0])
+    variation = values[:, 0] / np.maximum(values.sum(axis=1), 1e-12)
+    votes = np.where(rms <= planar, 1, np.where((rms > rugged) | (variation > scatter), -1, 0))
+    score = votes[neighbourhood].sum(axis=1)
+    labels = np.where(score > 0, BUILDING, np.where(score < 0, VEGETATION, UNCLASSIFIED)).astype(np.uint8)
+    return labels[inverse]
+
+
+def classify_objects(filename, ofilename, surface='grid', ground_offset=GROUND_OFFSET, planar=PLANAR, rugged=RUGGED,
+                     scatter=SCATTER, neighbours=NEIGHBOURS, units_code=''):
+    """
+    Writes a copy of a .las file with its heights above ground (in the user data field) and its vegetation and
+    buildings classified
+
+    Args:
+        filename (str): .las file with classified ground points (class 2), e.g. a tile with buffer
+        ofilename (str): .las file to write
+        surface (str): ground surface to measure heights from ('grid' or the slower 'tin', see height.py)
+        ground_offset (float): unclassified points higher above the ground are classified (meters)
+        planar (float): largest rms distance from the plane of the neighbourhood of a roof point (meters)
+        rugged (float): smallest rms distance from the plane of the neighbourhood of a vegetation point (meters)
+        scatter (float): smallest share of the smallest eigenvalue of the neighbourhood of a vegetation point
+        neighbours (int): number of voxels of a neighbourhood
+        units_code (str): '-feet -elevation_feet' if the coordinates are in feet
+
+    Returns the number of building and vegetation points.
+    """
+    vertical = 1 / FOOT if '-elevation_feet' in units_code.split() else 1.0
+    reader = LasReader(filename)
+    out = np.array(reader.points)
+    codes = reader.classification()
+    if len(out):
+        x, y, z = reader.xyz()
+        # coordinates relative to the lower left corner keep the precision of the triangulation
+        x, y = x - reader.header.mins[0], y - reader.header.mins[1]
+        height = ground_heights(x, y, z, codes == GROUND, surface)
+        out['user_data'] = user_data(height)
+        candidates = (codes == UNCLASSIFIED) & (height >= ground_offset * vertical)
+        codes = codes.copy()
+        voxel = VOXEL / FOOT if '-feet' in units_code.split() else VOXEL
+        codes[candidates] = label_objects(np.c_[x, y, z][candidates], planar * vertical, rugged * vertical, scatter,
+                                          neighbours, voxel)
+        set_classification(out, reader.point_format, codes)
+    with reader.writer(ofilename) as writer:
+        writer.write(out)
+    return int(np.isin(codes, (BUILDING, VEGETATION)).sum())
+
+
+def classify_tiles(files, odir, workers=1, surface='grid', ground_offset=GROUND_OFFSET, planar=PLANAR, rugged=RUGGED,
+                   scatter=SCATTER, neighbours=NEIGHBOURS, units_code=''):
+    """
+    Runs classify_objects on files, writing files with the same basenames to odir
+
+    The files are processed by a pool of worker processes (see pipeline.run_tasks). Returns the numbers of building
+    and vegetation points.
+    """
+    tasks = [(f, os.path.join(odir, os.path.basename(f)), surface, ground_offset, planar, rugged, scatter, neighbours,
+              units_code) for f in files]
+    return run_tasks(classify_objects, tasks, workers, processes=True)
@@ -8,6 +8,19 @@ from tkinter import messagebox
 from tkinter import filedialog
 import subprocess
 import logging
+import sys
+import shutil
+import threading
+import shlex
+import socket
+import tempfile
+import contextlib
+import signal
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import profiling
+import resources
 
 
 logger = logging.getLogger(__name__)
@@ -22,25 +35,347 @@ def init_logger(filename):
     return
 
 
-def cmd(command):
-    """Executes command prompt command"""
+# number of commands started by run_commands that are running in this process (in any thread)
+_running = [0]
+_running_lock = threading.Lock()
+
+# seconds between memory checks of commands held back by memory pressure
+MEMORY_POLL = 0.5
+
+
+# bytes read from the output of a command at a time, and longest output line logged as one line (longer lines are
+# logged in pieces, so the pipe is always drained)
+READ_SIZE = 2 ** 16
+MAX_LINE = 2 ** 16
+
+# output lines of LAStools that are not worth logging (licensing message of unlicensed LAStools)
+LASTOOLS_BANNER = ('Please note that LAStools is not "free"',
+                   "contact 'martin.isenburg@rapidlasso.com' to clarify licensing terms")
+
+
+async def run_command(command, timeout=None, semaphore=None, executor=None):
+    """
+    Runs a command line, streaming its stdout and stderr line by line to the logger
+
+    Wall time, CPU time, peak memory and block I/O of the command are recorded for the current stage (see
+    profiling.py). CPU time and memory are only available on POSIX systems.
+
+    Args:
+        command (str): command line
+        timeout (float): seconds after which the command is killed and an exception is raised (None: no limit)
+        semaphore (asyncio.Semaphore): limits the number of concurrently running commands
+        executor (concurrent.futures.Executor): threads waiting for the commands to exit (POSIX), one per concurrently
+            running command. Without an executor, the command gets a thread of its own
+
+    Returns the exit code of the command.
+    """
+    if semaphore is not None:
+        async with semaphore:
+            return await run_command(command, timeout, executor=executor)
+
+    if executor is None and os.name != 'nt':
+        # the thread is done once the command was reaped, which run_command always waits for
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return await run_command(command, timeout, executor=executor)
+
+    def log(line):
+        line = line.decode(errors='replace').rstrip()
+        if line and not line.startswith(LASTOOLS_BANNER):
+            logger.info(line)
+
+    async def pump(stream):
+        # reads in chunks rather than lines, so an overlong line cannot stop the reading and block the command on a
+        # full pipe
+        pending = b''
+        while True:
+            chunk = await stream.read(READ_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            if len(pending) > MAX_LINE:
+                lines.append(pending)
+                pending = b''
+            for line in lines:
+                log(line)
+        log(pending)
+
+    loop = asyncio.get_running_loop()
+    start = time.time()
     try:
-        res = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except:
+        if os.name == 'nt':
+            process = await asyncio.create_subprocess_shell(
+                command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            streams = [process.stdout, process.stderr]
+            waiter = asyncio.ensure_future(process.wait())
+        else:
+            # the child is reaped with os.wait4 (instead of by asyncio) to get its resource usage. Its peak memory is at
+            # least the memory of this process when it was forked
+            parent_memory = resources.current_memory()
+            process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            streams = []
+            for pipe in (process.stdout, process.stderr):
+                reader = asyncio.StreamReader()
+                await loop.connect_read_pipe(lambda reader=reader: asyncio.StreamReaderProtocol(reader), pipe)
+                streams.append(reader)
+            # a dedicated thread per running command: waits must not queue behind the default executor of the loop
+            waiter = loop.run_in_executor(executor, os.wait4, process.pid, 0)
+    except OSError:
         msg = 'Command failed: %s' % command
         logger.error(msg)
         raise Exception(msg)
 
-    msg = res.communicate()[1]
-    # if using for LAStools, get rid of the annoying LAStools licensing message.
-    msg = msg.replace(
-        'Please note that LAStools is not "free" (see http://lastools.org/LICENSE.txt)\r\ncontact \'martin.isenburg@rapidlasso.com\' to clarify licensing terms if needed.\r\n',
-        '')
-    logger.info(msg)
+    pumps = asyncio.gather(*[pump(stream) for stream in streams])
+    done, pending = await asyncio.wait([waiter, pumps], timeout=timeout)
+    timed_out = waiter not in done
+    if timed_out:
+        if os.name == 'nt':
+            process.kill()
+        else:
+            # not Popen.kill, which may reap the child before os.wait4 does
+            os.kill(process.pid, signal.SIGKILL)
+        await waiter
+    if pumps not in done:
+        pumps.cancel()
+
+    record = {'command': command, 'wall': time.time() - start}
+    if os.name == 'nt':
+        code = process.returncode
+    else:
+        pid, status, usage = waiter.result()
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        process.returncode = code
+        record.update({'user': usage.ru_utime, 'system': usage.ru_stime,
+                       # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+                       'max_rss_mb': usage.ru_maxrss / (2.0 ** 20 if sys.platform == 'darwin' else 2.0 ** 10),
+                       'blocks_read': usage.ru_inblock, 'blocks_written': usage.ru_oublock})
+        if parent_memory:
+            record['parent_rss_mb'] = parent_memory / 2.0 ** 20
+    record['exit_code'] = code
+    record['points'] = resources.command_points(command)
+    profiling.record_command(record)
+
+    if timed_out:
+        msg = 'Command timed out after %s s: %s' % (timeout, command)
+        logger.error(msg)
+        raise Exception(msg)
+    if code != 0:
+        logger.warning('Command exited with code %i: %s' % (code, command))
+    return code
+
 
+def run_commands(commands, concurrency=1, timeout=None, memory=0):
+    """
+    Runs command lines concurrently, at most concurrency at a time, and returns their exit codes
+
+    The output of every command is logged line by line as it arrives (see run_command). Raises the first exception
+    (e.g. a timeout) after all commands finished.
+
+    Commands back off under memory pressure: while other commands (of this or any other call in the process) are
+    running, a command only starts once the machine has memory (estimated peak memory of the command in bytes)
+    available on top of the reserve of resources.memory_pressure.
+    """
+    async def run(command, semaphore):
+        async with semaphore:
+            waited = False
+            while True:
+                with _running_lock:
+                    if not _running[0] or not resources.memory_pressure(memory):
+                        _running[0] += 1
+                        break
+                if not waited:
+                    logger.info('Low on memory, waiting for running commands to finish...')
+                    waited = True
+                await asyncio.sleep(MEMORY_POLL)
+            try:
+                return await run_command(command, timeout, executor=executor)
+            finally:
+                with _running_lock:
+                    _running[0] -= 1
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        results = await asyncio.gather(*[run(c, semaphore) for c in commands], return_exceptions=True)
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+        return results
+
+    if not commands:
+        return []
+    # one thread per running command waits for it to exit (see run_command)
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(commands)))) as executor:
+        return asyncio.run(run_all())
+
+
+def cmd(command, timeout=None):
+    """Executes command prompt command"""
+    run_commands([command], timeout=timeout)
     return
 
 
+# scratch area of the runs (file lists etc.) and lock file of a running project, both in the project directory
+SCRATCH_NAME = '.scratch'
+LOCK_NAME = '.run.lock'
+
+
+@contextlib.contextmanager
+def run_lock(directory):
+    """
+    Holds a lock on a project directory while it is processed, raises an exception if another run holds it
+
+    The lock is an open lock file in directory: locked with fcntl.flock on POSIX systems, on Windows an open file cannot
+    be deleted. Locks of crashed runs are released by the operating system.
+    """
+    path = os.path.join(directory, LOCK_NAME)
+    try:
+        if os.name == 'nt':
+            if os.path.exists(path):
+                # fails while another run holds the file open
+                os.remove(path)
+            f = open(path, 'x')
+        else:
+            import fcntl
+            f = open(path, 'a+')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                raise
+    except OSError:
+        msg = '%s is being processed by another run (lock file %s)' % (directory, path)
+        logger.error(msg)
+        raise Exception(msg)
+
+    try:
+        f.seek(0)
+        f.truncate()
+        f.write('pid %i on %s since %s\n' % (os.getpid(), socket.gethostname(), time.strftime('%Y-%m-%d %H:%M:%S')))
+        f.flush()
+        yield path
+    finally:
+        f.close()
+        if os.name == 'nt':
+            # on POSIX systems, the file stays: another run may already wait for a lock on it
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+@contextlib.contextmanager
+def scratch_dir(directory):
+    """
+    Creates a scratch directory for temporary files of a run in directory/.scratch and deletes it when done
+
+    Scratch directories left behind by earlier runs that crashed are deleted as well, so only use it while holding the
+    run_lock of directory. Yields the path of the scratch directory (with trailing separator).
+    """
+    base = os.path.join(directory, SCRATCH_NAME)
+    if os.path.isdir(base):
+        shutil.rmtree(base, ignore_errors=True)
+    os.makedirs(base, exist_ok=True)
+    path = tempfile.mkdtemp(prefix='run_', dir=base)
+    try:
+        yield path + os.sep
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def clone_file(src, dst):
+    """Creates dst as a copy-on-write clone (reflink) of src, returns False if the filesystem does not support it"""
+    try:
+        if sys.platform.startswith('linux'):
+            import fcntl
+            FICLONE = 0x40049409
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        if sys.platform == 'darwin':
+            import ctypes
+            libc = ctypes.CDLL('libc.dylib', use_errno=True)
+            if libc.clonefile(src.encode(), dst.encode(), 0) == 0:
+                return True
+    except (OSError, IOError, AttributeError):
+        pass
+    if os.path.exists(dst):
+        os.remove(dst)
+    return False
+
+
+def stage_files(files, odir, hardlink=True, workers=4, chunk_size=64 * 2 ** 20):
+    """
+    Makes the files available in odir without copying them where possible
+
+    Every file is cloned (copy-on-write reflink) if the filesystem supports it, otherwise hardlinked (if hardlink is
+    True and src and odir are on the same volume), otherwise copied in chunks of chunk_size by a pool of workers.
+    Progress of the copies is logged. Clones are only made on Linux (e.g. Btrfs, XFS) and macOS (APFS): there is no
+    copy-on-write path on Windows, so files on ReFS volumes are hardlinked or copied.
+
+    Args:
+        files (list): files to stage
+        odir (str): directory to stage the files in
+        hardlink (bool): allow hardlinks. Hardlinked files share their content with the original, so they must not be
+            modified in place.
+        workers (int): number of threads copying chunks in parallel
+        chunk_size (int): bytes per copied chunk
+
+    Returns dict with the number of files staged by 'clone', 'hardlink' and 'copy'.
+    """
+    staged = {'clone': 0, 'hardlink': 0, 'copy': 0}
+    chunks = []
+    for src in files:
+        dst = os.path.join(odir, os.path.basename(src))
+        if os.path.exists(dst):
+            if os.path.samefile(src, dst) and hardlink:
+                continue
+            os.remove(dst)
+        if clone_file(src, dst):
+            staged['clone'] += 1
+            continue
+        if hardlink:
+            try:
+                os.link(src, dst)
+                staged['hardlink'] += 1
+                continue
+            except (OSError, AttributeError):
+                pass
+        # copy: allocate the file, then copy its chunks in parallel
+        size = os.path.getsize(src)
+        with open(dst, 'wb') as f:
+            f.truncate(size)
+        chunks += [(src, dst, start, min(chunk_size, size - start)) for start in range(0, size, chunk_size)]
+        staged['copy'] += 1
+
+    if chunks:
+        total = sum(c[3] for c in chunks)
+        progress = {'done': 0, 'logged': 0}
+        lock = threading.Lock()
+
+        def copy_chunk(src, dst, start, length):
+            with open(src, 'rb') as fsrc, open(dst, 'r+b') as fdst:
+                fsrc.seek(start)
+                fdst.seek(start)
+                fdst.write(fsrc.read(length))
+            with lock:
+                progress['done'] += length
+                percent = 100 * progress['done'] // total
+                if percent >= progress['logged'] + 10 or progress['done'] == total:
+                    progress['logged'] = percent
+                    logger.info('Copied %i%% (%.1f of %.1f MB)' % (percent, progress['done'] / 2 ** 20,
+                                                                 total / 2 ** 20))
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(lambda c: copy_chunk(*c), chunks))
+        # keep the modification times of the originals
+        for src in set(c[0] for c in chunks):
+            shutil.copystat(src, os.path.join(odir, os.path.basename(src)))
+
+    logger.info('Staged %i files in %s (%i cloned, %i hardlinked, %i copied)' % (
+        sum(staged.values()), odir, staged['clone'], staged['hardlink'], staged['copy']))
+    return staged
+
+
 # opens window in GUI to browse for folder or file
 def browse(root, entry, select='file', ftypes=[('All files', '*')]):
     """GUI button command: opens browser window and adds selected file/folder to entry"""
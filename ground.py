@@ -0,0 +1,164 @@
+"""
+Native ground classification of .las files, as an alternative to lasground_new.
+
+The ground is found with a progressive morphological filter (Zhang et al., 2003) on a grid of the lowest point per
+cell: the grid is opened (eroded, then dilated) with windows growing up to the step size, and cells that stick out of
+the opened surface by more than the elevation threshold of the window are objects, not ground. The threshold grows
+with the window by the slope the ground may have. The parameters mirror those of lasground_new:
+
+- step: the largest window, i.e. the size of the largest objects (buildings) to remove
+- bulge: how much the ground may rise within step (the slope of the threshold is bulge / step, at most bulge)
+- spike: ground cells more than spike above the ground around them are removed (up spikes)
+- down_spike: lowest points more than down_spike below the ground around them are noise, not ground (down spikes)
+- offset: points up to offset above the ground surface are ground, too
+
+Like for lasground_new, the parameters are in meters, and converted to the units of the data if they are in feet
+('-feet', '-elevation_feet'). The ground surface is interpolated bilinearly from the ground cells; points up to offset
+(plus the rise of the surface over one cell and the scatter of the ground returns) above it and no more than
+down_spike below it get class 2, all other points class 1. Tiles of any number of points can be classified, the memory
+needed grows with the points of a tile.
+"""
+
+import os
+import logging
+import numpy as np
+from scipy import ndimage
+from pipeline import run_tasks
+from las_io import LasReader, set_classification
+
+
+logger = logging.getLogger(__name__)
+
+GROUND = 2
+UNCLASSIFIED = 1
+
+FOOT = 0.3048
+
+# points per grid cell on average: enough for the lowest point of a cell under vegetation to be a ground point
+POINTS_PER_CELL = 4.0
+
+# width of the band of ground points above the lowest points, in spreads of the ground returns
+NOISE_SPREADS = 3.0
+
+
+def lowest_grid(x, y, z, cell):
+    """
+    Returns the grid of the lowest z per cell (nan in empty cells) and the column and row index of every point
+
+    Args:
+        x, y, z (array): coordinates of the points, x and y relative to the lower left corner of the grid
+        cell (float): cell size
+    """
+    i = (x // cell).astype(np.int64)
+    j = (y // cell).astype(np.int64)
+    shape = (j.max() + 1, i.max() + 1)
+    cells = j * shape[1] + i
+    order = np.argsort(cells, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(cells[order]) != 0])
+    lowest = np.full(shape[0] * shape[1], np.nan)
+    lowest[cells[order[starts]]] = np.minimum.reduceat(z[order], starts)
+    return lowest.reshape(shape), i, j
+
+
+def _fill(values, valid):
+    """fills invalid cells of a grid with the value of the nearest valid cell"""
+    if valid.all() or not valid.any():
+        return values
+    index = ndimage.distance_transform_edt(~valid, return_distances=False, return_indices=True)
+    return values[tuple(index)]
+
+
+def ground_cells(lowest, cell, step, bulge, spike, down_spike, offset):
+    """
+    Returns the cells of a grid of lowest points that hold ground, and the grid with down spikes removed
+
+    Args:
+        lowest (array): lowest z per cell, nan in empty cells
+        cell (float): cell size
+        step, bulge, spike, down_spike, offset (float): filter parameters in the units of the data (see module doc)
+    """
+    valid = np.isfinite(lowest)
+    surface = _fill(np.where(valid, lowest, 0), valid)
+    # down spikes would pull the opened surface down around them
+    median = ndimage.median_filter(surface, size=3, mode='nearest')
+    low = valid & (surface < median - down_spike)
+    surface[low] = median[low]
+    objects = ~valid | low
+
+    slope = bulge / step if step > 0 else 0
+    previous, window = 1, 3
+    while True:
+        opened = ndimage.grey_opening(surface, size=(window, window), mode='nearest')
+        threshold = min(offset + slope * (window - previous) * cell, offset + bulge)
+        objects |= surface - opened > threshold
+        surface = opened
+        if (window - 1) * cell >= step:
+            break
+        previous, window = window, 2 * window - 1
+
+    ground = ~objects
+    if ground.any():
+        # up spikes: single ground cells high above the ground around them
+        filled = _fill(np.where(ground, lowest, 0), ground)
+        ground &= ~(filled - ndimage.median_filter(filled, size=3, mode='nearest') > spike)
+    return ground, np.where(low, np.nan, lowest)
+
+
+def classify_ground(filename, ofilename, step, bulge, spike, down_spike, offset, units_code='', cell=None):
+    """
+    Writes a copy of a .las file with its ground points classified (class 2, all other points class 1)
+
+    Args:
+        filename (str): .las file, e.g. a tile with buffer
+        ofilename (str): .las file to write
+        step, bulge, spike, down_spike, offset (float): filter parameters in meters, like for lasground_new
+        units_code (str): '-feet -elevation_feet' (or either flag) if the coordinates are in feet
+        cell (float): grid cell size in the units of the data (default: POINTS_PER_CELL points per cell on average)
+
+    Returns the number of ground points.
+    """
+    horizontal = 1 / FOOT if '-feet' in units_code.split() else 1.0
+    vertical = 1 / FOOT if '-elevation_feet' in units_code.split() else 1.0
+    step, bulge = float(step) * horizontal, float(bulge) * vertical
+    spike, down_spike, offset = float(spike) * vertical, float(down_spike) * vertical, float(offset) * vertical
+
+    reader = LasReader(filename)
+    out = np.array(reader.points)
+    codes = np.full(len(out), UNCLASSIFIED, dtype=np.uint8)
+    if len(out):
+        x, y, z = reader.xyz()
+        x, y = x - x.min(), y - y.min()
+        if cell is None:
+            area = max((x.max() + 1e-6) * (y.max() + 1e-6), 1e-6)
+            cell = np.sqrt(POINTS_PER_CELL * area / len(out))
+        lowest, i, j = lowest_grid(x, y, z, cell)
+        ground, lowest = ground_cells(lowest, cell, step, bulge, spike, down_spike, offset)
+        if ground.any():
+            surface = _fill(np.where(ground, lowest, 0), ground & np.isfinite(lowest))
+            # the lowest point of a cell lies anywhere in it: allow for the rise of the surface over one cell
+            gy, gx = np.gradient(surface, cell)
+            rise = np.hypot(gx, gy)[j, i] * cell
+            # cell centers are at (index + 0.5) * cell
+            elevation = ndimage.map_coordinates(surface, [y / cell - 0.5, x / cell - 0.5], order=1, mode='nearest')
+            dz = z - elevation
+            # the surface runs along the lowest points, the ground returns scatter above it: the band of ground points
+            # is widened by three times their spread (median absolute deviation of the points near the surface)
+            near = ground[j, i] & (dz >= -down_spike) & (dz <= offset + rise + bulge)
+            spread = 1.4826 * np.median(np.abs(dz[near] - np.median(dz[near]))) if near.any() else 0
+            codes[(dz <= offset + rise + min(NOISE_SPREADS * spread, bulge)) & (dz >= -down_spike)] = GROUND
+    set_classification(out, reader.point_format, codes)
+    with reader.writer(ofilename) as writer:
+        writer.write(out)
+    return int((codes == GROUND).sum())
+
+
+def classify_files(files, odir, params, units_code='', workers=1):
+    """
+    Runs classify_ground on files with params (step, bulge, spike, down_spike, offset), writing files with the same
+    basenames to odir
+
+    The files are processed by a pool of worker processes (see pipeline.run_tasks). Returns the numbers of ground
+    points.
+    """
+    tasks = [(f, os.path.join(odir, os.path.basename(f))) + tuple(params) + (units_code,) for f in files]
+    return run_tasks(classify_ground, tasks, workers, processes=True)
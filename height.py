@@ -0,0 +1,160 @@
+"""
+Native height above ground of the points of .las files, as an alternative to lasheight.
+
+The ground surface of a tile is built from its ground points (class 2), including the points of the tile buffer, either
+as a triangulated irregular network (TIN, the surface lasheight uses) or as a grid of the mean ground elevation per
+cell. The TIN is exact but triangulating takes about 10 s per million ground points, the grid is an order of magnitude
+faster and smooths the ground within a cell. The height of all non-ground points is interpolated from the surface at
+once (ground points lie on the TIN and get height 0) and stored like lasheight does: in the user data field, in
+decimeters, clamped to 0 - 255. Points outside the TIN (beyond the outermost ground points) get the elevation of the
+nearest ground point.
+"""
+
+import os
+import logging
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import Delaunay, cKDTree, QhullError
+from pipeline import run_tasks
+from las_io import LasReader
+
+
+logger = logging.getLogger(__name__)
+
+GROUND = 2
+
+# user data value of a height: decimeters, clamped to the range of an unsigned char
+SCALE = 10.0
+MAX_VALUE = 255
+
+SURFACES = ('tin', 'grid')
+
+# row height (m) of the order in which points are located in the TIN
+WALK_ROW = 2.0
+
+
+def _check_surface(surface):
+    if surface not in SURFACES:
+        msg = 'Unknown ground surface %s (use %s)' % (surface, ' or '.join(SURFACES))
+        logger.error(msg)
+        raise Exception(msg)
+
+
+def _nearest(gx, gy, gz, x, y):
+    """returns the elevation of the nearest ground point of every point"""
+    return gz[cKDTree(np.c_[gx, gy]).query(np.c_[x, y])[1]]
+
+
+def tin_elevation(gx, gy, gz, x, y):
+    """
+    Returns the elevation of the TIN of ground points at points x, y (linear interpolation within the triangles)
+
+    Args:
+        gx, gy, gz (array): coordinates of the ground points, shifted close to 0 (qhull works in double precision)
+        x, y (array): points to interpolate at
+    """
+    try:
+        tri = Delaunay(np.c_[gx, gy])
+    except (QhullError, ValueError):
+        # fewer than three ground points, or all on a line
+        return _nearest(gx, gy, gz, x, y)
+    xy = np.c_[x, y]
+    # the triangle search walks from the triangle found for the previous point, so the points are searched in
+    # serpentine order through rows of WALK_ROW, instead of walking across the tile for every point
+    row = (y // WALK_ROW).astype(np.int64)
+    order = np.lexsort((np.where(row % 2, -x, x), row))
+    simplex = np.empty(len(x), dtype=np.int64)
+    simplex[order] = tri.find_simplex(xy[order])
+    inside = simplex >= 0
+    # barycentric coordinates of the points in their triangles
+    t = tri.transform[simplex[inside]]
+    b = np.einsum('ijk,ik->ij', t[:, :2], xy[inside] - t[:, 2])
+    weights = np.c_[b, 1 - b.sum(axis=1)]
+    elevation = np.empty(len(x))
+    elevation[inside] = (gz[tri.simplices[simplex[inside]]] * weights).sum(axis=1)
+    if not inside.all():
+        elevation[~inside] = _nearest(gx, gy, gz, x[~inside], y[~inside])
+    return elevation
+
+
+def grid_elevation(gx, gy, gz, x, y, cell=1.0):
+    """
+    Returns the elevation of a grid of the mean ground elevation per cell at points x, y
+
+    Cells without ground points take the value of the nearest cell with ground points.
+    """
+    x0, y0 = min(gx.min(), x.min()), min(gy.min(), y.min())
+    gi, gj = ((gx - x0) // cell).astype(np.int64), ((gy - y0) // cell).astype(np.int64)
+    i, j = ((x - x0) // cell).astype(np.int64), ((y - y0) // cell).astype(np.int64)
+    shape = (max(gj.max(), j.max()) + 1, max(gi.max(), i.max()) + 1)
+    cells = gj * shape[1] + gi
+    count = np.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+    total = np.bincount(cells, gz, minlength=shape[0] * shape[1]).reshape(shape)
+    has_ground = count > 0
+    mean = np.where(has_ground, total / np.maximum(count, 1), 0)
+    # index of the nearest cell with ground points, for every cell
+    nearest = ndimage.distance_transform_edt(~has_ground, return_distances=False, return_indices=True)
+    return mean[tuple(nearest)][j, i]
+
+
+def ground_heights(x, y, z, ground, surface='tin', cell=1.0):
+    """
+    Returns the height above ground of points (0 for the ground points, and for all points if there are none)
+
+    Args:
+        x, y, z (array): coordinates of the points, x and y shifted close to 0
+        ground (array): True for the ground points
+        surface (str): 'tin' or 'grid' (see height_above_ground)
+        cell (float): cell size of the grid surface
+    """
+    _check_surface(surface)
+    height = np.zeros(len(z))
+    if ground.any() and not ground.all():
+        other = ~ground
+        if surface == 'tin':
+            elevation = tin_elevation(x[ground], y[ground], z[ground], x[other], y[other])
+        else:
+            elevation = grid_elevation(x[ground], y[ground], z[ground], x[other], y[other], cell)
+        height[other] = z[other] - elevation
+    return height
+
+
+def user_data(height):
+    """returns heights as user data values: decimeters, clamped to 0 - 255 (like lasheight)"""
+    return np.clip(np.round(height * SCALE), 0, MAX_VALUE)
+
+
+def height_above_ground(filename, ofilename, surface='tin', cell=1.0):
+    """
+    Writes a copy of a .las file with the height above ground of every point in the user data field (like lasheight)
+
+    Args:
+        filename (str): classified .las file (ground points have class 2), e.g. a tile with buffer
+        ofilename (str): .las file to write
+        surface (str): ground surface to measure heights from: 'tin' (triangulated ground points) or 'grid' (mean
+            ground elevation per cell of size cell)
+        cell (float): cell size of the grid surface
+
+    Ground points and all points of a file without ground points get height 0. Returns the number of points.
+    """
+    _check_surface(surface)
+    reader = LasReader(filename)
+    out = np.array(reader.points)
+    if len(out):
+        x, y, z = reader.xyz()
+        # coordinates relative to the lower left corner keep the precision of the triangulation
+        x, y = x - reader.header.mins[0], y - reader.header.mins[1]
+        out['user_data'] = user_data(ground_heights(x, y, z, reader.classification() == GROUND, surface, cell))
+    with reader.writer(ofilename) as writer:
+        writer.write(out)
+    return len(out)
+
+
+def compute_heights(files, odir, workers=1, surface='tin'):
+    """
+    Runs height_above_ground on files, writing files with the same basenames to odir
+
+    The files are processed by a pool of worker processes (see pipeline.run_tasks). Returns the numbers of points.
+    """
+    tasks = [(f, os.path.join(odir, os.path.basename(f)), surface) for f in files]
+    return run_tasks(height_above_ground, tasks, workers, processes=True)
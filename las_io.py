@@ -0,0 +1,449 @@
+"""
+Native access to LAS/LAZ files.
+
+The public header block of LAS 1.0 - 1.4 files holds the number of points, the number of points by return, the
+bounding box and the scale and offset of the coordinates. LAZ files share the uncompressed public header, so the
+header reader works for both. Point records can only be read from uncompressed LAS files: LasReader maps them as
+numpy.memmap and scales coordinates on demand, LasWriter streams point records to a new file chunk by chunk.
+"""
+
+import os
+import struct
+import threading
+import logging
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# LAS 1.0 - 1.2 public header block (227 bytes)
+_HEADER_FORMAT = '<4sHH16sBB32s32sHHHIIBHI5I3d3d6d'
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+
+# headers read so far by absolute path, with the (size, mtime) of the file when it was read
+_headers = {}
+_headers_lock = threading.Lock()
+
+
+class LasHeader:
+    """
+    Public header block of a LAS/LAZ file
+
+    Attributes:
+        filename (str): path of the file
+        version (tuple): (major, minor) version of the LAS specification
+        point_format (int): point data record format (0 - 10)
+        compressed (bool): True if the point data is LAZ-compressed
+        header_size (int): size of the public header block in bytes
+        offset_to_points (int): byte offset of the first point record
+        number_of_vlrs (int): number of variable length records
+        record_length (int): length of a single point record in bytes
+        point_count (int): number of point records
+        points_by_return (list): number of points by return (5 values for LAS < 1.4, 15 for LAS 1.4)
+        scale (tuple): x, y, z scale factors
+        offset (tuple): x, y, z offsets
+        mins (tuple): minimum x, y, z
+        maxs (tuple): maximum x, y, z
+        start_of_first_evlr (int): byte offset of the first extended variable length record (LAS 1.4, otherwise 0)
+        number_of_evlrs (int): number of extended variable length records (LAS 1.4, otherwise 0)
+    """
+
+    def __init__(self, filename, data):
+        if len(data) < _HEADER_SIZE or data[:4] != b'LASF':
+            msg = '%s is not a LAS/LAZ file' % filename
+            logger.error(msg)
+            raise Exception(msg)
+
+        values = struct.unpack_from(_HEADER_FORMAT, data)
+        self.filename = filename
+        self.file_source_id, self.global_encoding = values[1:3]
+        self.version = (values[4], values[5])
+        self.header_size, self.offset_to_points, self.number_of_vlrs = values[10:13]
+        self.compressed = bool(values[13] & 0x80)
+        self.point_format = values[13] & 0x3F
+        self.record_length = values[14]
+        self.point_count = values[15]
+        self.points_by_return = list(values[16:21])
+        self.scale = values[21:24]
+        self.offset = values[24:27]
+        max_x, min_x, max_y, min_y, max_z, min_z = values[27:33]
+        self.mins = (min_x, min_y, min_z)
+        self.maxs = (max_x, max_y, max_z)
+        self.start_of_first_evlr = 0
+        self.number_of_evlrs = 0
+
+        if self.version >= (1, 4) and len(data) >= 375:
+            # LAS 1.4 stores 64-bit point counts after the waveform data offset
+            self.start_of_first_evlr, self.number_of_evlrs, count = struct.unpack_from('<QIQ', data, 235)
+            by_return = list(struct.unpack_from('<15Q', data, 255))
+            if count or not self.point_count:
+                self.point_count = count
+                self.points_by_return = by_return
+
+    @property
+    def area(self):
+        """area of the xy bounding box"""
+        return (self.maxs[0] - self.mins[0]) * (self.maxs[1] - self.mins[1])
+
+    @property
+    def density(self):
+        """average number of points per square unit within the xy bounding box"""
+        if self.area <= 0:
+            return float(self.point_count)
+        return self.point_count / self.area
+
+    def __repr__(self):
+        return 'LasHeader(%s, %i points)' % (os.path.basename(self.filename), self.point_count)
+
+
+def read_header(filename):
+    """
+    Returns the LasHeader of a .las/.laz file
+
+    Headers are cached per file and only read again if the size or modification time of the file changed.
+    """
+    key = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = (st.st_size, st.st_mtime_ns)
+    with _headers_lock:
+        cached = _headers.get(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    with open(filename, 'rb') as f:
+        data = f.read(375)
+    header = LasHeader(filename, data)
+    with _headers_lock:
+        _headers[key] = (stamp, header)
+    return header
+
+
+def _sample(filename, dims, max_points):
+    # evenly strided sample of the scaled coordinates dims ('X', 'Y' and/or 'Z') of a .las file, or None
+    h = read_header(filename)
+    if h.compressed or filename.lower().endswith('.laz') or h.point_count == 0:
+        return None
+    dtype = np.dtype({'names': list(dims), 'formats': ['<i4'] * len(dims),
+                      'offsets': [4 * 'XYZ'.index(d) for d in dims], 'itemsize': h.record_length})
+    try:
+        points = np.memmap(filename, dtype=dtype, mode='r', offset=h.offset_to_points, shape=(h.point_count,))
+    except (ValueError, OSError):
+        logger.warning('Could not read point records of %s' % filename)
+        return None
+    step = max(1, -(-h.point_count // max_points))
+    sample = np.array(points[::step])
+    return tuple(sample[d] * h.scale['XYZ'.index(d)] + h.offset['XYZ'.index(d)] for d in dims)
+
+
+def sample_xy(filename, max_points=50000):
+    """
+    Returns x and y coordinates of an evenly strided sample of the points of a .las file
+
+    Args:
+        filename (str): .las file
+        max_points (int): maximum number of points to sample
+
+    Returns None for compressed (.laz) or unreadable files.
+    """
+    return _sample(filename, 'XY', max_points)
+
+
+def sample_z(filename, max_points=50000):
+    """returns the z coordinates of an evenly strided sample of the points of a .las file, or None (see sample_xy)"""
+    sample = _sample(filename, 'Z', max_points)
+    return None if sample is None else sample[0]
+
+
+# point data record formats 0 - 10: fields following X, Y, Z (all records start with X, Y, Z as int32)
+_LEGACY_FIELDS = [('intensity', '<u2'), ('return_bits', 'u1'), ('classification', 'u1'), ('scan_angle_rank', 'i1'),
+                  ('user_data', 'u1'), ('point_source_id', '<u2')]
+_EXTENDED_FIELDS = [('intensity', '<u2'), ('return_bits', 'u1'), ('flags', 'u1'), ('classification', 'u1'),
+                    ('user_data', 'u1'), ('scan_angle', '<i2'), ('point_source_id', '<u2'), ('gps_time', '<f8')]
+_GPS = [('gps_time', '<f8')]
+_RGB = [('red', '<u2'), ('green', '<u2'), ('blue', '<u2')]
+_NIR = [('nir', '<u2')]
+_WAVE = [('wave_packet', 'u1'), ('wave_offset', '<u8'), ('wave_size', '<u4'), ('wave_location', '<f4'),
+         ('x_t', '<f4'), ('y_t', '<f4'), ('z_t', '<f4')]
+POINT_FIELDS = {0: _LEGACY_FIELDS,
+                1: _LEGACY_FIELDS + _GPS,
+                2: _LEGACY_FIELDS + _RGB,
+                3: _LEGACY_FIELDS + _GPS + _RGB,
+                4: _LEGACY_FIELDS + _GPS + _WAVE,
+                5: _LEGACY_FIELDS + _GPS + _RGB + _WAVE,
+                6: _EXTENDED_FIELDS,
+                7: _EXTENDED_FIELDS + _RGB,
+                8: _EXTENDED_FIELDS + _RGB + _NIR,
+                9: _EXTENDED_FIELDS + _WAVE,
+                10: _EXTENDED_FIELDS + _RGB + _NIR + _WAVE
+                }
+
+
+def point_dtype(point_format, record_length=None):
+    """
+    Returns the numpy dtype of a point data record
+
+    Args:
+        point_format (int): point data record format (0 - 10)
+        record_length (int): record length from the header. Bytes beyond the standard record (extra bytes) are
+            exposed as the 'extra_bytes' field.
+    """
+    if point_format not in POINT_FIELDS:
+        msg = 'Unsupported point data record format %i' % point_format
+        logger.error(msg)
+        raise Exception(msg)
+    fields = [('X', '<i4'), ('Y', '<i4'), ('Z', '<i4')] + POINT_FIELDS[point_format]
+    dtype = np.dtype(fields)
+    if record_length is not None and record_length > dtype.itemsize:
+        dtype = np.dtype(fields + [('extra_bytes', 'V%i' % (record_length - dtype.itemsize))])
+    elif record_length is not None and record_length < dtype.itemsize:
+        msg = 'Record length %i too short for point format %i' % (record_length, point_format)
+        logger.error(msg)
+        raise Exception(msg)
+    return dtype
+
+
+def readable(filename):
+    """returns True if the point records of the file can be read natively (i.e. it is not LAZ-compressed)"""
+    return not filename.lower().endswith('.laz') and not read_header(filename).compressed
+
+
+def classification(points, point_format):
+    """returns the class codes of point records (without the flag bits of formats 0 - 5)"""
+    if point_format < 6:
+        return points['classification'] & 0x1F
+    return points['classification']
+
+
+def set_classification(points, point_format, codes):
+    """sets the class codes of point records in place (keeping the flag bits of formats 0 - 5)"""
+    if point_format < 6:
+        points['classification'] = (points['classification'] & 0xE0) | codes
+    else:
+        points['classification'] = codes
+
+
+def return_number(points, point_format):
+    """returns the return numbers of point records"""
+    if point_format < 6:
+        return points['return_bits'] & 0x07
+    return points['return_bits'] & 0x0F
+
+
+def number_of_returns(points, point_format):
+    """returns the number of returns of the pulses of point records"""
+    if point_format < 6:
+        return (points['return_bits'] >> 3) & 0x07
+    return points['return_bits'] >> 4
+
+
+def scaled(points, header, dim):
+    """returns the coordinates of point records along dim ('X', 'Y' or 'Z') as float, using header scale and offset"""
+    i = 'XYZ'.index(dim)
+    return points[dim] * header.scale[i] + header.offset[i]
+
+
+def unscaled(values, header, dim):
+    """returns coordinates along dim ('X', 'Y' or 'Z') as integer record values for scale and offset of header"""
+    i = 'XYZ'.index(dim)
+    return np.round((values - header.offset[i]) / header.scale[i]).astype('<i4')
+
+
+def rescale(points, source, target):
+    """converts the X, Y and Z of point records in place from scale and offset of header source to those of target"""
+    if source.scale == target.scale and source.offset == target.offset:
+        return points
+    for dim in 'XYZ':
+        points[dim] = unscaled(scaled(points, source, dim), target, dim)
+    return points
+
+
+def read_points(filename):
+    """returns the LasHeader and the point records of a .las file as read-only numpy.memmap"""
+    h = read_header(filename)
+    if not readable(filename):
+        msg = 'Cannot read compressed points of %s' % filename
+        logger.error(msg)
+        raise Exception(msg)
+    dtype = point_dtype(h.point_format, h.record_length)
+    if h.point_count == 0:
+        return h, np.zeros(0, dtype)
+    return h, np.memmap(filename, dtype=dtype, mode='r', offset=h.offset_to_points, shape=(h.point_count,))
+
+
+def create_las(filename, point_format=1, scale=(0.01, 0.01, 0.01), offset=(0.0, 0.0, 0.0), system_id='las_io'):
+    """
+    Writes a LAS 1.2 file without points (and without variable length records) and returns its LasHeader
+
+    The header can serve as template of a LasWriter writing to the same file.
+    """
+    record_length = point_dtype(point_format).itemsize
+    values = [b'LASF', 0, 0, b'\0' * 16, 1, 2, system_id.encode()[:32], b'las_io', 1, 2020, _HEADER_SIZE,
+              _HEADER_SIZE, 0, point_format, record_length, 0, 0, 0, 0, 0, 0]
+    values += list(scale) + list(offset) + [0.0] * 6
+    with open(filename, 'wb') as f:
+        f.write(struct.pack(_HEADER_FORMAT, *values))
+    return read_header(filename)
+
+
+def read_vlrs(filename):
+    """returns the variable length records of a .las/.laz file as list of (user_id, record_id, description, data)"""
+    h = read_header(filename)
+    vlrs = []
+    with open(filename, 'rb') as f:
+        f.seek(h.header_size)
+        for i in range(h.number_of_vlrs):
+            head = f.read(54)
+            if len(head) < 54:
+                break
+            user_id, record_id, length, description = struct.unpack('<2x16sHH32s', head)
+            vlrs.append((user_id.rstrip(b'\0').decode(errors='replace'), record_id,
+                         description.rstrip(b'\0').decode(errors='replace'), f.read(length)))
+    return vlrs
+
+
+def _vlr_bytes(user_id, record_id, description, data):
+    return struct.pack('<H16sHH32s', 0, user_id.encode()[:16], record_id, len(data), description.encode()[:32]) + data
+
+
+class LasWriter:
+    """
+    Writes point records to a new .las file chunk by chunk
+
+    The new file gets the header and variable length records of a template file. Point count, points by return and
+    bounding box are updated from the written points when the writer is closed.
+
+    Args:
+        filename (str): .las file to write
+        template (LasHeader): header of the file the points come from
+        vlrs (list): variable length records (user_id, record_id, description, data) to add. They replace records of
+            the template with the same user_id and record_id.
+    """
+
+    def __init__(self, filename, template, vlrs=None):
+        self.filename = filename
+        self.template = template
+        self.dtype = point_dtype(template.point_format, template.record_length)
+        self.count = 0
+        self.by_return = np.zeros(16, dtype=np.int64)
+        self.mins = None
+        self.maxs = None
+        with open(template.filename, 'rb') as f:
+            self._head = bytearray(f.read(template.offset_to_points))
+        if vlrs:
+            replaced = set((v[0], v[1]) for v in vlrs)
+            kept = [v for v in read_vlrs(template.filename) if (v[0], v[1]) not in replaced]
+            body = b''.join(_vlr_bytes(*v) for v in kept + list(vlrs))
+            self._head = self._head[:template.header_size] + bytearray(body)
+            struct.pack_into('<II', self._head, 96, len(self._head), len(kept) + len(vlrs))
+        self._file = open(filename, 'wb')
+        self._file.write(self._head)
+
+    def write(self, points):
+        """appends point records (structured array with the dtype of the template)"""
+        if len(points) == 0:
+            return
+        if points.dtype != self.dtype:
+            points = points.astype(self.dtype)
+        self._file.write(np.ascontiguousarray(points).tobytes())
+        self.count += len(points)
+        self.by_return += np.bincount(return_number(points, self.template.point_format), minlength=16)[:16]
+        xyz = np.array([[points[c].min() for c in 'XYZ'], [points[c].max() for c in 'XYZ']], dtype=np.int64)
+        self.mins = xyz[0] if self.mins is None else np.minimum(self.mins, xyz[0])
+        self.maxs = xyz[1] if self.maxs is None else np.maximum(self.maxs, xyz[1])
+
+    def close(self):
+        """updates the header and closes the file"""
+        t = self.template
+        if self.count:
+            mins = [self.mins[i] * t.scale[i] + t.offset[i] for i in range(3)]
+            maxs = [self.maxs[i] * t.scale[i] + t.offset[i] for i in range(3)]
+        else:
+            mins = maxs = [0.0, 0.0, 0.0]
+        head = self._head
+        legacy = t.point_format < 6 and self.count < 2 ** 32
+        struct.pack_into('<I', head, 107, self.count if legacy else 0)
+        struct.pack_into('<5I', head, 111, *[int(n) if legacy else 0 for n in self.by_return[1:6]])
+        struct.pack_into('<6d', head, 179, maxs[0], mins[0], maxs[1], mins[1], maxs[2], mins[2])
+        if t.version >= (1, 4) and t.header_size >= 375:
+            # extended variable length records of the template are not copied
+            struct.pack_into('<QIQ', head, 235, 0, 0, self.count)
+            struct.pack_into('<15Q', head, 255, *[int(n) for n in self.by_return[1:16]])
+        self._file.seek(0)
+        self._file.write(head)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_chunks(points, chunk_points=2 ** 21):
+    """yields consecutive slices of at most chunk_points point records"""
+    for start in range(0, len(points), chunk_points):
+        yield points[start:start + chunk_points]
+
+
+class LasReader:
+    """
+    Point records of a .las file (LAS 1.0 - 1.4, point formats 0 - 10), mapped as read-only numpy.memmap
+
+    Fields are views of the file and cost no copy (reader['classification'], reader.points[1000:2000]). Coordinates
+    are only scaled to float when requested, for all points or a chunk of them::
+
+        reader = LasReader('tile.las')
+        for chunk in reader.chunks():
+            x, y, z = reader.xyz(chunk)
+            ground = reader.classification(chunk) == 2
+
+    Args:
+        filename (str): uncompressed .las file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.header, self.points = read_points(filename)
+        self.point_format = self.header.point_format
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, key):
+        return self.points[key]
+
+    def chunks(self, chunk_points=2 ** 21):
+        """yields consecutive slices of at most chunk_points point records (views of the file)"""
+        return iter_chunks(self.points, chunk_points)
+
+    def x(self, points=None):
+        """returns the x coordinates of points (records of this file, default all) as float"""
+        return scaled(self.points if points is None else points, self.header, 'X')
+
+    def y(self, points=None):
+        """returns the y coordinates of points (records of this file, default all) as float"""
+        return scaled(self.points if points is None else points, self.header, 'Y')
+
+    def z(self, points=None):
+        """returns the z coordinates of points (records of this file, default all) as float"""
+        return scaled(self.points if points is None else points, self.header, 'Z')
+
+    def xyz(self, points=None):
+        """returns the x, y and z coordinates of points (records of this file, default all) as floats"""
+        return self.x(points), self.y(points), self.z(points)
+
+    def classification(self, points=None):
+        """returns the class codes of points (records of this file, default all)"""
+        return classification(self.points if points is None else points, self.point_format)
+
+    def return_number(self, points=None):
+        """returns the return numbers of points (records of this file, default all)"""
+        return return_number(self.points if points is None else points, self.point_format)
+
+    def number_of_returns(self, points=None):
+        """returns the number of returns of points (records of this file, default all)"""
+        return number_of_returns(self.points if points is None else points, self.point_format)
+
+    def writer(self, filename, vlrs=None):
+        """returns a LasWriter for a new file with the header and variable length records of this file"""
+        return LasWriter(filename, self.header, vlrs)
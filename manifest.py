@@ -0,0 +1,215 @@
+"""
+Content-hashed manifests of the LiDAR processing stages.
+
+After a stage finished, a manifest is written to each of its output directories. It holds the size, modification time
+and hash of every input and output file, the stage parameters and the stage results. When the workflow runs again, a
+stage is skipped if its manifest is intact and neither its inputs nor its parameters changed.
+
+A stage whose results list quarantined tiles (see quarantine.py) is never up to date, so that the next run tries these
+tiles again.
+
+Manifests of outputs that were deleted or compressed after use (see retention.py) are marked as retired. Their recorded
+outputs stand in for the missing files when the inputs of the stages reading them are checked.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'stage_manifest.json'
+
+# known file records by absolute path, so that files are only hashed once per process
+_records = {}
+_records_lock = threading.Lock()
+
+
+def within(path, directory):
+    """returns True if path is directory or lies inside directory (both relative, '/'-separated)"""
+    path = path.strip('/')
+    directory = directory.strip('/')
+    return path == directory or path.startswith(directory + '/')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """returns the blake2b hash of the file content"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_record(path, known=None):
+    """
+    Returns dict with size, mtime_ns and hash of a file
+
+    The hash is only computed if neither known (a previously recorded dict) nor the cache of this process holds a
+    record with the same size and modification time.
+    """
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    with _records_lock:
+        cached = _records.get(key)
+    for rec in (known, cached):
+        if rec and rec['size'] == st.st_size and rec['mtime_ns'] == st.st_mtime_ns:
+            return rec
+    rec = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': file_hash(path)}
+    with _records_lock:
+        _records[key] = rec
+    return rec
+
+
+def directory_files(directory):
+    """returns all files in directory and its subdirectories, except for manifests"""
+    l = []
+    for path, subdirs, files in os.walk(directory):
+        for name in files:
+            if name != MANIFEST_NAME:
+                l.append(os.path.join(path, name))
+    return sorted(l)
+
+
+def _key(path, root):
+    # paths inside the project directory are stored relative to it, so the project can be moved
+    path = os.path.abspath(path)
+    rel = os.path.relpath(path, os.path.abspath(root))
+    return path if rel.startswith('..') else rel.replace(os.sep, '/')
+
+
+def snapshot(paths, root, known=None, workers=1):
+    """returns dict of file records for all paths, keyed by path relative to root"""
+    known = known or {}
+
+    def record(path):
+        return _key(path, root), file_record(path, known.get(_key(path, root)))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(pool.map(record, paths))
+
+
+def stage_inputs(stage, root):
+    """returns all files read by stage: the files in its input directories and its source files"""
+    files = []
+    for i in stage.inputs:
+        files += directory_files(os.path.join(root, i))
+    files += [f for f in stage.sources if os.path.isfile(f)]
+    return files
+
+
+def stage_outputs(stage, root):
+    """returns all files in the output directories of stage"""
+    return [f for o in stage.outputs for f in directory_files(os.path.join(root, o))]
+
+
+def read_manifest(directory):
+    """returns the manifest stored in directory as dict, or None if there is no readable manifest"""
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _normalized(params):
+    # compare parameters the way they are stored (e.g. tuples become lists)
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+def _hashes(records):
+    return {k: r['hash'] for k, r in records.items()}
+
+
+def _retired_outputs(directory, root):
+    # recorded output records below directory if the manifest of the stage that wrote it is retired, else None
+    parts = directory.strip('/').split('/')
+    for i in range(len(parts), 0, -1):
+        m = read_manifest(os.path.join(root, *parts[:i]))
+        if m is not None:
+            if not m.get('retired'):
+                return None
+            return {k: r for k, r in m['outputs'].items() if within(k, directory)}
+    return None
+
+
+def retired(stage, root):
+    """returns True if the outputs of stage were retired"""
+    return any((read_manifest(os.path.join(root, o)) or {}).get('retired') for o in stage.outputs)
+
+
+def mark_retired(stage, root, mode):
+    """marks the manifests of all output directories of stage as retired (mode: 'delete' or 'compress')"""
+    for o in stage.outputs:
+        m = read_manifest(os.path.join(root, o))
+        if m is not None:
+            m['retired'] = mode
+            with open(os.path.join(root, o, MANIFEST_NAME), 'w') as f:
+                json.dump(m, f, indent=1, sort_keys=True)
+
+
+def up_to_date(stage, root, workers=1):
+    """
+    Checks if the outputs of stage are still valid
+
+    Returns (True, results) if the manifests of all output directories are intact, the inputs and parameters of the
+    stage are unchanged and no tiles were quarantined, (False, reason) otherwise.
+    """
+    if not stage.outputs:
+        return False, 'stage has no outputs'
+    manifests = [read_manifest(os.path.join(root, o)) for o in stage.outputs]
+    if any(m is None for m in manifests):
+        return False, 'no manifest'
+    m = manifests[0]
+    if any(other != m for other in manifests[1:]) or m.get('stage') != stage.name:
+        return False, 'manifest does not belong to this stage'
+    if m.get('params') != _normalized(stage.params):
+        return False, 'parameters changed'
+    if m.get('results', {}).get('quarantined'):
+        return False, '%i quarantined tile(s)' % len(m['results']['quarantined'])
+
+    if not m.get('retired'):
+        outputs = snapshot(stage_outputs(stage, root), root, m['outputs'], workers)
+        if _hashes(outputs) != _hashes(m['outputs']):
+            return False, 'outputs changed'
+
+    # inputs in retired directories are taken from the manifest of the stage that wrote them
+    files = [f for f in stage.sources if os.path.isfile(f)]
+    recorded = {}
+    for i in stage.inputs:
+        r = _retired_outputs(i, root)
+        if r is None:
+            files += directory_files(os.path.join(root, i))
+        else:
+            recorded.update(r)
+    inputs = snapshot(files, root, m['inputs'], workers)
+    inputs.update(recorded)
+    if _hashes(inputs) != _hashes(m['inputs']):
+        return False, 'inputs changed'
+
+    return True, m.get('results', {})
+
+
+def clear_outputs(stage, root):
+    """deletes all files (including manifests) in the output directories of stage, keeping the directory tree"""
+    for o in stage.outputs:
+        for path, subdirs, files in os.walk(os.path.join(root, o)):
+            for name in files:
+                os.remove(os.path.join(path, name))
+
+
+def write_manifests(stage, root, results, workers=1):
+    """records inputs, outputs, parameters and results of stage in a manifest in each of its output directories"""
+    m = {'stage': stage.name,
+         'params': _normalized(stage.params),
+         'inputs': snapshot(stage_inputs(stage, root), root, workers=workers),
+         'outputs': snapshot(stage_outputs(stage, root), root, workers=workers),
+         'results': _normalized(results)
+         }
+    for o in stage.outputs:
+        with open(os.path.join(root, o, MANIFEST_NAME), 'w') as f:
+            json.dump(m, f, indent=1, sort_keys=True)
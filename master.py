@@ -15,6 +15,7 @@ import tkinter as tk
 from tkinter import ttk
 from file_functions import *
 import LiDAR_processing_GUI as lp
+import sweep
 # import create_centerline_GUI as cc
 # import create_station_lines as sl
 # import DEM_Detrending as dd
@@ -203,7 +204,10 @@ class GCS_GUI(tk.Frame):
         self.r16_lidar.grid(row=15, column=2)
         self.r32_lidar = ttk.Radiobutton(root, text='32', variable=self.core_num, value=32)
         self.r32_lidar.grid(sticky=W, row=15, column=3)
-        self.core_num.set(16)
+        # 0: all CPUs of the machine, processes per stage planned from tiles and memory (see resources.Planner)
+        self.rauto_lidar = ttk.Radiobutton(root, text='auto', variable=self.core_num, value=0)
+        self.rauto_lidar.grid(sticky=W, row=13, column=3)
+        self.core_num.set(0)
 
         self.l_keep_orig_lidar = ttk.Label(root, text='Keep original ground/veg points: ')
         self.l_keep_orig_lidar.grid(sticky=E, row=16, column=1)
@@ -212,6 +216,68 @@ class GCS_GUI(tk.Frame):
         self.c_keep_orig_lidar.grid(sticky=W, row=16, column=2)
         self.keep_orig_lidar.set(True)
 
+        self.l_per_tile_lidar = ttk.Label(root, text='Process tiles independently: ')
+        self.l_per_tile_lidar.grid(sticky=E, row=17, column=1)
+        self.per_tile_lidar = BooleanVar()
+        self.c_per_tile_lidar = ttk.Checkbutton(root, variable=self.per_tile_lidar)
+        self.c_per_tile_lidar.grid(sticky=W, row=17, column=2)
+        self.per_tile_lidar.set(False)
+
+        self.l_retention_lidar = ttk.Label(root, text='Intermediate outputs: ')
+        self.l_retention_lidar.grid(sticky=E, row=18, column=1)
+        self.retention_lidar = StringVar()
+        self.o_retention_lidar = ttk.OptionMenu(root, self.retention_lidar, 'keep', 'keep', 'delete', 'compress')
+        self.o_retention_lidar.grid(sticky=W, row=18, column=2)
+
+        self.l_disk_budget_lidar = ttk.Label(root, text='Disk budget in GB (optional): ')
+        self.l_disk_budget_lidar.grid(sticky=E, row=19, column=1)
+        self.e_disk_budget_lidar = ttk.Entry(root)
+        self.e_disk_budget_lidar.grid(sticky=W, row=19, column=2)
+
+        self.l_ground_engine_lidar = ttk.Label(root, text='Ground classification: ')
+        self.l_ground_engine_lidar.grid(sticky=E, row=20, column=1)
+        self.ground_engine_lidar = StringVar()
+        self.o_ground_engine_lidar = ttk.OptionMenu(root, self.ground_engine_lidar, 'lasground_new',
+                                                    *lp.GROUND_ENGINES)
+        self.o_ground_engine_lidar.grid(sticky=W, row=20, column=2)
+
+        self.l_height_engine_lidar = ttk.Label(root, text='Height above ground: ')
+        self.l_height_engine_lidar.grid(sticky=E, row=21, column=1)
+        self.height_engine_lidar = StringVar()
+        self.o_height_engine_lidar = ttk.OptionMenu(root, self.height_engine_lidar, 'lasheight', *lp.HEIGHT_ENGINES)
+        self.o_height_engine_lidar.grid(sticky=W, row=21, column=2)
+
+        self.l_classify_engine_lidar = ttk.Label(root, text='Vegetation/building classification: ')
+        self.l_classify_engine_lidar.grid(sticky=E, row=22, column=1)
+        self.classify_engine_lidar = StringVar()
+        self.o_classify_engine_lidar = ttk.OptionMenu(root, self.classify_engine_lidar, 'lasclassify',
+                                                      *lp.CLASSIFY_ENGINES)
+        self.o_classify_engine_lidar.grid(sticky=W, row=22, column=2)
+
+        # thresholds and neighbourhood size of the eigen classifier (see classify.py)
+        self.eigen = {}
+        for row, (key, text, default) in enumerate([
+                ('ground_offset', 'Eigen: ground offset (m): ', lp.GROUND_OFFSET),
+                ('planar', 'Eigen: planar roughness (m): ', lp.PLANAR),
+                ('rugged', 'Eigen: rugged roughness (m): ', lp.RUGGED),
+                ('scatter', 'Eigen: scatter: ', lp.SCATTER),
+                ('neighbours', 'Eigen: neighbours: ', lp.NEIGHBOURS)], 23):
+            ttk.Label(root, text=text).grid(sticky=E, row=row, column=1)
+            self.eigen[key] = ttk.Entry(root)
+            self.eigen[key].insert(END, str(default))
+            self.eigen[key].grid(sticky=W, row=row, column=2)
+
+        self.l_tiling_lidar = ttk.Label(root, text='Tiling: ')
+        self.l_tiling_lidar.grid(sticky=E, row=28, column=1)
+        self.tiling_lidar = StringVar()
+        self.o_tiling_lidar = ttk.OptionMenu(root, self.tiling_lidar, 'uniform', *lp.TILINGS)
+        self.o_tiling_lidar.grid(sticky=W, row=28, column=2)
+
+        self.l_preview_lidar = ttk.Label(root, text='Preview on number of tiles (optional): ')
+        self.l_preview_lidar.grid(sticky=E, row=29, column=1)
+        self.e_preview_lidar = ttk.Entry(root)
+        self.e_preview_lidar.grid(sticky=W, row=29, column=2)
+
         # make 'Run' ttk.Button in GUI to call the process_lidar() function
         self.b_lidar_run = ttk.Button(root, text='    Run    ',
                                       command=lambda: lp.process_lidar(lastoolsdir=self.e_lasbin.get(),
@@ -229,12 +295,41 @@ class GCS_GUI(tk.Frame):
                                                                        fine_bulge=self.e_f_bulge.get(),
                                                                        fine_spike=self.e_f_spike.get(),
                                                                        fine_down_spike=self.e_f_dspike.get(),
-                                                                       fine_offset=self.e_f_offset.get()
+                                                                       fine_offset=self.e_f_offset.get(),
+                                                                       per_tile=self.per_tile_lidar.get(),
+                                                                       retention=self.retention_lidar.get(),
+                                                                       disk_budget=self.e_disk_budget_lidar.get(),
+                                                                       ground_engine=self.ground_engine_lidar.get(),
+                                                                       height_engine=self.height_engine_lidar.get(),
+                                                                       classify_engine=self.classify_engine_lidar.get(),
+                                                                       ground_offset=self.eigen['ground_offset'].get(),
+                                                                       planar=self.eigen['planar'].get(),
+                                                                       rugged=self.eigen['rugged'].get(),
+                                                                       scatter=self.eigen['scatter'].get(),
+                                                                       neighbours=self.eigen['neighbours'].get(),
+                                                                       tiling=self.tiling_lidar.get(),
+                                                                       preview=self.e_preview_lidar.get()
                                                                        )
                                       )
 
-        self.b_lidar_run.grid(sticky=W, row=17, column=2)
-        root.grid_rowconfigure(17, minsize=80)
+        self.b_lidar_run.grid(sticky=W, row=30, column=2)
+        root.grid_rowconfigure(30, minsize=80)
+
+        # try every combination of comma-separated values typed into the standard/coarse parameters on a few tiles
+        self.b_lidar_sweep = ttk.Button(root, text='    Sweep    ',
+                                        command=lambda: sweep.sweep_lidar(lastoolsdir=self.e_lasbin.get(),
+                                                                          lidardir=self.e_lidardir.get(),
+                                                                          units_code=self.lidar_units.get()[1:-1],
+                                                                          cores=self.core_num.get(),
+                                                                          step=self.e_c_step.get(),
+                                                                          bulge=self.e_c_bulge.get(),
+                                                                          spike=self.e_c_spike.get(),
+                                                                          down_spike=self.e_c_dspike.get(),
+                                                                          offset=self.e_c_offset.get(),
+                                                                          ground_engine=self.ground_engine_lidar.get()
+                                                                          )
+                                        )
+        self.b_lidar_sweep.grid(sticky=W, row=30, column=3)
         
         #########################################################################
         
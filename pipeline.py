@@ -0,0 +1,375 @@
+"""
+Dependency-graph execution of the LiDAR processing workflow.
+
+Every processing step is a Stage that declares which directories (relative to the LiDAR data directory) it reads and
+writes. A stage depends on all stages that write one of the directories it reads, so independent branches (e.g. the
+coarse and the fine lasground_new chains) run concurrently. All running stages share one CoreBudget.
+
+If the graph is given a project directory, finished stages are recorded in manifests (see manifest.py) and stages whose
+inputs and parameters did not change since the last run are skipped, and a resource profile of the run is written (see
+profiling.py).
+"""
+
+import os
+import time
+import threading
+import contextlib
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import manifest
+import profiling
+
+
+logger = logging.getLogger(__name__)
+
+# process pool shared by the run_tasks calls of a context (see process_pool)
+_process_pool = contextvars.ContextVar('process_pool', default=None)
+
+
+class Stage:
+    """
+    A single step of the processing workflow
+
+    Args:
+        name (str): unique name of the stage
+        func (callable): runs the stage as func(cores), where cores is the number of cores granted by the scheduler.
+            May return a dict of results that later stages can look up in StageGraph.results[name]
+        inputs (list): directories read by the stage
+        outputs (list): directories written by the stage
+        cores (int): maximum number of cores the stage can make use of
+        description (str): message logged when the stage starts
+        params (dict): parameters that determine the stage outputs (recorded in the stage manifest)
+        sources (list): files read by the stage that are not produced by other stages (e.g. the original point clouds)
+        incremental (bool): the stage updates its outputs itself (e.g. only the tiles whose inputs changed), so they are
+            not deleted before it re-runs
+        plan (callable): returns the number of cores the stage can make use of at most, called when the stage is about
+            to start (e.g. from the number of tiles written by earlier stages, see resources.Planner)
+        reads (list): input directories with the points processed by the stage, if not all inputs (e.g. not those it
+            depends on for their results only); for the resource profile
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), cores=1, description='', params=None, sources=(),
+                 incremental=False, plan=None, reads=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cores = max(1, int(cores))
+        self.description = description
+        self.params = params or {}
+        self.sources = list(sources)
+        self.incremental = incremental
+        self.plan = plan
+        self.reads = self.inputs if reads is None else list(reads)
+
+    def wanted(self):
+        """returns the number of cores to request for the stage: cores, limited by plan"""
+        if self.plan is None:
+            return self.cores
+        try:
+            return max(1, min(self.cores, int(self.plan())))
+        except Exception as e:
+            logger.warning('Could not plan the cores of %s (%s), requesting %i' % (self.name, e, self.cores))
+            return self.cores
+
+    def depends_on(self, other):
+        """returns True if this stage reads a directory written by other"""
+        return any(manifest.within(i, o) or manifest.within(o, i) for i in self.inputs for o in other.outputs)
+
+    def __repr__(self):
+        return 'Stage(%s)' % self.name
+
+
+def run_tasks(func, tasks, workers, processes=False):
+    """
+    Runs func(*task) for every task on a pool of workers and returns the results in task order
+
+    Idle workers take the next pending task, so workers that finish early keep busy while others still work on
+    long-running tasks. Raises the first exception raised by any task after all tasks finished.
+
+    If processes is True, the workers are processes instead of threads, for CPU-bound Python work that holds the GIL
+    (func and the tasks must be picklable). No processes are started for a single worker or task, unless a shared
+    pool was opened with process_pool: then the tasks run on the processes of that pool.
+
+    The resource usage of every task is accounted to the stage of the caller (see profiling.run_measured).
+    """
+    tasks = list(tasks)
+    if processes and (_process_pool.get() is not None or (workers > 1 and len(tasks) > 1)):
+        shared = _process_pool.get()
+        with contextlib.nullcontext(shared) if shared is not None else \
+                ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            futures = [pool.submit(profiling.run_measured, func, task, True) for task in tasks]
+            wait(futures)
+        for f in futures:
+            if f.exception() is None:
+                profiling.record_task(f.result()[1])
+        return [f.result()[0] for f in futures]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # every task runs in a copy of the caller's context, so its commands are accounted to the caller's stage
+        futures = [pool.submit(contextvars.copy_context().run, _measured, func, task) for task in tasks]
+        wait(futures)
+    return [f.result() for f in futures]
+
+
+def _measured(func, task):
+    result, usage = profiling.run_measured(func, task)
+    profiling.record_task(usage)
+    return result
+
+
+@contextlib.contextmanager
+def process_pool(workers):
+    """
+    Opens a pool of worker processes shared by all run_tasks(..., processes=True) calls in this context
+
+    For threads that each run a few tasks at a time, such as the tiles of the per-tile classification chain: on their
+    own, their tasks would run in the calling thread, where all threads take turns holding the GIL. Threads started
+    by run_tasks inherit the pool.
+    """
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        token = _process_pool.set(pool)
+        try:
+            yield pool
+        finally:
+            _process_pool.reset(token)
+
+
+class CoreBudget:
+    """
+    Thread-safe pool of cores shared by all concurrently running stages
+
+    Args:
+        cores (int): total number of cores available
+    """
+
+    def __init__(self, cores):
+        self.total = max(1, int(cores))
+        self.free = self.total
+        self._cond = threading.Condition()
+
+    def acquire(self, wanted, share=1, block=False):
+        """
+        Grants up to wanted cores, leaving room for share - 1 other stages waiting to start
+
+        Returns the number of granted cores, or 0 if no core is free and block is False.
+        """
+        with self._cond:
+            while self.free == 0:
+                if not block:
+                    return 0
+                self._cond.wait()
+            granted = min(wanted, max(1, self.free // max(1, share)))
+            self.free -= granted
+            return granted
+
+    def release(self, cores):
+        """returns cores to the pool"""
+        with self._cond:
+            self.free = min(self.total, self.free + cores)
+            self._cond.notify_all()
+
+
+class StageGraph:
+    """
+    Directed acyclic graph of stages, executed by a scheduler that starts every stage as soon as all of its
+    dependencies have finished and cores are available
+
+    Args:
+        root (str): project directory the stage inputs/outputs are relative to. If given, stages are skipped when their
+            manifests show unchanged inputs and parameters, and re-run from scratch otherwise.
+    """
+
+    def __init__(self, root=None):
+        self.stages = []
+        self.results = {}
+        self.root = root
+        self.skipped = []
+        self.profile = []
+        # optional retention.Retention that retires outputs no longer needed and enforces a disk budget
+        self.retention = None
+        # stages that re-run without checking their manifests
+        self.force = set()
+
+    def add(self, stage):
+        """adds a stage to the graph and returns it"""
+        if stage.name in [s.name for s in self.stages]:
+            raise Exception('Duplicate stage name: %s' % stage.name)
+        self.stages.append(stage)
+        return stage
+
+    def dependencies(self, stage):
+        """returns the stages that must finish before stage can start"""
+        return [s for s in self.stages if s is not stage and stage.depends_on(s)]
+
+    def consumers(self, stage):
+        """returns the stages that read any output of stage"""
+        return [s for s in self.stages if s is not stage and s.depends_on(stage)]
+
+    def stage(self, name):
+        """returns the stage called name"""
+        for s in self.stages:
+            if s.name == name:
+                return s
+        raise KeyError(name)
+
+    def outputs(self):
+        """returns all output directories of the graph in stage order"""
+        return [o for s in self.stages for o in s.outputs]
+
+    def order(self):
+        """returns the stages in a topological order, raises an exception if the graph has a cycle"""
+        ordered = []
+        visiting = set()
+        visited = set()
+
+        def visit(stage):
+            if stage.name in visited:
+                return
+            if stage.name in visiting:
+                msg = 'Cyclic stage dependency involving %s' % stage.name
+                logger.error(msg)
+                raise Exception(msg)
+            visiting.add(stage.name)
+            for dep in self.dependencies(stage):
+                visit(dep)
+            visiting.discard(stage.name)
+            visited.add(stage.name)
+            ordered.append(stage)
+
+        for stage in self.stages:
+            visit(stage)
+        return ordered
+
+    def stale(self):
+        """
+        Returns the names of the stages that will run: stages that are forced or not up to date, all stages depending
+        on them, and the stages that wrote retired outputs read by any of these
+        """
+        stale = set()
+        changed = True
+        for stage in self.order():
+            if stage.name in self.force or any(d.name in stale for d in self.dependencies(stage)) or \
+                    not manifest.up_to_date(stage, self.root)[0]:
+                stale.add(stage.name)
+        while changed:
+            changed = False
+            for stage in self.order():
+                if stage.name in stale:
+                    continue
+                if any(d.name in stale for d in self.dependencies(stage)) or \
+                        (manifest.retired(stage, self.root) and any(c.name in stale for c in self.consumers(stage))):
+                    stale.add(stage.name)
+                    changed = True
+        return stale
+
+    def _run_stage(self, stage, cores):
+        record = profiling.start_stage(stage.name, cores)
+        try:
+            result, skipped = self._execute(stage, cores)
+        except Exception as e:
+            self._account(stage, record, error=str(e))
+            raise
+        self._account(stage, record, skipped)
+        return result
+
+    def _account(self, stage, record, skipped=False, error=None):
+        if self.root is None:
+            inputs, outputs = stage.sources, []
+        else:
+            inputs = [f for i in stage.reads for f in manifest.directory_files(os.path.join(self.root, i))]
+            inputs += [f for f in stage.sources if os.path.isfile(f)]
+            outputs = manifest.stage_outputs(stage, self.root)
+        self.profile.append(profiling.finish_stage(record, inputs, outputs, skipped, error))
+
+    def _execute(self, stage, cores):
+        if self.root is not None and stage.outputs and stage.name not in self.force:
+            current, info = manifest.up_to_date(stage, self.root, workers=cores)
+            if current:
+                logger.info('Skipping %s (up to date)' % stage.name)
+                self.skipped.append(stage.name)
+                return info, True
+            if any(manifest.directory_files(os.path.join(self.root, o)) for o in stage.outputs):
+                logger.info('Re-running %s (%s)' % (stage.name, info))
+        if self.root is not None and not stage.incremental:
+            manifest.clear_outputs(stage, self.root)
+
+        if stage.description:
+            logger.info(stage.description)
+        start = time.time()
+        result = stage.func(cores) or {}
+
+        if self.root is not None and stage.outputs:
+            manifest.write_manifests(stage, self.root, result, workers=cores)
+        logger.info('OK (%s, %.1f s)' % (stage.name, time.time() - start))
+        return result, False
+
+    def run(self, budget):
+        """
+        Runs all stages, executing independent stages in parallel
+
+        Args:
+            budget (CoreBudget or int): cores shared by all running stages
+        """
+        if not isinstance(budget, CoreBudget):
+            budget = CoreBudget(budget)
+
+        start = time.time()
+        stages = self.order()
+        deps = {s.name: set(d.name for d in self.dependencies(s)) for s in stages}
+        if self.root is not None and (self.retention or any(manifest.retired(s, self.root) for s in stages)):
+            stale = self.stale()
+            if any(manifest.retired(s, self.root) for s in stages):
+                # outputs of retired stages are gone, so stages must not be skipped based on re-created inputs
+                self.force = stale
+            if self.retention:
+                self.retention.check(stale)
+        done = set(self.results)
+        started = set(done)
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+            while True:
+                ready = [] if error else [s for s in stages if s.name not in started and deps[s.name] <= done]
+                for i, stage in enumerate(ready):
+                    if self.retention and not self.retention.admit(stage, [s for s, c in running.values()]):
+                        if running:
+                            break
+                        # nothing left to wait for but retirements in progress
+                        self.retention.flush()
+                        if not self.retention.admit(stage, []):
+                            error = Exception('Stage %s does not fit into the disk budget' % stage.name)
+                            logger.error(str(error))
+                            break
+                    # block for cores only if nothing of this graph is running, otherwise wait for a stage to finish
+                    cores = budget.acquire(stage.wanted(), share=len(ready) - i, block=not running)
+                    if cores == 0:
+                        break
+                    started.add(stage.name)
+                    running[pool.submit(self._run_stage, stage, cores)] = (stage, cores)
+
+                if not running:
+                    break
+
+                # time out regularly so that cores freed by other graphs sharing the budget get picked up
+                finished, _ = wait(list(running), timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, cores = running.pop(future)
+                    budget.release(cores)
+                    try:
+                        self.results[stage.name] = future.result()
+                        done.add(stage.name)
+                        if self.retention:
+                            self.retention.finished(stage)
+                    except Exception as e:
+                        logger.error('Stage %s failed: %s' % (stage.name, e))
+                        error = error or e
+
+        if self.retention:
+            self.retention.close()
+        if self.root is not None:
+            profiling.write_profile(self.profile, self.root, time.time() - start)
+        if error:
+            raise error
+        return self.results
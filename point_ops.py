@@ -0,0 +1,550 @@
+"""
+In-process operations on the point records of .las files.
+
+These replace LAStools runs that only reorganize points (without classifying them), so that every file is read once
+instead of once per output.
+"""
+
+import os
+import json
+import struct
+import shutil
+import tempfile
+import logging
+import numpy as np
+import manifest
+from pipeline import run_tasks
+from spatial_index import BoxIndex, file_boxes, tile_range
+from las_io import read_header, read_vlrs, read_points, point_dtype, readable, LasReader, LasWriter, iter_chunks, \
+    scaled, rescale
+
+
+logger = logging.getLogger(__name__)
+
+
+def split_classes(filename, odirs, chunk_points=2 ** 21):
+    """
+    Writes the points of every class to its own .las file in a single pass over filename
+
+    Args:
+        filename (str): .las file to split
+        odirs (dict): output directory by class code. Every output file gets the basename of filename (with .las
+            extension); points of classes not in odirs are dropped. Classes without points get no output file.
+        chunk_points (int): number of point records processed at once
+
+    Returns dict with the number of points written by class code.
+    """
+    reader = LasReader(filename)
+    name = os.path.splitext(os.path.basename(filename))[0] + '.las'
+    writers = {}
+    try:
+        for chunk in reader.chunks(chunk_points):
+            codes = reader.classification(chunk)
+            for code, odir in odirs.items():
+                selected = chunk[codes == code]
+                if len(selected) == 0:
+                    continue
+                if code not in writers:
+                    writers[code] = reader.writer(os.path.join(odir, name))
+                writers[code].write(selected)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {code: writers[code].count if code in writers else 0 for code in odirs}
+
+
+def xy_keys(points):
+    """returns one int64 key per point record, equal for records with the same integer X and Y"""
+    return (points['X'].astype(np.int64) << 32) | (points['Y'].astype(np.int64) & 0xFFFFFFFF)
+
+
+def lowest_z(points):
+    """returns the sorted indices of the record with the lowest Z for every distinct (X, Y) of points"""
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    keys = xy_keys(points)
+    order = np.lexsort((points['Z'], keys))
+    keys = keys[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return np.sort(order[first])
+
+
+def _write_lowest_z(path, dtype, writer, memory_points):
+    """writes the lowest-z records of the raw record file path; files larger than memory_points are partitioned"""
+    count = os.path.getsize(path) // dtype.itemsize
+    if count <= memory_points:
+        points = np.fromfile(path, dtype=dtype)
+        writer.write(points[lowest_z(points)])
+        return
+
+    # external mode: all records with the same (X, Y) end up in the same partition, every partition fits in memory
+    parts = int(np.ceil(2.0 * count / memory_points))
+    pdir = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.dedup_')
+    try:
+        records = np.memmap(path, dtype=dtype, mode='r')
+        for chunk in iter_chunks(records, memory_points):
+            keys = xy_keys(chunk)
+            # mix the bits of the key, so that neighbouring points spread evenly over the partitions
+            part = ((keys * 0x9E3779B1) >> 16) % parts
+            order = np.argsort(part, kind='stable')
+            bounds = np.searchsorted(part[order], np.arange(parts + 1))
+            for i in range(parts):
+                if bounds[i + 1] > bounds[i]:
+                    with open(os.path.join(pdir, '%i.bin' % i), 'ab') as f:
+                        f.write(np.ascontiguousarray(chunk[order[bounds[i]:bounds[i + 1]]]).tobytes())
+        del records
+        for i in range(parts):
+            part_path = os.path.join(pdir, '%i.bin' % i)
+            if os.path.exists(part_path):
+                _write_lowest_z(part_path, dtype, writer,
+                                max(memory_points, os.path.getsize(part_path) // dtype.itemsize))
+    finally:
+        shutil.rmtree(pdir, ignore_errors=True)
+
+
+def remove_duplicates(filename, ofilename, memory_points=2 ** 25):
+    """
+    Writes the points of filename to ofilename, keeping only the point with the lowest z of all points with the same
+    x and y (like lasduplicate -lowest_z)
+
+    Args:
+        filename (str): input .las file
+        ofilename (str): output .las file
+        memory_points (int): files with more points are deduplicated in partitions of at most this size
+    """
+    header, points = read_points(filename)
+    with LasWriter(ofilename, header) as writer:
+        if header.point_count <= memory_points:
+            writer.write(points[lowest_z(points)])
+        else:
+            del points
+            with open(filename, 'rb') as f:
+                f.seek(header.offset_to_points)
+                tmp = ofilename + '.records'
+                with open(tmp, 'wb') as out:
+                    shutil.copyfileobj(f, out)
+                    out.truncate(header.point_count * header.record_length)
+            try:
+                _write_lowest_z(tmp, writer.dtype, writer, memory_points)
+            finally:
+                os.remove(tmp)
+    return writer.count
+
+
+def mergeable(files):
+    """returns True if all files can be read natively and share point format and record length"""
+    headers = [read_header(f) for f in files]
+    return all(readable(f) for f in files) and \
+        len(set((h.point_format, h.record_length) for h in headers)) <= 1
+
+
+# variable length record of lastile holding the tile bounds: level, level index, implicit levels (30 bits), buffer flag,
+# reversible flag, min x, max x, min y, max y
+TILE_VLR = ('LAStools', 10)
+_TILE_FORMAT = '<III4f'
+
+
+def tile_vlr(bounds, buffer=False):
+    """returns the lastile tiling VLR (user_id, record_id, description, data) for tile bounds (min x, max x, min y,
+    max y)"""
+    flags = (1 << 30 if buffer else 0)
+    return TILE_VLR + ('LAStiling (c) by rapidlasso', struct.pack(_TILE_FORMAT, 0, 0, flags, *bounds))
+
+
+def tile_bounds(filename):
+    """returns the tile bounds (min x, max x, min y, max y) and buffer flag stored by lastile, or None"""
+    for user_id, record_id, description, data in read_vlrs(filename):
+        if (user_id, record_id) == TILE_VLR and len(data) >= struct.calcsize(_TILE_FORMAT):
+            level, index, flags, min_x, max_x, min_y, max_y = struct.unpack_from(_TILE_FORMAT, data)
+            return (min_x, max_x, min_y, max_y), bool(flags & (1 << 30))
+    return None
+
+
+def remove_buffer(filename, ofilename):
+    """
+    Writes the points of a buffered tile without its buffer to ofilename (like lastile -remove_buffer)
+
+    The tile bounds are read from the tiling VLR. Returns the number of points written.
+    """
+    stored = tile_bounds(filename)
+    if stored is None:
+        msg = '%s has no tile bounds' % filename
+        logger.error(msg)
+        raise Exception(msg)
+    min_x, max_x, min_y, max_y = stored[0]
+    reader = LasReader(filename)
+    with reader.writer(ofilename, vlrs=[tile_vlr(stored[0])]) as writer:
+        for chunk in reader.chunks():
+            x, y = reader.x(chunk), reader.y(chunk)
+            writer.write(chunk[(x >= min_x) & (x < max_x) & (y >= min_y) & (y < max_y)])
+    return writer.count
+
+
+# file in the output directory of merge_tiles recording the inputs of every tile (incremental mode)
+TILE_INDEX_NAME = 'tile_index.json'
+
+
+def plan_tiles(files, tile_size, buffer=0):
+    """
+    Returns the tiles of tile_size that files with points overlap, and the files overlapping every tile
+
+    The overlaps are found with a spatial index over the header bounding boxes of the files (see spatial_index.py).
+    Returns dict of tile (tx, ty) -> sorted indices into files of the files overlapping the tile grown by buffer.
+    """
+    counts = [read_header(f).point_count for f in files]
+    boxes = file_boxes(files)
+    index = BoxIndex(boxes)
+    tiles = set()
+    for box, count in zip(boxes, counts):
+        if count:
+            x0, y0, x1, y1 = tile_range(box, tile_size)
+            tiles.update((tx, ty) for tx in range(x0, x1 + 1) for ty in range(y0, y1 + 1))
+    # the index finds files touching a tile, their tile ranges tell if they hold points of it (points on the upper
+    # edge of a tile belong to the next tile)
+    ranges = [tile_range(box, tile_size, buffer) for box in boxes]
+    plan = {}
+    for tx, ty in sorted(tiles):
+        box = (tx * tile_size - buffer, ty * tile_size - buffer, (tx + 1) * tile_size + buffer,
+               (ty + 1) * tile_size + buffer)
+        plan[(tx, ty)] = [int(i) for i in index.query(box) if counts[i] and
+                          ranges[i][0] <= tx <= ranges[i][2] and ranges[i][1] <= ty <= ranges[i][3]]
+    return plan
+
+
+def _tile_masks(v, k, tile_size, buffer):
+    """returns the masks of coordinates v (of one axis) in tile k including its buffer, and in tile k itself"""
+    t = np.floor(v / tile_size)
+    own = t == k
+    if buffer <= 0:
+        return own, own
+    f = v - t * tile_size
+    return own | ((t == k - 1) & (f >= tile_size - buffer)) | ((t == k + 1) & (f < buffer)), own
+
+
+def _merge_chunks(filename, index, template, dtype, files_are_flightlines, chunk_points):
+    """yields the records of an input of merge_tiles in chunks, converted to scale and offset of template"""
+    h, points = read_points(filename)
+    for chunk in iter_chunks(points, chunk_points):
+        chunk = rescale(np.array(chunk, dtype=dtype), h, template)
+        if files_are_flightlines:
+            chunk['point_source_id'] = index + 1
+        yield chunk
+
+
+def _split_file(filename, index, spill, template, dtype, tile_size, buffer, files_are_flightlines, chunk_points):
+    """spills the records of an input of merge_tiles to <spill>/<tx>_<ty>/<index>.bin for every tile (including
+    buffers), returns the set of tiles with points of their own"""
+    interior = set()
+    for chunk in _merge_chunks(filename, index, template, dtype, files_are_flightlines, chunk_points):
+        x = scaled(chunk, template, 'X')
+        y = scaled(chunk, template, 'Y')
+        tx = np.floor(x / tile_size).astype(np.int64)
+        ty = np.floor(y / tile_size).astype(np.int64)
+        # points near the tile edges also go to the neighbouring tiles (dx, dy)
+        fx = x - tx * tile_size
+        fy = y - ty * tile_size
+        near_x = {-1: fx < buffer, 0: None, 1: fx >= tile_size - buffer}
+        near_y = {-1: fy < buffer, 0: None, 1: fy >= tile_size - buffer}
+        for dx in (-1, 0, 1) if buffer > 0 else (0,):
+            for dy in (-1, 0, 1) if buffer > 0 else (0,):
+                masks = [m for m in (near_x[dx], near_y[dy]) if m is not None]
+                select = np.logical_and.reduce(masks) if masks else slice(None)
+                kx = tx[select] + dx
+                ky = ty[select] + dy
+                records = chunk[select]
+                keys = (kx << 32) | (ky & 0xFFFFFFFF)
+                order = np.argsort(keys, kind='stable')
+                keys = keys[order]
+                starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else []
+                for start, end in zip(starts, np.r_[starts[1:], len(keys)]):
+                    key = (int(kx[order[start]]), int(ky[order[start]]))
+                    tdir = os.path.join(spill, '%i_%i' % key)
+                    if not os.path.isdir(tdir):
+                        os.makedirs(tdir, exist_ok=True)
+                    with open(os.path.join(tdir, '%i.bin' % index), 'ab') as f:
+                        f.write(records[order[start:end]].tobytes())
+                    if dx == dy == 0:
+                        interior.add(key)
+    return interior
+
+
+def _read_tile_index(odir):
+    try:
+        with open(os.path.join(odir, TILE_INDEX_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def merge_tiles(files, odir, tile_size, lowest_z_only=False, files_are_flightlines=True, memory_points=2 ** 24,
+                prefix='tile', workers=1, buffer=0, incremental=False, max_reads=4):
+    """
+    Merges files into square tiles of tile_size, optionally removing duplicate points in the same pass
+
+    The counterpart of lastile -tile_size <tile_size> [-buffer <buffer>] -faf (followed by lasduplicate -lowest_z).
+    The output tiles and the files overlapping them are planned with a spatial index over the file headers (see
+    plan_tiles), then every tile is written to odir as <prefix>_<min x>_<min y>.las from the files overlapping it, with
+    workers tiles in parallel. Files overlapping more than max_reads tiles are split into one temporary record file
+    per tile in a single pass beforehand instead of being read once per tile. Like lastile, the tile bounds are stored
+    in a variable length record. Coordinates of files with a different scale or offset than the first file are
+    converted to the scale and offset of the first file.
+
+    In incremental mode, the inputs of every tile (path and content hash) are recorded in tile_index.json in odir.
+    When merging again, tiles whose inputs and settings did not change are kept, all other files in odir are deleted
+    and their tiles written again.
+
+    Args:
+        files (list): .las files with the same point format (see mergeable)
+        odir (str): output directory
+        tile_size (float): tile edge length, tiles are aligned to multiples of tile_size
+        lowest_z_only (bool): keep only the lowest point of all points with the same x and y
+        files_are_flightlines (bool): set the point source ID of every point to the (1-based) index of its file
+        memory_points (int): number of records read at once, also the limit for in-memory deduplication of a tile
+        prefix (str): output file name prefix
+        workers (int): number of tiles written in parallel
+        buffer (float): points closer than buffer to a neighbouring tile are also written to the neighbouring tile
+        incremental (bool): only write tiles whose inputs changed since the last merge to odir
+        max_reads (int): files overlapping more tiles are split in one pass
+
+    Returns list of the tiles in odir.
+    """
+    if not files:
+        return []
+    template = read_header(files[0])
+    dtype = point_dtype(template.point_format, template.record_length)
+    plan = plan_tiles(files, tile_size, buffer)
+    names = {key: os.path.join(odir, '%s_%i_%i.las' % (prefix, round(key[0] * tile_size), round(key[1] * tile_size)))
+             for key in plan}
+
+    keep = set()
+    if incremental:
+        settings = [tile_size, buffer, lowest_z_only, files_are_flightlines, prefix, template.point_format,
+                    template.scale, template.offset]
+        signatures = {key: json.loads(json.dumps([settings] + [
+            [os.path.relpath(files[i], odir), i, manifest.file_record(files[i])['hash']] for i in inputs]))
+            for key, inputs in plan.items()}
+        previous = _read_tile_index(odir)
+        for key, signature in signatures.items():
+            recorded = previous.get(os.path.basename(names[key]))
+            if recorded and recorded['inputs'] == signature and recorded['written'] == os.path.isfile(names[key]):
+                keep.add(key)
+        if keep:
+            logger.info('Keeping %i of %i tiles with unchanged inputs' % (len(keep), len(plan)))
+        kept = set(os.path.basename(names[key]) for key in keep)
+        for name in os.listdir(odir):
+            if name not in kept and os.path.isfile(os.path.join(odir, name)):
+                os.remove(os.path.join(odir, name))
+
+    todo = [key for key in sorted(plan) if key not in keep]
+    reads = {}
+    for key in todo:
+        for i in plan[key]:
+            reads[i] = reads.get(i, 0) + 1
+    split = set(i for i, n in reads.items() if n > max_reads)
+    spill = tempfile.mkdtemp(dir=odir, prefix='.merge_')
+
+    try:
+        interior = set()
+        for tiles in run_tasks(_split_file, [(files[i], i, spill, template, dtype, tile_size, buffer,
+                                              files_are_flightlines, memory_points) for i in sorted(split)], workers):
+            interior |= tiles
+
+        def chunks(key):
+            # records of the tile (including its buffer) from all files overlapping it, in file order, each with a
+            # flag telling if it holds points of the tile itself
+            for i in plan[key]:
+                if i in split:
+                    path = os.path.join(spill, '%i_%i' % key, '%i.bin' % i)
+                    if os.path.exists(path):
+                        for chunk in iter_chunks(np.memmap(path, dtype=dtype, mode='r'), memory_points):
+                            yield np.array(chunk), key in interior
+                    continue
+                for chunk in _merge_chunks(files[i], i, template, dtype, files_are_flightlines, memory_points):
+                    select_x, own_x = _tile_masks(scaled(chunk, template, 'X'), key[0], tile_size, buffer)
+                    select_y, own_y = _tile_masks(scaled(chunk, template, 'Y'), key[1], tile_size, buffer)
+                    select = select_x & select_y
+                    if select.any():
+                        yield chunk[select], bool((own_x & own_y).any())
+
+        def write(key):
+            # the records of a tile are collected in memory, or in a temporary record file if there are too many
+            pending = []
+            count = 0
+            own = False
+            tmp = os.path.join(spill, '%i_%i.records' % key)
+            for chunk, own_points in chunks(key):
+                own = own or own_points
+                pending.append(chunk)
+                count += len(chunk)
+                if count > memory_points:
+                    with open(tmp, 'ab') as f:
+                        for c in pending:
+                            f.write(c.tobytes())
+                    pending = []
+                    count = 0
+            if not own:
+                # only buffer points, no tile
+                return False
+
+            bounds = (key[0] * tile_size, (key[0] + 1) * tile_size, key[1] * tile_size, (key[1] + 1) * tile_size)
+            with LasWriter(names[key], template, vlrs=[tile_vlr(bounds, buffer > 0)]) as writer:
+                if os.path.exists(tmp):
+                    with open(tmp, 'ab') as f:
+                        for c in pending:
+                            f.write(c.tobytes())
+                    if lowest_z_only:
+                        _write_lowest_z(tmp, dtype, writer, memory_points)
+                    else:
+                        for chunk in iter_chunks(np.memmap(tmp, dtype=dtype, mode='r'), memory_points):
+                            writer.write(np.array(chunk))
+                else:
+                    points = np.concatenate(pending) if pending else np.zeros(0, dtype)
+                    writer.write(points[lowest_z(points)] if lowest_z_only else points)
+            return True
+
+        run_tasks(write, [(key,) for key in todo], workers)
+    finally:
+        shutil.rmtree(spill, ignore_errors=True)
+
+    if incremental:
+        index = {os.path.basename(names[key]): {'inputs': signatures[key], 'written': os.path.isfile(names[key])}
+                 for key in plan}
+        with open(os.path.join(odir, TILE_INDEX_NAME), 'w') as f:
+            json.dump(index, f, indent=1)
+    return [names[key] for key in sorted(plan) if os.path.isfile(names[key])]
+
+
+class TileLocator:
+    """
+    Finds the tile of points among square tiles of different sizes, each aligned to multiples of its size (such as the
+    tiles of tiling.plan_quadtree)
+
+    Args:
+        tiles (list): tile bounds (min x, max x, min y, max y), not overlapping each other
+    """
+
+    def __init__(self, tiles):
+        self.tiles = [tuple(float(v) for v in t) for t in tiles]
+        bounds = np.array(self.tiles).reshape(-1, 4)
+        sizes = bounds[:, 1] - bounds[:, 0]
+        # sorted keys (position in the grid of their size) of the tiles of every size
+        self.levels = []
+        for size in np.unique(sizes):
+            indices = np.flatnonzero(sizes == size)
+            keys = self._keys(bounds[indices, 0] + size / 2, bounds[indices, 2] + size / 2, size)
+            order = np.argsort(keys)
+            self.levels.append((size, keys[order], indices[order]))
+
+    @staticmethod
+    def _keys(x, y, size):
+        return (np.floor(x / size).astype(np.int64) << 32) | (np.floor(y / size).astype(np.int64) & 0xFFFFFFFF)
+
+    def locate(self, x, y):
+        """returns the index of the tile of every point (x, y), -1 for points outside all tiles"""
+        index = np.full(len(x), -1, dtype=np.int64)
+        for size, keys, indices in self.levels:
+            k = self._keys(x, y, size)
+            i = np.minimum(np.searchsorted(keys, k), len(keys) - 1)
+            found = keys[i] == k
+            index[found] = indices[i[found]]
+        return index
+
+
+def _split_to_tiles(filename, index, spill, template, dtype, locator, buffer, files_are_flightlines, chunk_points):
+    """spills the records of an input of tile_files to <spill>/<tile>/<index>.bin for every tile (including buffers),
+    returns the set of tiles with points of their own"""
+    interior = set()
+    bounds = np.array(locator.tiles).reshape(-1, 4)
+    for chunk in _merge_chunks(filename, index, template, dtype, files_are_flightlines, chunk_points):
+        x = scaled(chunk, template, 'X')
+        y = scaled(chunk, template, 'Y')
+        own = locator.locate(x, y)
+        if (own < 0).any():
+            msg = '%i points of %s are outside the planned tiles' % ((own < 0).sum(), filename)
+            logger.error(msg)
+            raise Exception(msg)
+        points = [np.arange(len(x))]
+        tiles = [own]
+        if buffer > 0:
+            # points closer than buffer to the edge of their tile also go to the tiles found at buffer distance (tiles
+            # are at least buffer wide, so every tile whose buffer holds a point is found)
+            b = bounds[own]
+            near = np.flatnonzero((x - b[:, 0] < buffer) | (b[:, 1] - x <= buffer) | (y - b[:, 2] < buffer) |
+                                  (b[:, 3] - y <= buffer))
+            for dx in (-buffer, 0, buffer):
+                for dy in (-buffer, 0, buffer):
+                    if dx == dy == 0:
+                        continue
+                    other = locator.locate(x[near] + dx, y[near] + dy)
+                    select = (other >= 0) & (other != own[near])
+                    points.append(near[select])
+                    tiles.append(other[select])
+        points, tiles = np.concatenate(points), np.concatenate(tiles)
+        # a point reaches a neighbouring tile through up to three probes
+        pairs = np.unique(tiles * len(x) + points)
+        tiles, points = pairs // len(x), pairs % len(x)
+        starts = np.flatnonzero(np.r_[True, tiles[1:] != tiles[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(tiles)]):
+            tile = int(tiles[start])
+            tdir = os.path.join(spill, str(tile))
+            os.makedirs(tdir, exist_ok=True)
+            with open(os.path.join(tdir, '%i.bin' % index), 'ab') as f:
+                f.write(chunk[points[start:end]].tobytes())
+        interior.update(int(t) for t in np.unique(own))
+    return interior
+
+
+def tile_files(files, odir, tiles, buffer=0, files_are_flightlines=True, memory_points=2 ** 24, prefix='tile',
+               workers=1):
+    """
+    Writes the points of files to tiles of different sizes, each with a buffer
+
+    The counterpart of lastile -buffer <buffer> -faf for a list of tiles instead of one tile size, such as the tiles of
+    tiling.plan_quadtree. Every file is read once and its points are spilled to one temporary record file per tile
+    (including the points in the buffers of neighbouring tiles), then every tile with points of its own is written to
+    odir as <prefix>_<min x>_<min y>.las, with workers files and tiles in parallel. Like lastile, the tile bounds are
+    stored in a variable length record, so the buffer can be removed again (see remove_buffer). Coordinates of files
+    with a different scale or offset than the first file are converted to the scale and offset of the first file.
+
+    Args:
+        files (list): .las files with the same point format (see mergeable)
+        odir (str): output directory
+        tiles (list): tile bounds (min x, max x, min y, max y) of squares aligned to multiples of their size, at least
+            buffer wide and not overlapping each other. All points of files must lie in a tile.
+        buffer (float): width of the tile buffer
+        files_are_flightlines (bool): set the point source ID of every point to the (1-based) index of its file
+        memory_points (int): number of records read at once
+        prefix (str): output file name prefix
+        workers (int): number of files and tiles processed in parallel
+
+    Returns list of the tiles written.
+    """
+    if not files:
+        return []
+    template = read_header(files[0])
+    dtype = point_dtype(template.point_format, template.record_length)
+    locator = TileLocator(tiles)
+    spill = tempfile.mkdtemp(dir=odir, prefix='.tile_')
+    try:
+        interior = set()
+        tasks = [(f, i, spill, template, dtype, locator, buffer, files_are_flightlines, memory_points)
+                 for i, f in enumerate(files)]
+        for written in run_tasks(_split_to_tiles, tasks, workers):
+            interior |= written
+
+        def write(tile):
+            bounds = locator.tiles[tile]
+            name = os.path.join(odir, '%s_%i_%i.las' % (prefix, round(bounds[0]), round(bounds[2])))
+            with LasWriter(name, template, vlrs=[tile_vlr(bounds, buffer > 0)]) as writer:
+                for i in range(len(files)):
+                    path = os.path.join(spill, str(tile), '%i.bin' % i)
+                    if os.path.exists(path):
+                        for chunk in iter_chunks(np.memmap(path, dtype=dtype, mode='r'), memory_points):
+                            writer.write(np.array(chunk))
+            return name
+
+        names = run_tasks(write, [(tile,) for tile in sorted(interior)], workers)
+    finally:
+        shutil.rmtree(spill, ignore_errors=True)
+    return sorted(names)
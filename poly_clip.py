@@ -0,0 +1,203 @@
+"""
+Native point-in-polygon clipping of .las files against polygon shapefiles.
+
+The polygon edges are sorted into horizontal bands (an interval index over y), so that every point is only tested
+against the few edges whose y-range overlaps its band instead of all edges of the polygon. Inside/outside is decided
+by counting the edges crossed by a ray in +x direction: a point lies inside a shape if it crosses an odd number of
+edges of the shape's rings, so holes ("donuts") need no special treatment. A point is inside the polygons if it lies
+inside any of the shapes.
+"""
+
+import os
+import struct
+import threading
+import logging
+import numpy as np
+from las_io import LasReader
+
+
+logger = logging.getLogger(__name__)
+
+# shapefile shape types with polygon geometry: Polygon, PolygonZ, PolygonM
+_POLYGON_TYPES = (5, 15, 25)
+
+# polygon indices by absolute path of the shapefile, with the (size, mtime) of the file when it was read
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def read_shapefile(filename):
+    """
+    Returns the rings of all polygons in a shapefile (.shp) as list of (shape number, list of (n, 2) vertex arrays)
+
+    Z and M values are ignored. Null shapes are skipped.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < 100 or struct.unpack_from('>i', data, 0)[0] != 9994:
+        msg = '%s is not a shapefile' % filename
+        logger.error(msg)
+        raise Exception(msg)
+
+    shapes = []
+    pos = 100
+    while pos + 8 <= len(data):
+        number, length = struct.unpack_from('>ii', data, pos)
+        content = pos + 8
+        pos = content + 2 * length
+        shape_type = struct.unpack_from('<i', data, content)[0]
+        if shape_type == 0:
+            continue
+        if shape_type not in _POLYGON_TYPES:
+            msg = '%s contains shapes of type %i, only polygons are supported' % (filename, shape_type)
+            logger.error(msg)
+            raise Exception(msg)
+        num_parts, num_points = struct.unpack_from('<ii', data, content + 36)
+        parts = list(struct.unpack_from('<%ii' % num_parts, data, content + 44)) + [num_points]
+        points = np.frombuffer(data, dtype='<f8', count=2 * num_points,
+                               offset=content + 44 + 4 * num_parts).reshape(-1, 2)
+        shapes.append((number, [points[parts[i]:parts[i + 1]] for i in range(num_parts)]))
+    return shapes
+
+
+class PolygonIndex:
+    """
+    Band index over the edges of a set of polygons for vectorized point-in-polygon tests
+
+    Args:
+        shapes (list): (shape number, rings) as returned by read_shapefile
+        edges_per_band (int): targeted average number of edges per band
+    """
+
+    def __init__(self, shapes, edges_per_band=8):
+        x0, y0, x1, y1, shape = [], [], [], [], []
+        for i, (number, rings) in enumerate(shapes):
+            for ring in rings:
+                if len(ring) < 2:
+                    continue
+                # close the ring, the closing vertex of shapefile rings is usually a repetition of the first
+                closed = np.vstack([ring, ring[:1]])
+                x0.append(closed[:-1, 0])
+                y0.append(closed[:-1, 1])
+                x1.append(closed[1:, 0])
+                y1.append(closed[1:, 1])
+                shape.append(np.full(len(ring), i))
+
+        self.shapes = len(shapes)
+        if not x0:
+            self.edges = 0
+            return
+        x0, y0, x1, y1, shape = [np.concatenate(a) for a in (x0, y0, x1, y1, shape)]
+        # horizontal edges are never crossed by a horizontal ray
+        keep = y0 != y1
+        self.x0, self.y0, self.x1, self.y1, self.shape = x0[keep], y0[keep], x1[keep], y1[keep], shape[keep]
+        self.edges = len(self.x0)
+        if not self.edges:
+            return
+
+        self.xmin, self.xmax = min(self.x0.min(), self.x1.min()), max(self.x0.max(), self.x1.max())
+        self.ymin, self.ymax = min(self.y0.min(), self.y1.min()), max(self.y0.max(), self.y1.max())
+        self.bands = max(1, self.edges // edges_per_band)
+        self.band_height = (self.ymax - self.ymin) / self.bands or 1.0
+
+        # every edge is listed in all bands its y-range overlaps (CSR layout: band_start[b]:band_start[b + 1])
+        lo = self._band(np.minimum(self.y0, self.y1))
+        hi = self._band(np.maximum(self.y0, self.y1))
+        counts = hi - lo + 1
+        edge = np.repeat(np.arange(self.edges), counts)
+        band = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = np.argsort(band, kind='stable')
+        self.band_edges = edge[order]
+        self.band_start = np.searchsorted(band[order], np.arange(self.bands + 1))
+
+    def _band(self, y):
+        return np.clip(((y - self.ymin) / self.band_height).astype(np.int64), 0, self.bands - 1)
+
+    def contains(self, x, y, chunk_pairs=2 ** 22):
+        """
+        Returns a boolean array, True for every point (x, y) inside any of the polygons
+
+        Args:
+            x, y (numpy.ndarray): point coordinates
+            chunk_pairs (int): maximum number of (point, edge) pairs tested at once
+        """
+        inside = np.zeros(len(x), dtype=bool)
+        if not self.edges or not len(x):
+            return inside
+
+        candidates = np.flatnonzero((x >= self.xmin) & (x <= self.xmax) & (y >= self.ymin) & (y <= self.ymax))
+        band = self._band(y[candidates])
+        counts = self.band_start[band + 1] - self.band_start[band]
+        ends = np.cumsum(counts)
+
+        start = 0
+        while start < len(candidates):
+            # process as many points as fit into chunk_pairs (at least one)
+            stop = max(start + 1, np.searchsorted(ends, (ends[start - 1] if start else 0) + chunk_pairs, 'right'))
+            c = counts[start:stop]
+            local = np.repeat(np.arange(stop - start), c)
+            first = self.band_start[band[start:stop]]
+            edge = self.band_edges[np.repeat(first, c) + np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)]
+
+            px = x[candidates[start:stop]][local]
+            py = y[candidates[start:stop]][local]
+            y0, y1 = self.y0[edge], self.y1[edge]
+            straddles = (y0 > py) != (y1 > py)
+            local, edge, px, py, y0, y1 = [a[straddles] for a in (local, edge, px, py, y0, y1)]
+            x0, x1 = self.x0[edge], self.x1[edge]
+            crosses = px < x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+
+            # a point is inside a shape if its ray crosses an odd number of the shape's edges
+            keys = local[crosses] * self.shapes + self.shape[edge[crosses]]
+            keys, n = np.unique(keys, return_counts=True)
+            inside[candidates[start:stop][keys[n % 2 == 1] // self.shapes]] = True
+            start = stop
+        return inside
+
+
+def polygon_index(filename):
+    """returns the PolygonIndex of a shapefile, cached until the file changes"""
+    key = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = (st.st_size, st.st_mtime_ns)
+    with _indices_lock:
+        cached = _indices.get(key)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    index = PolygonIndex(read_shapefile(filename))
+    with _indices_lock:
+        _indices[key] = (stamp, index)
+    return index
+
+
+def clip_file(filename, index, inside=None, outside=None, chunk_points=2 ** 21):
+    """
+    Writes the points of a .las file inside and/or outside of polygons, classifying every point only once
+
+    Args:
+        filename (str): .las file
+        index (PolygonIndex): polygons to clip with (see polygon_index)
+        inside (str): .las file for the points inside the polygons (like lasclip -poly), or None
+        outside (str): .las file for the points outside the polygons (like lasclip -poly -interior), or None
+
+    Output files are only written if they receive points. Returns the number of points (inside, outside).
+    """
+    reader = LasReader(filename)
+    writers = {}
+    counts = {True: 0, False: 0}
+    try:
+        for chunk in reader.chunks(chunk_points):
+            mask = index.contains(reader.x(chunk), reader.y(chunk))
+            for side, ofilename in ((True, inside), (False, outside)):
+                selected = chunk[mask == side]
+                counts[side] += len(selected)
+                if ofilename is None or len(selected) == 0:
+                    continue
+                if side not in writers:
+                    writers[side] = reader.writer(ofilename)
+                writers[side].write(selected)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return counts[True], counts[False]
@@ -0,0 +1,219 @@
+"""
+Resource accounting of the LiDAR processing stages.
+
+While a stage runs, every command started through file_functions.run_command is recorded with its wall time and, on
+POSIX systems, the CPU time, peak memory and block I/O of the child process (from os.wait4). The native steps run by
+pipeline.run_tasks are measured the same way, from the resource usage of the worker thread (Linux) or worker process
+that ran them, and summed per stage, as is the work of the stage's own thread. The bytes read and written by a stage
+are the blocks its commands and native steps read from and wrote to storage (reads served from the page cache do not
+count). Where these counters are not available (Windows), the sizes of the input and output files are used instead.
+When the stage finished, the point counts of its inputs and outputs are added. The profile of a run is written as JSON
+to the project directory and summarized as a table in the log.
+
+Linux reports the peak memory of a child as at least the memory of the Python process it was forked from, so the memory
+of this process at the start of a command is recorded with it. The memory per point measured for every tool (see
+resources.memory_rates) is kept in the profile across runs: a run that measures nothing for a tool, e.g. because all
+stages were up to date, keeps the measurement of an earlier run.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+import logging
+from las_io import read_header
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_NAME = 'run_profile.json'
+
+# bytes per block of ru_inblock and ru_oublock
+BLOCK_SIZE = 512
+
+# record of the stage the current thread (or asyncio task) works for
+_current = contextvars.ContextVar('profiling_stage', default=None)
+_lock = threading.Lock()
+
+
+def _usage(thread):
+    # resource usage of the calling thread (or process), None where it is not available
+    if resource is None or (thread and not hasattr(resource, 'RUSAGE_THREAD')):
+        return None
+    return resource.getrusage(resource.RUSAGE_THREAD if thread else resource.RUSAGE_SELF)
+
+
+def _delta(before, after):
+    return {'user': after.ru_utime - before.ru_utime, 'system': after.ru_stime - before.ru_stime,
+            'blocks_read': after.ru_inblock - before.ru_inblock, 'blocks_written': after.ru_oublock - before.ru_oublock}
+
+
+def _rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss / (2.0 ** 20 if sys.platform == 'darwin' else 2.0 ** 10)
+
+
+def start_stage(name, cores):
+    """returns a new stage record and makes it the target of record_command in the current context"""
+    record = {'stage': name, 'cores': cores, 'start': time.time(), 'commands': [],
+              'native': {'tasks': 0, 'user': 0.0, 'system': 0.0, 'max_rss_mb': 0.0, 'blocks_read': 0,
+                         'blocks_written': 0},
+              'thread_usage': _usage(True)}
+    _current.set(record)
+    return record
+
+
+def record_command(command):
+    """adds a command record (dict) to the stage of the current context, if any"""
+    record = _current.get()
+    if record is not None:
+        with _lock:
+            record['commands'].append(command)
+
+
+def run_measured(func, args, process=False):
+    """
+    Runs func(*args), returns its result and its resource usage (see record_task)
+
+    The usage is the CPU time and block I/O of the calling thread while func ran. If process is True (in a worker
+    process running one task at a time), it is that of the whole process and of the commands it waited for, with the
+    peak memory of the process and its commands. It is None where these counters are not available.
+    """
+    before = _usage(not process)
+    if process and before is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = func(*args)
+    if before is None:
+        return result, None
+    after = _usage(not process)
+    usage = _delta(before, after)
+    if process:
+        spawned = resource.getrusage(resource.RUSAGE_CHILDREN)
+        for key, value in _delta(children, spawned).items():
+            usage[key] += value
+        usage['max_rss_mb'] = max(_rss_mb(after), _rss_mb(spawned) if spawned.ru_utime > children.ru_utime else 0)
+    return result, usage
+
+
+def record_task(usage, task=True):
+    """adds the resource usage of a native step (see run_measured) to the stage of the current context, if any"""
+    record = _current.get()
+    if record is None or usage is None:
+        return
+    with _lock:
+        native = record['native']
+        native['tasks'] += int(task)
+        for key in ('user', 'system', 'blocks_read', 'blocks_written'):
+            native[key] += usage[key]
+        native['max_rss_mb'] = max(native['max_rss_mb'], usage.get('max_rss_mb', 0))
+
+
+def _files_summary(files):
+    size = 0
+    points = 0
+    for f in files:
+        try:
+            size += os.path.getsize(f)
+            if f.lower().endswith(('.las', '.laz')):
+                points += read_header(f).point_count
+        except Exception:
+            # e.g. a file that was deleted in the meantime or is not a valid LAS file
+            continue
+    return size, points
+
+
+def finish_stage(record, inputs, outputs, skipped=False, error=None):
+    """
+    Completes a stage record with wall time, totals of its commands and native steps and the point count of inputs and
+    outputs
+
+    Must be called in the thread that called start_stage.
+
+    Args:
+        record (dict): record returned by start_stage
+        inputs (list): files with the points processed by the stage
+        outputs (list): files written by the stage
+        skipped (bool): True if the stage was up to date and did not run
+        error (str): error message if the stage failed
+    """
+    record['wall'] = time.time() - record.pop('start')
+    record['skipped'] = skipped
+    if error:
+        record['error'] = error
+    before = record.pop('thread_usage')
+    if before is not None:
+        record_task(_delta(before, _usage(True)), task=False)
+    commands = record['commands']
+    native = record['native']
+    record['user'] = sum(c.get('user') or 0 for c in commands) + native['user']
+    record['system'] = sum(c.get('system') or 0 for c in commands) + native['system']
+    record['max_rss_mb'] = max([c.get('max_rss_mb') or 0 for c in commands] + [native['max_rss_mb']])
+    record['bytes_read'], record['points_in'] = _files_summary(inputs)
+    record['bytes_written'], record['points_out'] = _files_summary(outputs)
+    if resource is not None:
+        record['bytes_read'] = BLOCK_SIZE * (sum(c.get('blocks_read') or 0 for c in commands) + native['blocks_read'])
+        record['bytes_written'] = BLOCK_SIZE * (sum(c.get('blocks_written') or 0 for c in commands) +
+                                                native['blocks_written'])
+    record['points_per_sec'] = record['points_in'] / record['wall'] if record['wall'] > 0 and not skipped else 0
+    _current.set(None)
+    return record
+
+
+def summary_table(records):
+    """returns the stage records as text table"""
+    rows = [('stage', 'wall [s]', 'cpu [s]', 'RSS [MB]', 'read [MB]', 'written [MB]', 'points in', 'points/s', 'cmds')]
+    for r in records:
+        rows.append((r['stage'] + (' (skipped)' if r['skipped'] else ''),
+                     '%.1f' % r['wall'],
+                     '%.1f' % (r['user'] + r['system']),
+                     '%.0f' % r['max_rss_mb'],
+                     '%.1f' % (r['bytes_read'] / 2.0 ** 20),
+                     '%.1f' % (r['bytes_written'] / 2.0 ** 20),
+                     '%i' % r['points_in'],
+                     '%.0f' % r['points_per_sec'],
+                     '%i' % len(r['commands'])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ['  '.join(v.ljust(w) if i == 0 else v.rjust(w) for i, (v, w) in enumerate(zip(row, widths)))
+             for row in rows]
+    lines.insert(1, '-' * len(lines[0]))
+    return '\n'.join(lines)
+
+
+def write_profile(records, root, wall):
+    """writes the stage records of a run to run_profile.json in root and logs the summary table"""
+    # imported here, resources imports this module
+    from resources import measured_memory, memory_rates
+    memory = measured_memory(root)
+    memory.update(memory_rates(records))
+    profile = {'finished': time.strftime('%Y-%m-%d %H:%M:%S'), 'wall': wall, 'stages': records, 'memory': memory}
+    with open(os.path.join(root, PROFILE_NAME), 'w') as f:
+        json.dump(profile, f, indent=1)
+    logger.info('Run profile (%.1f s):\n%s' % (wall, summary_table(records)))
+
+
+def extrapolate(records, points, total_points, tiles, total_tiles, cores):
+    """
+    Returns the estimated wall time in s of the stages of records on all tiles, from their run on a sample of the tiles
+
+    Every stage is assumed to take time in proportion to its points and inversely to the number of processes it runs
+    at a time (at most one per tile and core). The estimate is rough: it does not account for stages that ran side by
+    side or for time that does not scale with the points (e.g. starting LAStools).
+
+    Args:
+        records (list): stage records of the run on the sample
+        points (int): points in the sampled tiles
+        total_points (int): points in all tiles
+        tiles (int): number of sampled tiles
+        total_tiles (int): number of all tiles
+        cores (int): cores available to the full run
+    """
+    scale = total_points / float(max(1, points))
+    full = max(1, min(cores, total_tiles))
+    return sum(r['wall'] * scale * max(1, min(r['cores'], tiles)) / full for r in records)
@@ -0,0 +1,226 @@
+"""
+Verification, retry and quarantine of the per-tile steps of the workflow.
+
+A LAStools process that crashes on one tile leaves a missing, truncated or incomplete output file, which the following
+stages would silently build on. After a step ran on all tiles, every output is checked against its input tile: it must
+exist, its header must be readable, the file must hold all point records the header announces, and the point count must
+match the input (for steps that keep all points) or not exceed it (for steps that drop points). The native steps (see
+run_native) are checked the same way, and also fail on a tile if they raise an error.
+
+Tiles that fail are run again one at a time (not side by side with other tiles, in case they ran out of memory), after
+a delay that doubles with every retry. Tiles that keep failing are quarantined: their outputs are removed, so the
+following stages go on without them, and they are listed in quarantine.json of the project directory by stage. If all
+tiles of a step fail, the step raises an exception instead, as that points to a problem with the settings or the tools
+rather than the tiles. The stages list their quarantined tiles in their results, which keeps them from being skipped
+as up to date (see manifest.up_to_date): the next run tries the tiles again.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from file_functions import run_commands
+from pipeline import run_tasks
+from las_io import read_header
+
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_NAME = 'quarantine.json'
+
+# retries of a failed tile, and seconds before the first retry (doubled for every further one)
+RETRIES = 2
+BACKOFF = 5.0
+
+_lock = threading.Lock()
+
+
+def check_output(ifile, ofile, conserve=True):
+    """
+    Returns None if ofile is a complete output of a step on tile ifile, otherwise the reason why not
+
+    Args:
+        ifile (str): input tile
+        ofile (str): output file of the step
+        conserve (bool): True if the step keeps all points (the point counts must match), False if it drops points
+    """
+    if not os.path.isfile(ofile):
+        return 'no output'
+    try:
+        i, o = read_header(ifile), read_header(ofile)
+    except Exception as e:
+        return 'unreadable output (%s)' % e
+    if not o.compressed and os.path.getsize(ofile) < o.offset_to_points + o.point_count * o.record_length:
+        return 'truncated output'
+    if o.point_count > i.point_count or (conserve and o.point_count < i.point_count):
+        return '%i of %i points' % (o.point_count, i.point_count)
+    return None
+
+
+def check_outputs(ifile, output, conserve=True):
+    """
+    Returns None if output is a complete output of a step on tile ifile, otherwise the reason why not
+
+    output is either a file the step must write (see check_output), or a list of files the step may write (e.g. one
+    per class). Each of these that exists must be complete and must not hold more points than ifile.
+    """
+    if isinstance(output, str):
+        return check_output(ifile, output, conserve)
+    for ofile in output:
+        if os.path.isfile(ofile):
+            reason = check_output(ifile, ofile, conserve=False)
+            if reason:
+                return '%s: %s' % (os.path.basename(ofile), reason)
+    return None
+
+
+def _remove(output):
+    for filename in [output] if isinstance(output, str) else output:
+        try:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        except OSError:
+            logger.warning('Couldn\'t delete %s' % filename)
+
+
+def _run_verified(tasks, run, concurrency, conserve, retries, backoff):
+    # runs the jobs of tasks (input tile, output, job) with run(jobs, concurrency), which returns an error message (or
+    # None) per job, then verifies, retries and quarantines like run_tiles
+    retries = RETRIES if retries is None else retries
+    backoff = BACKOFF if backoff is None else backoff
+    if not tasks:
+        return {}
+    failed = {}
+    for (ifile, output, job), error in zip(tasks, run([job for _, _, job in tasks], concurrency)):
+        reason = error or check_outputs(ifile, output, conserve)
+        if reason:
+            failed[ifile] = (output, job, reason)
+
+    for attempt in range(retries):
+        if not failed:
+            break
+        delay = backoff * 2 ** attempt
+        logger.warning('%i tile(s) failed (%s), retrying one at a time in %.0f s' % (
+            len(failed), '; '.join('%s: %s' % (os.path.basename(i), r) for i, (_, _, r) in sorted(failed.items())),
+            delay))
+        time.sleep(delay)
+        for ifile, (output, job, _) in sorted(failed.items()):
+            _remove(output)
+            reason = run([job], 1)[0] or check_outputs(ifile, output, conserve)
+            if reason:
+                failed[ifile] = (output, job, reason)
+            else:
+                logger.info('%s succeeded on retry %i' % (os.path.basename(ifile), attempt + 1))
+                del failed[ifile]
+
+    for ifile, (output, job, reason) in sorted(failed.items()):
+        _remove(output)
+        logger.error('Quarantined %s after %i retries (%s)%s' % (os.path.basename(ifile), retries, reason,
+                                                                ': %s' % job if isinstance(job, str) else ''))
+    if len(failed) == len(tasks):
+        ifile = tasks[0][0]
+        msg = 'All %i tile(s) failed, e.g. %s: %s' % (len(tasks), os.path.basename(ifile), failed[ifile][2])
+        logger.error(msg)
+        raise Exception(msg)
+    return {ifile: reason for ifile, (_, _, reason) in failed.items()}
+
+
+def run_tiles(tasks, concurrency=1, memory=0, conserve=True, retries=None, backoff=None):
+    """
+    Runs one command per tile, verifies the outputs (see check_output) and retries or quarantines failed tiles
+
+    Args:
+        tasks (list): (input tile, output file, command line) per tile
+        concurrency (int): maximum number of commands running at a time on the first attempt
+        memory (int): estimated peak memory of a command in bytes (see file_functions.run_commands)
+        conserve (bool): True if the command keeps all points of the tile
+        retries (int): number of retries of a failed tile (default RETRIES)
+        backoff (float): seconds before the first retry, doubled for every further retry (default BACKOFF)
+
+    Returns dict of the reason of failure by quarantined input tile. Raises an exception if all tiles failed, which
+    points to a problem with the settings or LAStools rather than the tiles.
+    """
+    def run(commands, concurrency):
+        run_commands(commands, concurrency, memory=memory)
+        return [None] * len(commands)
+
+    return _run_verified(tasks, run, concurrency, conserve, retries, backoff)
+
+
+def _attempt(func, output, args):
+    # runs func(*args) on one tile, returns the error message if it raised (removing what it wrote)
+    try:
+        func(*args)
+    except Exception as e:
+        _remove(output)
+        return '%s: %s' % (type(e).__name__, e)
+    return None
+
+
+def run_native(func, tasks, workers=1, conserve=True, processes=True, retries=None, backoff=None):
+    """
+    Runs a native step per tile, verifies the outputs and retries or quarantines failed tiles like run_tiles
+
+    A tile fails if func raises an error or its output fails the checks (see check_outputs).
+
+    Args:
+        func (callable): step, called as func(*args) per tile
+        tasks (list): (input tile, output, args) per tile. output is the file func writes, or a list of the files it
+            may write (see check_outputs)
+        workers (int): number of tiles processed at a time on the first attempt (see pipeline.run_tasks)
+        conserve (bool): True if func keeps all points of the tile (only checked for a single output file)
+        processes (bool): run the tiles in worker processes (func and args must be picklable) instead of threads
+        retries (int): number of retries of a failed tile (default RETRIES)
+        backoff (float): seconds before the first retry, doubled for every further retry (default BACKOFF)
+
+    Returns dict of the reason of failure by quarantined input tile. Raises an exception if all tiles failed.
+    """
+    def run(jobs, workers):
+        return run_tasks(_attempt, [(func, output, args) for output, args in jobs], workers, processes)
+
+    return _run_verified([(ifile, output, (output, args)) for ifile, output, args in tasks], run, workers, conserve,
+                         retries, backoff)
+
+
+def _update(root, update):
+    # applies update to the records of quarantine.json in root (dict of tiles by stage), removing it once empty
+    filename = os.path.join(root, QUARANTINE_NAME)
+    with _lock:
+        stages = quarantined(root)
+        updated = update(dict(stages))
+        if updated == stages:
+            return
+        if updated:
+            with open(filename, 'w') as f:
+                json.dump(updated, f, indent=1, sort_keys=True)
+        elif os.path.isfile(filename):
+            os.remove(filename)
+
+
+def record(root, stage, tiles):
+    """
+    Records the quarantined tiles (dict of reason by input tile) of a stage in quarantine.json of root, replacing the
+    record of an earlier run of the stage
+    """
+    def update(stages):
+        stages.pop(stage, None)
+        if tiles:
+            stages[stage] = {os.path.relpath(t, root).replace(os.sep, '/'): r for t, r in sorted(tiles.items())}
+        return stages
+
+    _update(root, update)
+
+
+def prune(root, stages):
+    """removes the records of stages other than stages (names) from quarantine.json of root, e.g. of another mode"""
+    _update(root, lambda records: {s: t for s, t in records.items() if s in stages})
+
+
+def quarantined(root):
+    """returns the quarantined tiles of the last runs in root as dict of reason by tile by stage"""
+    try:
+        with open(os.path.join(root, QUARANTINE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
@@ -0,0 +1,201 @@
+"""
+CPUs and memory of the machine, and concurrency planning for the LiDAR workflow.
+
+LAStools processes differ a lot in their memory needs: lasground_new with -hyper_fine holds a fine grid and all points
+of a tile, las2las streams the points. The Planner picks the number of processes of a stage from the cores of the
+machine, the number of tiles and the memory one process needs. The memory of a process is estimated from the points
+of the largest tile, with the memory per point measured for the tool in earlier runs of the project (see profiling.py)
+or else the one of TOOL_MEMORY.
+While commands run, file_functions.run_commands holds new commands back as long as the machine is short of memory (see
+memory_pressure), so that it does not start swapping.
+"""
+
+import os
+import json
+import shlex
+import logging
+from las_io import read_header
+import profiling
+
+
+logger = logging.getLogger(__name__)
+
+MB = 2 ** 20
+
+# estimated peak memory of one process of a tool: (bytes, bytes per point of the processed file)
+TOOL_MEMORY = {'lasground_new': (100 * MB, 400),
+               'lasheight': (50 * MB, 120),
+               'lasclassify': (50 * MB, 160),
+               'lastile': (50 * MB, 60),
+               'lasclip': (30 * MB, 40),
+               'lasduplicate': (30 * MB, 80),
+               'las2las': (20 * MB, 0),
+               'lasinfo': (20 * MB, 0),
+               'laszip': (20 * MB, 0),
+               # in-process steps reading the points in chunks (see point_ops.py and poly_clip.py)
+               'split_classes': (100 * MB, 0),
+               'poly_clip': (200 * MB, 0),
+               # holds all points of a tile and the triangulation of its ground points (see height.py)
+               'height': (100 * MB, 250),
+               # holds all points of a tile and the grids of the morphological filter (see ground.py)
+               'ground': (100 * MB, 200),
+               # holds all points of a tile, its ground surface and the neighbourhoods of its voxels (see classify.py)
+               'classify': (100 * MB, 300)
+               }
+DEFAULT_MEMORY = (100 * MB, 200)
+
+# memory left to the system and other programs: a fraction of the total memory, but at least RESERVE_MIN
+RESERVE_FRACTION = 0.1
+RESERVE_MIN = 512 * MB
+
+# on Linux, the peak memory of a child process is at least the memory of the process it was forked from. A measured
+# peak only counts for the tool if it exceeds the memory of this process at the start of the command by this fraction
+INHERITED_MARGIN = 0.1
+
+
+def cpu_count():
+    """returns the number of CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def memory():
+    """returns (total, available) physical memory in bytes, or None if it cannot be determined"""
+    try:
+        import psutil
+        m = psutil.virtual_memory()
+        return m.total, m.available
+    except ImportError:
+        pass
+    if os.path.isfile('/proc/meminfo'):
+        info = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                info[name] = int(value.split()[0]) * 1024
+        return info['MemTotal'], info.get('MemAvailable', info['MemFree'] + info.get('Cached', 0))
+    if os.name == 'nt':
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('length', ctypes.c_ulong), ('load', ctypes.c_ulong), ('total', ctypes.c_ulonglong),
+                        ('available', ctypes.c_ulonglong), ('total_page_file', ctypes.c_ulonglong),
+                        ('available_page_file', ctypes.c_ulonglong), ('total_virtual', ctypes.c_ulonglong),
+                        ('available_virtual', ctypes.c_ulonglong), ('available_extended', ctypes.c_ulonglong)]
+
+        status = MemoryStatus()
+        status.length = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.total, status.available
+    return None
+
+
+def reserve(total):
+    """returns the memory in bytes to leave free on a machine with total bytes of memory"""
+    return max(RESERVE_MIN, RESERVE_FRACTION * total)
+
+
+def memory_pressure(needed=0):
+    """returns True if a process needing needed bytes would leave less than the reserve of memory free"""
+    m = memory()
+    if m is None:
+        return False
+    total, available = m
+    return available - needed < reserve(total)
+
+
+def tool_name(command):
+    """returns the name of the program of a command line (e.g. lasground_new for C:/LAStools/bin/lasground_new.exe)"""
+    program = command.split(' -', 1)[0].strip().strip('"')
+    return os.path.splitext(os.path.basename(program))[0]
+
+
+def current_memory():
+    """returns the resident memory in bytes of this process, or None if it cannot be determined (only on Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def command_points(command):
+    """returns the point count of the input file (-i) of a command line, or None if it has no single .las/.laz input"""
+    try:
+        args = [a.strip('"') for a in shlex.split(command, posix=os.name != 'nt')]
+        filename = args[args.index('-i') + 1]
+        if filename.lower().endswith(('.las', '.laz')):
+            return read_header(filename).point_count
+    except Exception:
+        pass
+    return None
+
+
+def memory_rates(records):
+    """
+    Returns dict of the measured memory per point (bytes) by tool, from the command records of stages (see profiling.py)
+
+    The rate of a command is its peak memory beyond the base memory of the tool (TOOL_MEMORY) per point of its input
+    file. Commands whose peak is not clearly above the memory of the Python process that started them are left out: on
+    Linux, their peak is that of the Python process, not of the tool.
+    """
+    rates = {}
+    for stage in records:
+        for c in stage.get('commands', []):
+            if not c.get('max_rss_mb') or c.get('exit_code') != 0 or not c.get('points'):
+                continue
+            peak = c['max_rss_mb'] * MB
+            if c.get('parent_rss_mb') and peak <= (1 + INHERITED_MARGIN) * c['parent_rss_mb'] * MB:
+                continue
+            tool = tool_name(c['command'])
+            rate = max(0, peak - TOOL_MEMORY.get(tool, DEFAULT_MEMORY)[0]) / c['points']
+            rates[tool] = max(rates.get(tool, 0), rate)
+    return rates
+
+
+def measured_memory(root):
+    """returns dict of the memory per point (bytes) by tool measured in earlier runs in root (from its run profile)"""
+    try:
+        with open(os.path.join(root, profiling.PROFILE_NAME)) as f:
+            return json.load(f).get('memory', {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+class Planner:
+    """
+    Picks the number of processes a stage runs at the same time from cores, tiles and memory
+
+    Args:
+        cores (int): cores to use (None, 0 or 'auto': all CPUs of the machine)
+        root (str): project directory. The memory per point measured in its earlier runs (see memory_rates) is used
+            instead of the one of TOOL_MEMORY.
+    """
+
+    def __init__(self, cores=None, root=None):
+        self.cores = int(cores) if cores and cores != 'auto' else cpu_count()
+        self.measured = measured_memory(root) if root else {}
+        self._limited = {}
+
+    def process_memory(self, tool, files=()):
+        """returns the estimated peak memory in bytes of one process of tool working on the largest of files"""
+        base, per_point = TOOL_MEMORY.get(tool, DEFAULT_MEMORY)
+        per_point = self.measured.get(tool, per_point)
+        points = max([read_header(f).point_count for f in files] or [0])
+        return base + per_point * points
+
+    def workers(self, tool, files):
+        """returns the number of processes of tool to run at the same time on files: at most one per file and core,
+        and no more than fit into the available memory"""
+        n = max(1, min(self.cores, len(files)))
+        m = memory()
+        if m is None:
+            return n
+        total, available = m
+        fit = int((available - reserve(total)) // max(1, self.process_memory(tool, files)))
+        n = max(1, min(n, fit))
+        if fit < self.cores and self._limited.get(tool) != n:
+            logger.info('Memory for %i %s processes at a time (%.1f GB available)' % (n, tool, available / 2.0 ** 30))
+            self._limited[tool] = n
+        return n
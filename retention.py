@@ -0,0 +1,181 @@
+"""
+Retention of intermediate stage outputs.
+
+Most output directories of the LiDAR workflow are only read by the next stages. Once all stages reading a directory
+finished, the retention engine deletes its point clouds or compresses them to LAZ. The manifest of the directory is
+kept and marked as retired, so that later runs still know the recorded outputs: stages reading a retired directory are
+skipped as long as nothing changed, and the stage that wrote it runs again if one of its consumers has to re-run.
+
+Outputs of stages without consumers (the final products) and directories listed to keep are never retired. Before the
+run starts, the peak disk usage of all stage outputs is projected from the size of one uncompressed copy of the point
+cloud per output directory; the run is refused if the projection exceeds the free disk space or the disk budget.
+During the run, stages only start while the outputs on disk plus the projected outputs of running stages stay within
+the budget.
+"""
+
+import os
+import shutil
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import manifest
+from las_io import read_header
+
+
+logger = logging.getLogger(__name__)
+
+MODES = ('keep', 'delete', 'compress')
+
+# typical size of a LAZ file relative to the LAS file
+LAZ_RATIO = 0.15
+
+
+def directory_size(directory):
+    """returns the total size of all files in directory and its subdirectories"""
+    return sum(os.path.getsize(f) for f in manifest.directory_files(directory) if os.path.isfile(f))
+
+
+def uncompressed_size(files):
+    """returns the total size of .las/.laz files when stored uncompressed"""
+    total = 0
+    for f in files:
+        h = read_header(f)
+        total += h.offset_to_points + h.point_count * h.record_length
+    return total
+
+
+class Retention:
+    """
+    Deletes or compresses stage outputs as soon as no stage needs them anymore, within a disk budget
+
+    Args:
+        graph (StageGraph): stages of the run, with the project directory as root
+        mode (str): 'keep' (retire nothing), 'delete' or 'compress'
+        copy_size (int): estimated size in bytes of one output directory (e.g. the uncompressed input point cloud)
+        keep (list): output directories (relative to the root) that are never retired
+        budget (float): maximum disk usage of all stage outputs in bytes (None: only limited by the free space)
+        compress (callable): compress(files) writes a .laz file next to each .las file (required for 'compress')
+    """
+
+    def __init__(self, graph, mode='keep', copy_size=0, keep=(), budget=None, compress=None):
+        if mode not in MODES:
+            msg = 'Unknown retention mode %s (use one of %s)' % (mode, ', '.join(MODES))
+            logger.error(msg)
+            raise Exception(msg)
+        if mode == 'compress' and compress is None:
+            msg = 'Retention mode compress needs a compression function'
+            logger.error(msg)
+            raise Exception(msg)
+        self.graph = graph
+        self.root = graph.root
+        self.mode = mode
+        self.copy_size = copy_size
+        self.keep = list(keep)
+        self.budget = budget
+        self.compress = compress
+        self.stale = set()
+        self.done = set()
+        self.retired = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+
+    def retirable(self, stage):
+        """returns True if the outputs of stage may be retired once all of its consumers finished"""
+        return self.mode != 'keep' and bool(stage.outputs) and bool(self.graph.consumers(stage)) and \
+            not any(manifest.within(o, k) or manifest.within(k, o) for o in stage.outputs for k in self.keep)
+
+    def output_size(self, stage):
+        """returns the size of the outputs of stage currently on disk"""
+        return sum(directory_size(os.path.join(self.root, o)) for o in stage.outputs)
+
+    def estimate(self, stage):
+        """returns the projected size of the outputs of stage (the current size if it will not run)"""
+        if stage.name not in self.stale:
+            return self.output_size(stage)
+        return self.copy_size * len(stage.outputs)
+
+    def project(self):
+        """returns the projected peak disk usage of all stage outputs if the stages run one after another"""
+        live = {}
+        done = set()
+        peak = 0
+        for stage in self.graph.order():
+            live[stage.name] = self.estimate(stage)
+            peak = max(peak, sum(live.values()))
+            done.add(stage.name)
+            for dep in self.graph.dependencies(stage):
+                if self.retirable(dep) and all(c.name in done for c in self.graph.consumers(dep)):
+                    live[dep.name] *= LAZ_RATIO if self.mode == 'compress' else 0
+        return peak
+
+    def check(self, stale):
+        """
+        Projects the peak disk usage for the stages that will run and raises an exception if it does not fit
+
+        Args:
+            stale (set): names of the stages that will run
+        """
+        self.stale = set(stale)
+        peak = self.project()
+        current = sum(self.output_size(s) for s in self.graph.stages)
+        free = shutil.disk_usage(self.root).free
+        logger.info('Projected peak disk usage of stage outputs: %.1f GB (currently %.1f GB, %.1f GB free)' % (
+            peak / 2.0 ** 30, current / 2.0 ** 30, free / 2.0 ** 30))
+        if peak - current > free:
+            msg = 'Not enough disk space: the stage outputs are projected to need %.1f GB more, %.1f GB are free' % (
+                (peak - current) / 2.0 ** 30, free / 2.0 ** 30)
+            logger.error(msg)
+            raise Exception(msg)
+        if self.budget is not None and peak > self.budget:
+            msg = 'Projected peak disk usage %.1f GB exceeds the disk budget of %.1f GB' % (
+                peak / 2.0 ** 30, self.budget / 2.0 ** 30)
+            logger.error(msg)
+            raise Exception(msg)
+
+    def admit(self, stage, running):
+        """returns True if stage can start next to the running stages without exceeding the disk budget"""
+        if self.budget is None:
+            return True
+        usage = sum(self.output_size(s) for s in self.graph.stages)
+        usage += sum(max(0, self.estimate(s) - self.output_size(s)) for s in running)
+        usage += self.estimate(stage)
+        return usage <= self.budget
+
+    def finished(self, stage):
+        """records that stage finished (or was skipped) and retires the outputs no remaining stage needs"""
+        self.done.add(stage.name)
+        for dep in self.graph.dependencies(stage):
+            if dep.name in self.retired or not self.retirable(dep):
+                continue
+            if all(c.name in self.done for c in self.graph.consumers(dep)):
+                self.retired.add(dep.name)
+                with self._lock:
+                    self._pending.append(self._pool.submit(self.retire, dep))
+
+    def retire(self, stage):
+        """deletes or compresses the outputs of stage and marks its manifests as retired"""
+        if manifest.retired(stage, self.root):
+            return
+        files = [f for f in manifest.stage_outputs(stage, self.root) if f.lower().endswith('.las')]
+        if self.mode == 'compress' and files:
+            self.compress(files)
+            files = [f for f in files if os.path.isfile(os.path.splitext(f)[0] + '.laz')]
+        for f in files:
+            os.remove(f)
+        manifest.mark_retired(stage, self.root, self.mode)
+        logger.info('Retired outputs of %s (%s)' % (stage.name, 'deleted' if self.mode == 'delete' else 'compressed'))
+
+    def flush(self):
+        """waits for all pending retirements, raises the first exception of any of them"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """waits for pending retirements and shuts down the retirement thread"""
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
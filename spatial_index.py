@@ -0,0 +1,89 @@
+"""
+Spatial index over the bounding boxes of point cloud files.
+
+The merge steps only need the input files overlapping an output tile. The bounding boxes of the inputs are taken from
+their headers and packed into a static R-tree (sort-tile-recursive bulk loading): the boxes are sorted into vertical
+slices by their center x and within every slice by their center y, and every node_size consecutive boxes form a leaf.
+Upper levels group node_size consecutive nodes of the level below, up to a single root.
+"""
+
+import logging
+import numpy as np
+from las_io import read_header
+
+
+logger = logging.getLogger(__name__)
+
+
+class BoxIndex:
+    """
+    Static R-tree over axis-aligned boxes
+
+    Args:
+        boxes (array-like): rows of (min x, min y, max x, max y)
+        node_size (int): maximum number of children per node
+    """
+
+    def __init__(self, boxes, node_size=16):
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.node_size = max(2, int(node_size))
+        n = len(self.boxes)
+
+        # sort-tile-recursive order of the boxes
+        cx = (self.boxes[:, 0] + self.boxes[:, 2]) / 2
+        cy = (self.boxes[:, 1] + self.boxes[:, 3]) / 2
+        slices = max(1, int(np.ceil(np.sqrt(n / float(self.node_size)))))
+        per_slice = slices * self.node_size
+        by_x = np.argsort(cx, kind='stable')
+        self.order = np.concatenate([s[np.argsort(cy[s], kind='stable')]
+                                     for s in np.array_split(by_x, max(1, -(-n // per_slice)))]) if n else by_x
+
+        # node bounds per level, bottom up: the children of node i are entries i * node_size ... of the level below
+        self.levels = []
+        self._ordered = self.boxes[self.order]
+        bounds = self._ordered
+        while len(bounds) > 1 or not self.levels:
+            groups = np.arange(0, len(bounds), self.node_size)
+            if len(bounds):
+                bounds = np.c_[np.minimum.reduceat(bounds[:, 0], groups), np.minimum.reduceat(bounds[:, 1], groups),
+                               np.maximum.reduceat(bounds[:, 2], groups), np.maximum.reduceat(bounds[:, 3], groups)]
+            self.levels.append(bounds)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def query(self, box):
+        """returns the sorted indices of all boxes intersecting box (min x, min y, max x, max y), edges included"""
+        x0, y0, x1, y1 = box
+        if not len(self.boxes):
+            return np.zeros(0, dtype=np.int64)
+        nodes = np.array([0])
+        # descend from the root to the leaves, keeping the nodes whose bounds intersect box
+        for level in range(len(self.levels) - 1, -1, -1):
+            below = self.levels[level - 1] if level > 0 else self._ordered
+            children = (nodes[:, None] * self.node_size + np.arange(self.node_size)).ravel()
+            children = children[children < len(below)]
+            b = below[children]
+            nodes = children[(b[:, 0] <= x1) & (b[:, 2] >= x0) & (b[:, 1] <= y1) & (b[:, 3] >= y0)]
+        return np.sort(self.order[nodes])
+
+
+def file_boxes(files):
+    """returns the xy bounding boxes (min x, min y, max x, max y) of files from their headers, as array of rows"""
+    boxes = []
+    for f in files:
+        h = read_header(f)
+        boxes.append((h.mins[0], h.mins[1], h.maxs[0], h.maxs[1]))
+    return np.array(boxes, dtype=float).reshape(-1, 4)
+
+
+def file_index(files, node_size=16):
+    """returns a BoxIndex over the header bounding boxes of files (query results are indices into files)"""
+    return BoxIndex(file_boxes(files), node_size)
+
+
+def tile_range(box, tile_size, margin=0):
+    """returns the tile indices (min tx, min ty, max tx, max ty) of the tiles a box (grown by margin) touches"""
+    x0, y0, x1, y1 = box
+    return (int(np.floor((x0 - margin) / tile_size)), int(np.floor((y0 - margin) / tile_size)),
+            int(np.floor((x1 + margin) / tile_size)), int(np.floor((y1 + margin) / tile_size)))
@@ -0,0 +1,276 @@
+"""
+Parameter sweeps of the ground classification settings on a sample of tiles.
+
+Instead of running the whole workflow for every try of step, bulge, spike, down_spike and offset, a sweep classifies
+the ground of a few tiles of 01_tiled with every combination of the given values, running the combinations in
+parallel. The tiles are picked to represent the point densities and relief of the project (see
+tiling.stratified_sample). The ground is classified with lasground_new or with the native progressive morphological
+filter ('pmf', see ground.py), like in the workflow (tiles the filter cannot read go through lasground_new). Every set
+of parameters is scored by its number of ground points and the roughness of its ground surface: the root mean square
+of the difference between the mean ground elevation of every 1 x 1 cell (in the units of the data) and the mean of its
+four neighbours. Vegetation or buildings kept as ground make the surface rough, too few ground points leave cells
+empty.
+
+The classified tiles are kept in ground_sweep/<parameter set>/ of the LiDAR data directory (ground_sweep/pmf_<parameter
+set>/ for the pmf filter), and the scores of every (tile, parameter set) in ground_sweep/sweep_cache.json, so that tiles
+already classified with a set are only scored again if the tile changed. The scores of the tiles that were classified
+are cached even if others failed. Parameter sets that failed on a tile are left out of the results, which are written
+to ground_sweep/sweep_results.json.
+
+Usage::
+
+    python sweep.py C:\\LAStools\\bin\\ D:\\surveys\\block_01\\ --step 1 2 5 --bulge 0.5 1 --spike 1 --down_spike 1
+        --offset 0.05 [--tiles 4] [--cores N] [--units meters] [--ground-engine pmf]
+"""
+
+import os
+import sys
+import json
+import argparse
+import itertools
+import logging
+import numpy as np
+from tkinter import messagebox
+import manifest
+from file_functions import run_commands, run_lock, err_info
+from pipeline import run_tasks
+from las_io import LasReader, readable
+from resources import Planner
+from quarantine import check_output
+from tiling import stratified_sample
+from ground import classify_ground
+from LiDAR_processing_GUI import SWEEP_NAME, GROUND_ENGINES, lasground_command, las_files, pts
+from batch import UNITS, GROUND_PARAMS
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = 'sweep_cache.json'
+RESULTS_NAME = 'sweep_results.json'
+
+GROUND = 2
+
+
+def parameter_sets(grid):
+    """
+    Returns all combinations of the values in grid as list of dicts
+
+    Args:
+        grid (dict): list of values (or a single value) by lasground_new parameter (step, bulge, spike, down_spike
+            and offset)
+    """
+    missing = [p for p in GROUND_PARAMS if p not in grid or grid[p] in ('', [])]
+    if missing:
+        msg = 'No values for %s' % ', '.join(missing)
+        logger.error(msg)
+        raise Exception(msg)
+    values = [grid[p] if isinstance(grid[p], (list, tuple)) else [grid[p]] for p in GROUND_PARAMS]
+    return [dict(zip(GROUND_PARAMS, combination)) for combination in itertools.product(*values)]
+
+
+def set_name(params):
+    """returns the directory name of a parameter set (e.g. step5_bulge1_spike1_down_spike1_offset0.05)"""
+    return '_'.join('%s%s' % (p, params[p]) for p in GROUND_PARAMS)
+
+
+def set_dir(params, engine='lasground_new'):
+    """returns the directory name of a parameter set of a ground engine in the sweep directory"""
+    return set_name(params) if engine == 'lasground_new' else '%s_%s' % (engine, set_name(params))
+
+
+def _classify(filename, ofilename, params, units_code):
+    # classify_ground on one tile, logging instead of raising errors: the output is verified afterwards
+    try:
+        classify_ground(filename, ofilename, *params, units_code=units_code)
+    except Exception as e:
+        logger.error('Ground classification of %s failed: %s' % (filename, e))
+
+
+def roughness(x, y, z, cell=1.0):
+    """
+    Returns the sum of the squared differences between the mean elevation of every cell and the mean of its four
+    neighbours, and the number of cells it is summed over (cells whose neighbours all hold points)
+    """
+    if len(x) == 0:
+        return 0.0, 0
+    i = ((x - x.min()) // cell).astype(np.int64) + 1
+    j = ((y - y.min()) // cell).astype(np.int64) + 1
+    # one empty cell around the grid, so that the neighbours of every cell exist
+    shape = (j.max() + 2, i.max() + 2)
+    cells = j * shape[1] + i
+    count = np.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+    mean = np.bincount(cells, z, minlength=shape[0] * shape[1]).reshape(shape) / np.maximum(count, 1)
+    full = count > 0
+    inner = full[1:-1, 1:-1] & full[:-2, 1:-1] & full[2:, 1:-1] & full[1:-1, :-2] & full[1:-1, 2:]
+    neighbours = (mean[:-2, 1:-1] + mean[2:, 1:-1] + mean[1:-1, :-2] + mean[1:-1, 2:]) / 4
+    d = (mean[1:-1, 1:-1] - neighbours)[inner]
+    return float((d ** 2).sum()), int(inner.sum())
+
+
+def score_tile(filename):
+    """returns the point count, ground point count and roughness sums (see roughness) of a classified tile"""
+    reader = LasReader(filename)
+    ground = reader.classification() == GROUND
+    x, y, z = reader.xyz(reader.points[ground])
+    squares, cells = roughness(x, y, z)
+    return {'points': len(reader), 'ground_points': int(ground.sum()), 'squares': squares, 'cells': cells}
+
+
+def _read_cache(directory):
+    try:
+        with open(os.path.join(directory, CACHE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def parameter_sweep(lastoolsdir, lidardir, units_code, grid, tiles=4, cores=0, ground_engine='lasground_new'):
+    """
+    Classifies the ground of a sample of tiles with every combination of ground classification parameters
+
+    Args:
+        lastoolsdir (str): LAStools bin directory
+        lidardir (str): LiDAR data directory, tiled by an earlier run of the workflow (01_tiled)
+        units_code (str): lasground_new units arguments ('' for meters, '-feet -elevation_feet' for feet)
+        grid (dict): values by parameter (see parameter_sets)
+        tiles (int): number of tiles to classify
+        cores (int): cores to use (0 or 'auto': all CPUs of the machine)
+        ground_engine (str): 'lasground_new' or 'pmf' (see lidar_workflow)
+
+    Returns the results of the parameter sets as list of dicts with the parameters, the number of points and ground
+    points, the ground fraction and the roughness, in the order of parameter_sets(grid). Sets that failed on a tile
+    are left out. Raises an exception if all sets failed.
+    """
+    if ground_engine not in GROUND_ENGINES:
+        msg = 'Unknown ground engine %s (use %s)' % (ground_engine, ' or '.join(GROUND_ENGINES))
+        logger.error(msg)
+        raise Exception(msg)
+    tiled = las_files(os.path.join(lidardir, '01_tiled', ''))
+    if not tiled:
+        msg = 'No tiles in %s, run the workflow once to create them' % os.path.join(lidardir, '01_tiled')
+        logger.error(msg)
+        raise Exception(msg)
+    sample = stratified_sample(tiled, max(1, int(tiles)))
+    sets = parameter_sets(grid)
+    sdir = os.path.join(lidardir, SWEEP_NAME)
+
+    with run_lock(lidardir):
+        cache = _read_cache(sdir)
+        hashes = {t: manifest.file_record(t)['hash'] for t in sample}
+
+        def key(params, tile):
+            return set_dir(params, ground_engine) + '/' + os.path.basename(tile)
+
+        def cached(params, tile):
+            entry = cache.get(key(params, tile))
+            return entry and entry['input'] == hashes[tile] and entry['units'] == units_code
+
+        todo = [(params, t) for params in sets for t in sample if not cached(params, t)]
+        logger.info('Sweeping %i parameter sets on %i tiles (%i of %i classifications cached)' % (
+            len(sets), len(sample), len(sets) * len(sample) - len(todo), len(sets) * len(sample)))
+
+        if todo:
+            for params in sets:
+                os.makedirs(os.path.join(sdir, set_dir(params, ground_engine)), exist_ok=True)
+            planner = Planner(cores, lidardir)
+            # the largest tiles first, so that the pool does not end up waiting for them
+            todo.sort(key=lambda task: pts(task[1]), reverse=True)
+            outputs = [os.path.join(sdir, key(params, t)) for params, t in todo]
+            # outputs of earlier sweeps on a tile that changed since must not pass for new ones
+            for o in outputs:
+                if os.path.isfile(o):
+                    os.remove(o)
+            native = {i for i, (params, t) in enumerate(todo) if ground_engine != 'lasground_new' and readable(t)}
+            if native:
+                run_tasks(_classify, [(todo[i][1], outputs[i], [todo[i][0][p] for p in GROUND_PARAMS], units_code)
+                                      for i in sorted(native)],
+                          planner.workers('ground', sample * len(sets)), processes=True)
+            run_commands([lasground_command(lastoolsdir, t, units_code, [params[p] for p in GROUND_PARAMS],
+                                            os.path.join(sdir, set_dir(params, ground_engine), ''))
+                          for i, (params, t) in enumerate(todo) if i not in native],
+                         planner.workers('lasground_new', sample * len(sets)),
+                         memory=planner.process_memory('lasground_new', sample))
+
+            # the scores of the tiles that were classified are cached, also if others failed
+            failed = {}
+            for (params, t), o in zip(todo, outputs):
+                reason = check_output(t, o)
+                if reason:
+                    failed[(set_name(params), t)] = reason
+            done = [(task, o) for task, o in zip(todo, outputs) if (set_name(task[0]), task[1]) not in failed]
+            for ((params, t), _), score in zip(done, run_tasks(score_tile, [(o,) for _, o in done], planner.cores)):
+                score.update({'input': hashes[t], 'units': units_code})
+                cache[key(params, t)] = score
+            with open(os.path.join(sdir, CACHE_NAME), 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+            for (name, t), reason in sorted(failed.items()):
+                logger.error('Parameter set %s failed on %s (%s), leaving it out' % (name, os.path.basename(t), reason))
+
+    results = []
+    for params in sets:
+        if not all(cached(params, t) for t in sample):
+            continue
+        scores = [cache[key(params, t)] for t in sample]
+        points = sum(s['points'] for s in scores)
+        ground = sum(s['ground_points'] for s in scores)
+        cells = sum(s['cells'] for s in scores)
+        results.append({'params': params, 'points': points, 'ground_points': ground,
+                        'ground_fraction': ground / float(max(1, points)),
+                        'roughness': np.sqrt(sum(s['squares'] for s in scores) / cells) if cells else None})
+    if not results:
+        msg = 'All %i parameter sets failed, see the log' % len(sets)
+        logger.error(msg)
+        raise Exception(msg)
+
+    with open(os.path.join(sdir, RESULTS_NAME), 'w') as f:
+        json.dump({'tiles': [os.path.basename(t) for t in sample], 'units': units_code, 'ground_engine': ground_engine,
+                   'results': results}, f, indent=1)
+    logger.info('Parameter sweep results:\n%s' % results_table(results))
+    return results
+
+
+def results_table(results):
+    """returns the results of parameter_sweep as text table"""
+    lines = ['%-8s %-8s %-8s %-10s %-8s %12s %8s %10s' % (GROUND_PARAMS + ('ground pts', 'ground %', 'roughness'))]
+    for r in results:
+        roughness = '-' if r['roughness'] is None else '%.3f' % r['roughness']
+        lines.append('%-8s %-8s %-8s %-10s %-8s %12i %8.1f %10s' % (
+            tuple(r['params'][p] for p in GROUND_PARAMS) + (r['ground_points'], 100 * r['ground_fraction'], roughness)))
+    return '\n'.join(lines)
+
+
+def grid_from_entries(**entries):
+    """returns the sweep grid from comma-separated values by parameter (as typed into the GUI)"""
+    return {p: [v.strip() for v in str(entries[p]).split(',') if v.strip()] for p in GROUND_PARAMS}
+
+
+@err_info
+def sweep_lidar(lastoolsdir, lidardir, units_code, cores, tiles=4, ground_engine='lasground_new', **entries):
+    """Runs parameter_sweep on the comma-separated values of every parameter typed into the GUI, showing the results in
+    a message box"""
+    results = parameter_sweep(lastoolsdir, lidardir, units_code, grid_from_entries(**entries), tiles, cores,
+                              ground_engine)
+    messagebox.showinfo('Parameter sweep', results_table(results))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweeps ground classification parameters on a sample of tiles.')
+    parser.add_argument('lastoolsdir', help='LAStools bin directory')
+    parser.add_argument('lidardir', help='LiDAR data directory (tiled by an earlier run of the workflow)')
+    for p in GROUND_PARAMS:
+        parser.add_argument('--' + p, nargs='+', required=True, help='values of %s' % p)
+    parser.add_argument('--tiles', type=int, default=4, help='number of tiles to classify')
+    parser.add_argument('--cores', type=int, default=0, help='cores to use (default: all)')
+    parser.add_argument('--units', default='meters', choices=sorted(UNITS), help='units of the data')
+    parser.add_argument('--ground-engine', default='lasground_new', choices=GROUND_ENGINES,
+                        help='ground classification to sweep')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    parameter_sweep(os.path.join(args.lastoolsdir, ''), os.path.join(args.lidardir, ''), UNITS[args.units],
+                    {p: getattr(args, p) for p in GROUND_PARAMS}, args.tiles, args.cores, args.ground_engine)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
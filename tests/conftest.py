@@ -0,0 +1,46 @@
+import os
+import sys
+import struct
+import numpy as np
+import pytest
+
+# the modules of the toolkit live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# point data record formats 0 - 3
+_FIELDS = [('X', '<i4'), ('Y', '<i4'), ('Z', '<i4'), ('intensity', '<u2'), ('return_bits', 'u1'),
+           ('classification', 'u1'), ('scan_angle_rank', 'i1'), ('user_data', 'u1'), ('point_source_id', '<u2')]
+_EXTRA = {0: [], 1: [('gps_time', '<f8')], 2: [('red', '<u2'), ('green', '<u2'), ('blue', '<u2')],
+          3: [('gps_time', '<f8'), ('red', '<u2'), ('green', '<u2'), ('blue', '<u2')]}
+
+
+def write_las(filename, x, y, z, classification=1, point_format=1, scale=0.01):
+    """
+    Writes a LAS 1.2 file with single-return points at x, y, z (class codes classification), returns its filename
+
+    The file is written without the toolkit, so that it can test the toolkit's readers.
+    """
+    x, y, z = (np.asarray(v, dtype=float) for v in (x, y, z))
+    offset = (np.floor(x.min()) if len(x) else 0.0, np.floor(y.min()) if len(y) else 0.0, 0.0)
+    points = np.zeros(len(x), np.dtype(_FIELDS + _EXTRA[point_format]))
+    for i, values in enumerate((x, y, z)):
+        points['XYZ'[i]] = np.round((values - offset[i]) / scale)
+    points['return_bits'] = 1 | (1 << 3)
+    points['classification'] = np.broadcast_to(np.asarray(classification, dtype=np.uint8), len(x))
+    if len(x):
+        scaled = [points[d] * scale + offset[i] for i, d in enumerate('XYZ')]
+        bounds = [f(v) for v in scaled for f in (np.max, np.min)]
+    else:
+        bounds = [0.0] * 6
+    header = struct.pack('<4sHH16sBB32s32sHHHIIBHI5I3d3d6d', b'LASF', 0, 0, b'\0' * 16, 1, 2, b'tests', b'tests', 1,
+                         2020, 227, 227, 0, point_format, points.dtype.itemsize, len(x), len(x), 0, 0, 0, 0,
+                         scale, scale, scale, offset[0], offset[1], offset[2], *bounds)
+    with open(str(filename), 'wb') as f:
+        f.write(header)
+        f.write(points.tobytes())
+    return str(filename)
+
+
+@pytest.fixture
+def make_las():
+    return write_las
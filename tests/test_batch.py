@@ -0,0 +1,91 @@
+import os
+import json
+import pytest
+import batch
+
+
+@pytest.fixture
+def queue(tmp_path):
+    # queue file of three projects, the second overriding a default ground parameter
+    dirs = []
+    for name in ('a', 'b', 'c'):
+        os.mkdir(str(tmp_path / name))
+        dirs.append(str(tmp_path / name))
+    queue = {'cores': 2, 'defaults': {'lastoolsdir': str(tmp_path), 'coarse': {'step': 5, 'offset': 0.05}},
+             'projects': [{'lidardir': dirs[0]}, {'lidardir': dirs[1], 'coarse': {'step': 3}}, {'lidardir': dirs[2]}]}
+    filename = str(tmp_path / 'queue.json')
+    with open(filename, 'w') as f:
+        json.dump(queue, f)
+    return filename, dirs
+
+
+@pytest.fixture
+def workflow(monkeypatch):
+    # records the calls of the workflow instead of running it, failing for the directories in fail
+    calls, fail = [], set()
+
+    def lidar_workflow(**kwargs):
+        calls.append(kwargs)
+        if os.path.normpath(kwargs['lidardir']) in fail:
+            raise ValueError('tile missing')
+        return {'tiles': 1}, {'tiles': 2}
+    monkeypatch.setattr(batch, 'lidar_workflow', lidar_workflow)
+    return calls, fail
+
+
+def status(lidardir):
+    with open(os.path.join(lidardir, batch.STATUS_NAME)) as f:
+        return json.load(f)
+
+
+def test_read_queue_merges_defaults(queue):
+    filename, dirs = queue
+    projects = batch.read_queue(filename)['projects']
+    assert [p['coarse'] for p in projects] == [{'step': 5, 'offset': 0.05}, {'step': 3, 'offset': 0.05},
+                                               {'step': 5, 'offset': 0.05}]
+    kwargs = batch.workflow_args(projects[1], 4)
+    assert kwargs['lidardir'] == os.path.join(dirs[1], '') and kwargs['cores'] == 4
+    assert kwargs['coarse_step'] == 3 and kwargs['fine_step'] == ''
+
+
+def test_projects_run_in_queue_order(queue, workflow):
+    filename, dirs = queue
+    calls, fail = workflow
+    assert batch.run_queue(batch.read_queue(filename), parallel=1) == 0
+    assert [os.path.normpath(c['lidardir']) for c in calls] == dirs
+    assert all(c['budget'].total == 2 for c in calls)
+    assert status(dirs[2])['state'] == 'done' and status(dirs[2])['veg_results'] == {'tiles': 2}
+
+
+def test_failed_project_and_resume(queue, workflow):
+    filename, dirs = queue
+    calls, fail = workflow
+    fail.add(dirs[1])
+    assert batch.run_queue(batch.read_queue(filename), parallel=2) == 1
+    assert [status(d)['state'] for d in dirs] == ['done', 'failed', 'done']
+    assert 'tile missing' in status(dirs[1])['error']
+    # the next run of the queue resumes the failed project (the workflow skips stages that are up to date)
+    fail.clear()
+    assert batch.run_queue(batch.read_queue(filename)) == 0
+    assert [status(d)['state'] for d in dirs] == ['done', 'done', 'done']
+    assert len(calls) == 6
+
+
+def test_missing_project_directory(queue, workflow, tmp_path):
+    filename, dirs = queue
+    calls, fail = workflow
+    queue = batch.read_queue(filename)
+    queue['projects'][0]['lidardir'] = str(tmp_path / 'missing')
+    assert batch.run_queue(queue, parallel=1) == 1
+    assert len(calls) == 2
+
+
+def test_project_listed_twice(queue):
+    filename, dirs = queue
+    with open(filename) as f:
+        queue = json.load(f)
+    queue['projects'].append({'lidardir': os.path.join(dirs[0], '')})
+    with open(filename, 'w') as f:
+        json.dump(queue, f)
+    with pytest.raises(Exception, match='listed 2 times'):
+        batch.read_queue(filename)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import classify
+from las_io import LasReader
+from LiDAR_processing_GUI import lidar_workflow
+
+
+@pytest.fixture
+def scene(tmp_path, make_las):
+    # flat ground with a flat 6 m roof at 10-20 m and a 3-12 m tree crown scattered around (35, 35)
+    rng = np.random.default_rng(0)
+    gx, gy = rng.uniform(0, 50, 20000), rng.uniform(0, 50, 20000)
+    rx, ry = rng.uniform(10, 20, 4000), rng.uniform(10, 20, 4000)
+    tx, ty, tz = rng.normal(35, 2, 4000), rng.normal(35, 2, 4000), rng.uniform(3, 12, 4000)
+    x, y = np.r_[gx, rx, tx], np.r_[gy, ry, ty]
+    z = np.r_[rng.normal(0, 0.02, len(gx)), 6 + rng.normal(0, 0.01, len(rx)), tz]
+    codes = np.r_[np.full(len(gx), classify.GROUND), np.full(len(rx) + len(tx), classify.UNCLASSIFIED)]
+    return make_las(tmp_path / 'scene.las', x, y, z, codes), len(gx), len(rx)
+
+
+def test_roof_and_crown(scene, tmp_path):
+    filename, ground, roof = scene
+    classify.classify_objects(filename, str(tmp_path / 'out.las'))
+    codes = LasReader(str(tmp_path / 'out.las')).classification()
+    assert (codes[:ground] == classify.GROUND).all()
+    assert (codes[ground:ground + roof] == classify.BUILDING).mean() > 0.95
+    assert (codes[ground + roof:] == classify.VEGETATION).mean() > 0.8
+
+
+def test_ground_offset_above_roof(scene, tmp_path):
+    filename, ground, roof = scene
+    classify.classify_objects(filename, str(tmp_path / 'out.las'), ground_offset=7.0)
+    codes = LasReader(str(tmp_path / 'out.las')).classification()
+    assert (codes[ground:ground + roof] == classify.UNCLASSIFIED).all()
+
+
+@pytest.mark.parametrize('params', [{'planar': 0.5, 'rugged': 0.4}, {'neighbours': 'ten'}, {'scatter': 0.5}])
+def test_workflow_rejects_invalid_parameters(tmp_path, params):
+    with pytest.raises(Exception, match='Invalid eigen classifier parameters'):
+        lidar_workflow('', str(tmp_path) + '/', '', 1, '', True, *(['1'] * 10), classify_engine='eigen', **params)
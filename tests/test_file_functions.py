@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import subprocess
+import pytest
+import file_functions
+from file_functions import run_commands, stage_files, run_lock, scratch_dir
+
+
+def python_command(code):
+    return '%s -c "%s"' % (sys.executable, code)
+
+
+def test_overlong_output_line_is_drained(caplog):
+    # a line beyond the limit of asyncio.StreamReader must not stop the reading (the command would block on a full pipe)
+    command = python_command("import sys; sys.stdout.write('x' * 300000 + '\\\\nend\\\\n'); sys.stdout.flush()")
+    with caplog.at_level(logging.INFO, logger='file_functions'):
+        assert run_commands([command], timeout=30) == [0]
+    assert sum(len(r.getMessage()) for r in caplog.records if r.getMessage().startswith('x')) == 300000
+    assert any(r.getMessage() == 'end' for r in caplog.records)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='commands are reaped with os.wait4 on POSIX only')
+def test_waits_do_not_queue_behind_each_other():
+    # more commands than threads of the default executor of the event loop
+    start = time.time()
+    assert run_commands(['sleep 1'] * 48, concurrency=48) == [0] * 48
+    assert time.time() - start < 3.5
+
+
+def test_exit_codes():
+    assert run_commands([python_command('import sys; sys.exit(3)'), python_command('pass')], 2) == [3, 0]
+
+
+
+@pytest.fixture
+def sources(tmp_path):
+    # two files of different sizes in src/, an empty dst/
+    os.mkdir(str(tmp_path / 'src'))
+    os.mkdir(str(tmp_path / 'dst'))
+    files = []
+    for name, size in (('a.las', 10000), ('b.las', 2500)):
+        files.append(str(tmp_path / 'src' / name))
+        with open(files[-1], 'wb') as f:
+            f.write(os.urandom(size))
+        os.utime(files[-1], (1000000000, 1000000000))
+    return files, str(tmp_path / 'dst')
+
+
+def content(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def no_clone(monkeypatch):
+    monkeypatch.setattr(file_functions, 'clone_file', lambda src, dst: False)
+
+
+def test_clone_file(sources):
+    files, odir = sources
+    dst = os.path.join(odir, 'a.las')
+    # cloning depends on the filesystem, a failed clone leaves nothing behind
+    if file_functions.clone_file(files[0], dst):
+        assert content(dst) == content(files[0]) and not os.path.samefile(dst, files[0])
+    else:
+        assert not os.path.exists(dst)
+
+
+def test_clone_is_preferred(sources, monkeypatch):
+    files, odir = sources
+    monkeypatch.setattr(file_functions, 'clone_file', lambda src, dst: shutil.copyfile(src, dst) is not None)
+    assert stage_files(files, odir) == {'clone': 2, 'hardlink': 0, 'copy': 0}
+    assert not os.path.samefile(files[0], os.path.join(odir, 'a.las'))
+
+
+def test_hardlink_fallback(sources, monkeypatch):
+    files, odir = sources
+    no_clone(monkeypatch)
+    assert stage_files(files, odir) == {'clone': 0, 'hardlink': 2, 'copy': 0}
+    assert all(os.path.samefile(f, os.path.join(odir, os.path.basename(f))) for f in files)
+    # files already linked are not staged again
+    assert stage_files(files, odir) == {'clone': 0, 'hardlink': 0, 'copy': 0}
+
+
+@pytest.mark.parametrize('hardlink', [False, True])
+def test_chunked_copy_fallback(sources, monkeypatch, caplog, hardlink):
+    files, odir = sources
+    no_clone(monkeypatch)
+
+    def cross_device(src, dst):
+        raise OSError(18, 'Invalid cross-device link')
+    monkeypatch.setattr(file_functions.os, 'link', cross_device)
+    with caplog.at_level(logging.INFO, logger='file_functions'):
+        assert stage_files(files, odir, hardlink=hardlink, workers=3, chunk_size=1000) == \
+            {'clone': 0, 'hardlink': 0, 'copy': 2}
+    for f in files:
+        dst = os.path.join(odir, os.path.basename(f))
+        assert content(dst) == content(f) and os.path.getmtime(dst) == 1000000000
+    # progress is logged in steps of at least 10 %, and once all is copied
+    percents = [int(r.getMessage().split('%')[0].split()[1]) for r in caplog.records
+                if r.getMessage().startswith('Copied')]
+    assert percents[-1] == 100 and percents == sorted(set(percents))
+    assert all(b - a >= 10 for a, b in zip(percents[:-1], percents[1:-1]))
+    assert 'Staged 2 files' in caplog.records[-1].getMessage()
+
+
+def test_copy_replaces_stale_file(sources, monkeypatch):
+    files, odir = sources
+    no_clone(monkeypatch)
+    with open(os.path.join(odir, 'a.las'), 'wb') as f:
+        f.write(b'old')
+    assert stage_files(files[:1], odir, hardlink=False, chunk_size=4096)['copy'] == 1
+    assert content(os.path.join(odir, 'a.las')) == content(files[0])
+
+
+def test_second_run_is_locked_out(tmp_path):
+    directory = str(tmp_path)
+    with run_lock(directory) as path:
+        assert 'pid %i' % os.getpid() in content(path).decode()
+        with pytest.raises(Exception, match='being processed by another run'):
+            with run_lock(directory):
+                pass
+    # released once the first run is done
+    with run_lock(directory):
+        pass
+
+
+def test_lock_of_another_process(tmp_path):
+    directory = str(tmp_path)
+    code = 'import sys, time; from file_functions import run_lock\n' \
+           'with run_lock(sys.argv[1]):\n    print("locked", flush=True)\n    time.sleep(30)'
+    other = subprocess.Popen([sys.executable, '-c', code, directory], stdout=subprocess.PIPE,
+                             cwd=os.path.dirname(file_functions.__file__))
+    try:
+        assert other.stdout.readline().strip() == b'locked'
+        with pytest.raises(Exception, match='being processed by another run'):
+            with run_lock(directory):
+                pass
+    finally:
+        other.kill()
+        other.wait()
+        other.stdout.close()
+    # the operating system releases the lock of a killed run
+    with run_lock(directory):
+        pass
+
+
+def test_scratch_dir(tmp_path):
+    directory = str(tmp_path)
+    # leftovers of a crashed run are removed
+    os.makedirs(os.path.join(directory, file_functions.SCRATCH_NAME, 'run_crashed'))
+    with scratch_dir(directory) as scratch:
+        assert scratch.endswith(os.sep) and os.path.isdir(scratch)
+        assert os.listdir(os.path.join(directory, file_functions.SCRATCH_NAME)) == [os.path.basename(scratch[:-1])]
+        with open(scratch + 'tmp.las', 'w') as f:
+            f.write('temporary')
+    assert not os.path.exists(os.path.join(directory, file_functions.SCRATCH_NAME))
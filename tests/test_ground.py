@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import ground
+from las_io import LasReader
+
+
+@pytest.fixture
+def terrain(tmp_path, make_las):
+    # gently sloped ground with a 12 x 12 m, 6 m high building, a tree and a point 4 m below the ground
+    rng = np.random.default_rng(0)
+    gx, gy = rng.uniform(0, 60, 30000), rng.uniform(0, 60, 30000)
+    gz = 0.05 * gx + 0.02 * gy + rng.normal(0, 0.01, len(gx))
+    bx, by = rng.uniform(20, 32, 2000), rng.uniform(20, 32, 2000)
+    tx, ty = rng.normal(45, 1.5, 1000), rng.normal(15, 1.5, 1000)
+    x, y = np.r_[gx, bx, tx, 10], np.r_[gy, by, ty, 50]
+    z = np.r_[gz, 0.05 * bx + 0.02 * by + 6, 0.05 * tx + 0.02 * ty + rng.uniform(2, 10, len(tx)), 1.5 - 4]
+    # the ground below the building and the tree is hidden
+    hidden = np.r_[((gx >= 20) & (gx <= 32) & (gy >= 20) & (gy <= 32)) | (np.hypot(gx - 45, gy - 15) < 2),
+                   np.zeros(len(bx) + len(tx) + 1, dtype=bool)]
+    x, y, z = x[~hidden], y[~hidden], z[~hidden]
+    labels = np.concatenate([np.full((~hidden[:len(gx)]).sum(), 'ground'), np.full(len(bx), 'building'),
+                             np.full(len(tx), 'tree'), ['noise']])
+    return make_las(tmp_path / 'terrain.las', x, y, z, classification=0), labels
+
+
+def test_pmf_separates_ground_from_objects(terrain, tmp_path):
+    filename, labels = terrain
+    ofilename = str(tmp_path / 'out.las')
+    count = ground.classify_ground(filename, ofilename, step=15, bulge=1, spike=1, down_spike=1, offset=0.05)
+    codes = LasReader(ofilename).classification()
+    assert count == (codes == ground.GROUND).sum()
+    assert (codes[labels == 'ground'] == ground.GROUND).mean() > 0.98
+    assert (codes[labels == 'building'] == ground.UNCLASSIFIED).all()
+    assert (codes[labels == 'tree'] == ground.UNCLASSIFIED).mean() > 0.95
+    assert codes[labels == 'noise'] == ground.UNCLASSIFIED
+
+
+def test_small_step_keeps_the_roof(terrain, tmp_path):
+    # windows smaller than the building cannot remove its roof
+    filename, labels = terrain
+    ofilename = str(tmp_path / 'out.las')
+    ground.classify_ground(filename, ofilename, step=3, bulge=1, spike=1, down_spike=1, offset=0.05)
+    codes = LasReader(ofilename).classification()
+    assert (codes[labels == 'building'] == ground.GROUND).mean() > 0.5
+
+
+def test_empty_file(tmp_path, make_las):
+    filename = make_las(tmp_path / 'empty.las', [], [], [])
+    assert ground.classify_ground(filename, str(tmp_path / 'out.las'), 5, 1, 1, 1, 0.05) == 0
+    assert len(LasReader(str(tmp_path / 'out.las'))) == 0
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import height
+from las_io import LasReader
+
+
+def plane(x, y):
+    return 100 + 0.1 * x + 0.2 * y
+
+
+def test_tin_elevation_of_a_plane():
+    rng = np.random.default_rng(0)
+    gx, gy = rng.uniform(0, 50, 500), rng.uniform(0, 50, 500)
+    x, y = rng.uniform(5, 45, 1000), rng.uniform(5, 45, 1000)
+    assert height.tin_elevation(gx, gy, plane(gx, gy), x, y) == pytest.approx(plane(x, y))
+
+
+def test_outside_the_tin_takes_the_nearest_ground_point():
+    gx, gy = np.array([0.0, 10, 0, 10]), np.array([0.0, 0, 10, 10])
+    gz = np.array([1.0, 2, 3, 4])
+    assert list(height.tin_elevation(gx, gy, gz, np.array([-5.0, 30]), np.array([-5.0, 12]))) == [1, 4]
+
+
+# the grid smooths the sloped ground within a cell
+@pytest.mark.parametrize('surface, tolerance', [('tin', 0), ('grid', 3)])
+def test_heights_in_user_data(tmp_path, make_las, surface, tolerance):
+    rng = np.random.default_rng(0)
+    gx, gy = np.meshgrid(np.arange(0, 41.0), np.arange(0, 41.0))
+    gx, gy = gx.ravel(), gy.ravel()
+    x, y = rng.uniform(2, 38, 200), rng.uniform(2, 38, 200)
+    h = np.r_[rng.uniform(0, 20, 198), 40, -3]
+    filename = make_las(tmp_path / 'a.las', np.r_[gx, x], np.r_[gy, y], np.r_[plane(gx, gy), plane(x, y) + h],
+                        classification=np.r_[np.full(len(gx), 2), np.full(len(x), 1)], scale=0.001)
+    assert height.height_above_ground(filename, str(tmp_path / 'b.las'), surface) == len(gx) + len(x)
+    values = LasReader(str(tmp_path / 'b.las'))['user_data'].astype(int)
+    assert (values[:len(gx)] == 0).all()
+    # decimeters, clamped to 0 - 255
+    assert np.abs(values[len(gx):] - np.clip(np.round(h * 10), 0, 255)).max() <= tolerance
+
+
+def test_no_ground_points(tmp_path, make_las):
+    filename = make_las(tmp_path / 'a.las', [0, 1, 2], [0, 1, 2], [5, 6, 7])
+    height.height_above_ground(filename, str(tmp_path / 'b.las'))
+    assert (LasReader(str(tmp_path / 'b.las'))['user_data'] == 0).all()
+
+
+def test_unknown_surface(tmp_path, make_las):
+    filename = make_las(tmp_path / 'a.las', [0, 1], [0, 1], [0, 0])
+    with pytest.raises(Exception):
+        height.height_above_ground(filename, str(tmp_path / 'b.las'), 'spline')
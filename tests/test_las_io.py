@@ -0,0 +1,116 @@
+import struct
+import numpy as np
+import pytest
+import las_io
+
+
+def test_header_round_trip(tmp_path, make_las):
+    filename = make_las(tmp_path / 'a.las', [0, 10, 5], [0, 20, 5], [1, 2, 3])
+    h = las_io.read_header(filename)
+    assert h.version == (1, 2) and h.point_format == 1 and not h.compressed
+    assert h.point_count == 3 and h.points_by_return[0] == 3
+    assert h.mins == pytest.approx((0, 0, 1)) and h.maxs == pytest.approx((10, 20, 3))
+    assert h.density == pytest.approx(3 / 200.0)
+    assert las_io.readable(filename)
+
+
+def test_header_cache_follows_file_changes(tmp_path, make_las):
+    filename = make_las(tmp_path / 'a.las', [0, 1], [0, 1], [0, 0])
+    assert las_io.read_header(filename).point_count == 2
+    make_las(tmp_path / 'a.las', [0, 1, 2, 3], [0, 1, 2, 3], [0, 0, 0, 0])
+    assert las_io.read_header(filename).point_count == 4
+
+
+def test_las14_point_count(tmp_path, make_las):
+    # LAS 1.4 headers keep the point count in 64 bits, with the legacy count 0
+    data = bytearray(open(make_las(tmp_path / 'a.las', [0, 1], [0, 1], [0, 0]), 'rb').read(227))
+    struct.pack_into('<BB', data, 24, 1, 4)
+    struct.pack_into('<HI', data, 94, 375, 375)
+    struct.pack_into('<I', data, 107, 0)
+    data += bytearray(375 - 227)
+    struct.pack_into('<QIQ', data, 235, 0, 0, 2 ** 33)
+    filename = str(tmp_path / 'b.las')
+    with open(filename, 'wb') as f:
+        f.write(data)
+    assert las_io.read_header(filename).point_count == 2 ** 33
+
+
+def test_not_a_las_file(tmp_path):
+    filename = str(tmp_path / 'a.las')
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * 400)
+    with pytest.raises(Exception, match='not a LAS/LAZ file'):
+        las_io.read_header(filename)
+
+
+def coordinates(points, h):
+    return [points[d] * h.scale[i] + h.offset[i] for i, d in enumerate('XYZ')]
+
+
+def test_points_round_trip(tmp_path, make_las):
+    x, y, z = np.array([0.5, 10.25, 3.0]), np.array([1.0, 2.0, 3.75]), np.array([-1.0, 0.0, 2.5])
+    filename = make_las(tmp_path / 'a.las', x, y, z, classification=[2, 5, 6])
+    h, points = las_io.read_points(filename)
+    assert len(points) == 3
+    for values, expected in zip(coordinates(points, h), (x, y, z)):
+        assert values == pytest.approx(expected)
+    assert list(las_io.classification(points, h.point_format)) == [2, 5, 6]
+    assert list(las_io.return_number(points, h.point_format)) == [1, 1, 1]
+    sx, sy = las_io.sample_xy(filename)
+    assert sx == pytest.approx(x) and sy == pytest.approx(y)
+
+
+def test_writer_copies_header_and_updates_counts(tmp_path, make_las):
+    filename = make_las(tmp_path / 'a.las', np.arange(10.0), np.arange(10.0), np.arange(10.0))
+    h, points = las_io.read_points(filename)
+    ofilename = str(tmp_path / 'b.las')
+    vlr = ('test', 1, 'test record', b'1234')
+    with las_io.LasWriter(ofilename, h, vlrs=[vlr]) as writer:
+        writer.write(points[2:5])
+        writer.write(points[7:8])
+    o, written = las_io.read_points(ofilename)
+    assert o.point_count == 4 and o.points_by_return[0] == 4
+    assert o.mins == pytest.approx((2, 2, 2)) and o.maxs == pytest.approx((7, 7, 7))
+    assert o.scale == h.scale and o.offset == h.offset
+    assert np.array_equal(written, np.r_[points[2:5], points[7:8]])
+    assert las_io.read_vlrs(ofilename) == [vlr]
+
+
+def test_compressed_points_are_not_read(tmp_path, make_las):
+    filename = make_las(tmp_path / 'a.las', [0, 1], [0, 1], [0, 0])
+    laz = str(tmp_path / 'a.laz')
+    with open(filename, 'rb') as src, open(laz, 'wb') as dst:
+        dst.write(src.read())
+    assert not las_io.readable(laz) and las_io.sample_xy(laz) is None
+    with pytest.raises(Exception, match='Cannot read compressed points'):
+        las_io.read_points(laz)
+
+
+def test_create_las(tmp_path):
+    h = las_io.create_las(str(tmp_path / 'a.las'), 3, scale=(0.001, 0.001, 0.01), offset=(100.0, 200.0, 0.0))
+    assert h.point_format == 3 and h.point_count == 0 and h.record_length == 34
+    assert h.scale == (0.001, 0.001, 0.01) and h.offset == (100.0, 200.0, 0.0)
+
+
+def test_reader_chunks_and_lazy_scaling(tmp_path, make_las):
+    x = np.arange(100) * 0.5
+    filename = make_las(tmp_path / 'a.las', x, x + 1, -x, classification=np.arange(100) % 3 + 1)
+    reader = las_io.LasReader(filename)
+    assert len(reader) == 100 and isinstance(reader.points, np.memmap)
+    chunks = list(reader.chunks(chunk_points=30))
+    assert [len(c) for c in chunks] == [30, 30, 30, 10]
+    cx, cy, cz = reader.xyz(chunks[1])
+    assert cx == pytest.approx(x[30:60]) and cy == pytest.approx(x[30:60] + 1) and cz == pytest.approx(-x[30:60])
+    assert list(reader.classification(chunks[3])) == list(np.arange(90, 100) % 3 + 1)
+    assert reader['X'].dtype == np.dtype('<i4')
+
+
+def test_reader_writer_keeps_records(tmp_path, make_las):
+    reader = las_io.LasReader(make_las(tmp_path / 'a.las', [0, 1, 2], [0, 1, 2], [0, 1, 2], classification=2))
+    points = np.array(reader.points)
+    points['classification'] = [5, 6, 2]
+    with reader.writer(str(tmp_path / 'b.las')) as writer:
+        writer.write(points)
+    out = las_io.LasReader(str(tmp_path / 'b.las'))
+    assert list(out.classification()) == [5, 6, 2]
+    assert np.array_equal(out['X'], reader['X'])
@@ -0,0 +1,61 @@
+import os
+import pytest
+import manifest
+from pipeline import Stage
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+@pytest.fixture
+def project(tmp_path):
+    root = str(tmp_path)
+    write(os.path.join(root, 'in', 'a.las'), 'input')
+    write(os.path.join(root, 'out', 'a.las'), 'output')
+    write(os.path.join(root, 'poly.shp'), 'polygon')
+    stage = Stage('clip', None, inputs=['in'], outputs=['out'], params={'step': 1, 'sizes': (1, 2)},
+                  sources=[os.path.join(root, 'poly.shp')])
+    return root, stage
+
+
+def test_up_to_date_after_run(project):
+    root, stage = project
+    assert manifest.up_to_date(stage, root) == (False, 'no manifest')
+    manifest.write_manifests(stage, root, {'tiles': 1})
+    assert manifest.up_to_date(stage, root) == (True, {'tiles': 1})
+    m = manifest.read_manifest(os.path.join(root, 'out'))
+    assert set(m['inputs']) == {'in/a.las', 'poly.shp'} and set(m['outputs']) == {'out/a.las'}
+
+
+def test_changed_parameters(project):
+    root, stage = project
+    manifest.write_manifests(stage, root, {})
+    stage.params = {'step': 2, 'sizes': (1, 2)}
+    assert manifest.up_to_date(stage, root) == (False, 'parameters changed')
+
+
+@pytest.mark.parametrize('path, reason', [('in/a.las', 'inputs changed'), ('in/b.las', 'inputs changed'),
+                                          ('poly.shp', 'inputs changed'), ('out/a.las', 'outputs changed'),
+                                          ('out/b.las', 'outputs changed')])
+def test_changed_files(project, path, reason):
+    root, stage = project
+    manifest.write_manifests(stage, root, {})
+    write(os.path.join(root, path), 'changed content')
+    assert manifest.up_to_date(stage, root) == (False, reason)
+
+
+def test_removed_input(project):
+    root, stage = project
+    manifest.write_manifests(stage, root, {})
+    os.remove(os.path.join(root, 'in', 'a.las'))
+    assert manifest.up_to_date(stage, root) == (False, 'inputs changed')
+
+
+def test_manifest_of_another_stage(project):
+    root, stage = project
+    manifest.write_manifests(stage, root, {})
+    stage.name = 'separate'
+    assert manifest.up_to_date(stage, root) == (False, 'manifest does not belong to this stage')
@@ -0,0 +1,188 @@
+import os
+import time
+import threading
+import pytest
+from pipeline import Stage, StageGraph, CoreBudget, run_tasks, process_pool
+from profiling import BLOCK_SIZE
+
+
+def graph_of(*stages):
+    graph = StageGraph()
+    for stage in stages:
+        graph.add(stage)
+    return graph
+
+
+def test_dependency_order():
+    ran = []
+
+    def step(name):
+        return lambda cores: ran.append(name)
+
+    # added in reverse, the scheduler still runs every stage after the stages writing its inputs
+    graph = graph_of(Stage('merge', step('merge'), inputs=['a', 'b'], outputs=['c']),
+                     Stage('clip', step('clip'), inputs=['t/x'], outputs=['b']),
+                     Stage('ground', step('ground'), inputs=['t'], outputs=['a']),
+                     Stage('tile', step('tile'), outputs=['t']))
+    order = [s.name for s in graph.order()]
+    assert order[0] == 'tile' and order[-1] == 'merge'
+    graph.run(4)
+    assert ran[0] == 'tile' and ran[-1] == 'merge' and sorted(ran[1:3]) == ['clip', 'ground']
+
+
+def test_independent_stages_run_in_parallel():
+    # both stages only pass the barrier if they run at the same time
+    barrier = threading.Barrier(2, timeout=10)
+    graph = graph_of(Stage('coarse', lambda cores: barrier.wait(), outputs=['coarse']),
+                     Stage('fine', lambda cores: barrier.wait(), outputs=['fine']))
+    graph.run(2)
+    assert set(graph.results) == {'coarse', 'fine'}
+
+
+def test_results():
+    graph = graph_of(Stage('tile', lambda cores: {'tile_size': 500}, outputs=['t']),
+                     Stage('ground', lambda cores: None, inputs=['t'], outputs=['g']))
+    assert graph.run(1) == {'tile': {'tile_size': 500}, 'ground': {}}
+
+
+def test_core_budget():
+    budget = CoreBudget(8)
+    # leaves room for the other stage waiting to start
+    assert budget.acquire(8, share=2) == 4
+    assert budget.acquire(8) == 4
+    assert budget.acquire(1) == 0
+    budget.release(4)
+    assert budget.acquire(2) == 2 and budget.free == 2
+    budget.release(100)
+    assert budget.free == budget.total == 8
+
+
+def test_stages_share_the_budget():
+    granted = {}
+    lock = threading.Lock()
+    busy = [0, 0]
+
+    def step(name):
+        def run(cores):
+            with lock:
+                busy[0] += cores
+                busy[1] = max(busy[1], busy[0])
+                granted[name] = cores
+            with lock:
+                busy[0] -= cores
+        return run
+
+    budget = CoreBudget(4)
+    graph_of(*[Stage('s%i' % i, step('s%i' % i), outputs=['d%i' % i], cores=3) for i in range(3)]).run(budget)
+    assert all(1 <= c <= 3 for c in granted.values()) and busy[1] <= 4
+    assert budget.free == 4
+
+
+def test_failed_stage_stops_its_consumers():
+    ran = []
+
+    def fail(cores):
+        raise ValueError('no tiles')
+
+    graph = graph_of(Stage('tile', fail, outputs=['t']),
+                     Stage('ground', lambda cores: ran.append('ground'), inputs=['t'], outputs=['g']),
+                     Stage('other', lambda cores: ran.append('other'), outputs=['o']))
+    with pytest.raises(ValueError, match='no tiles'):
+        graph.run(1)
+    assert 'ground' not in ran and 'tile' not in graph.results
+
+
+def test_cycle_and_duplicate_names():
+    graph = graph_of(Stage('a', None, inputs=['x'], outputs=['y']), Stage('b', None, inputs=['y'], outputs=['x']))
+    with pytest.raises(Exception, match='Cyclic'):
+        graph.order()
+    with pytest.raises(Exception, match='Duplicate'):
+        graph.add(Stage('a', None))
+
+
+def project_graph(root, ran, step=1):
+    # tile writes t/a.txt, ground reads it and writes g/a.txt
+    def tile(cores):
+        ran.append('tile')
+        with open(os.path.join(root, 't', 'a.txt'), 'w') as f:
+            f.write('tile')
+        return {'tiles': 1}
+
+    def ground(cores):
+        ran.append('ground')
+        with open(os.path.join(root, 'g', 'a.txt'), 'w') as f:
+            f.write('ground %s' % step)
+
+    for d in ('t', 'g'):
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    graph = StageGraph(root=root)
+    graph.add(Stage('tile', tile, outputs=['t']))
+    graph.add(Stage('ground', ground, inputs=['t'], outputs=['g'], params={'step': step}))
+    return graph
+
+
+def test_unchanged_stages_are_skipped(tmp_path):
+    root, ran = str(tmp_path), []
+    project_graph(root, ran).run(1)
+    graph = project_graph(root, ran)
+    # results of skipped stages come from their manifests
+    assert graph.run(1) == {'tile': {'tiles': 1}, 'ground': {}}
+    assert ran == ['tile', 'ground'] and sorted(graph.skipped) == ['ground', 'tile']
+
+
+def test_resume_at_the_first_stale_stage(tmp_path):
+    root, ran = str(tmp_path), []
+    project_graph(root, ran).run(1)
+    graph = project_graph(root, ran, step=2)
+    graph.run(1)
+    assert ran == ['tile', 'ground', 'ground'] and graph.skipped == ['tile']
+    with open(os.path.join(root, 't', 'a.txt'), 'w') as f:
+        f.write('changed tile')
+    graph = project_graph(root, ran, step=2)
+    graph.run(1)
+    # tile re-runs as its output changed. It writes the same tile again, so ground stays up to date
+    assert ran[3:] == ['tile'] and graph.skipped == ['ground']
+
+
+def test_shared_process_pool():
+    # threads running one task at a time submit it to the shared pool instead of running it themselves
+    def task():
+        return run_tasks(os.getpid, [()], 1, processes=True)[0]
+    with process_pool(2):
+        pids = run_tasks(task, [()] * 4, 4)
+    assert os.getpid() not in pids
+    assert run_tasks(task, [()], 1) == [os.getpid()]
+
+
+def busy(filename):
+    # a native step: 0.2 s of CPU time and 1 MB written to storage
+    start = time.thread_time()
+    while time.thread_time() - start < 0.2:
+        pass
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * 2 ** 20)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_native_steps_are_accounted(tmp_path, make_las, processes):
+    root = str(tmp_path)
+    for d in ('t', 'dep', 'g'):
+        os.makedirs(os.path.join(root, d))
+    make_las(tmp_path / 't' / 'a.las', [0, 1, 2], [0, 1, 2], [0, 0, 0])
+    make_las(tmp_path / 'dep' / 'a.las', [0, 1], [0, 1], [0, 0])
+
+    def ground(cores):
+        run_tasks(busy, [(os.path.join(root, 'g', '%i.bin' % k),) for k in range(2)], 2, processes=processes)
+
+    graph = StageGraph(root=root)
+    graph.add(Stage('ground', ground, inputs=['t', 'dep'], outputs=['g'], reads=['t']))
+    graph.run(2)
+    record = graph.profile[0]
+    assert record['native']['tasks'] == 2 and record['user'] + record['system'] >= 0.35
+    assert record['bytes_written'] >= 2 * 2 ** 20 and record['bytes_written'] % BLOCK_SIZE == 0
+    # dep is an input for the stage order only
+    assert record['points_in'] == 3
+    if processes:
+        assert record['max_rss_mb'] > 0
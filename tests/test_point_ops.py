@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pytest
+import point_ops
+from las_io import LasReader
+
+
+def lowest(x, y, z):
+    # lowest z of every distinct (x, y), sorted by (x, y)
+    result = {}
+    for p in zip(np.round(x, 2), np.round(y, 2), np.round(z, 2)):
+        result[p[:2]] = min(result.get(p[:2], np.inf), p[2])
+    return sorted((k + (v,) for k, v in result.items()))
+
+
+def points_of(files):
+    found = []
+    for f in files:
+        r = LasReader(f)
+        found += list(zip(*(np.round(v, 2) for v in r.xyz())))
+    return sorted(found)
+
+
+@pytest.fixture
+def duplicated(tmp_path, make_las):
+    # two overlapping flightlines on a 0.5 m grid, points of the second file partly on the positions of the first
+    rng = np.random.default_rng(0)
+    files, coords = [], []
+    for k in range(2):
+        x, y = rng.integers(0, 80, 3000) * 0.5 + 10 * k, rng.integers(0, 80, 3000) * 0.5
+        z = rng.uniform(0, 10, 3000).round(2)
+        files.append(make_las(tmp_path / ('line_%i.las' % k), x, y, z))
+        coords.append((x, y, z))
+    x, y, z = (np.concatenate(v) for v in zip(*coords))
+    return files, (x, y, z)
+
+
+@pytest.mark.parametrize('memory_points', [2 ** 25, 500])
+def test_remove_duplicates(tmp_path, make_las, memory_points):
+    x, y = np.array([0, 0, 0, 1, 1, 2.5]), np.array([0, 0, 0, 1, 1, 2])
+    z = np.array([3, 1, 2, 5, 4, 0])
+    x, y, z = np.tile(x, 200) + np.repeat(np.arange(200) * 5, 6), np.tile(y, 200), np.tile(z, 200)
+    filename = make_las(tmp_path / 'a.las', x, y, z)
+    count = point_ops.remove_duplicates(filename, str(tmp_path / 'b.las'), memory_points=memory_points)
+    assert count == 600
+    assert points_of([str(tmp_path / 'b.las')]) == lowest(x, y, z)
+
+
+@pytest.mark.parametrize('max_reads', [4, 0])
+def test_merge_tiles_keeps_lowest_points(tmp_path, duplicated, max_reads):
+    files, (x, y, z) = duplicated
+    odir = str(tmp_path / 'merged') + '/'
+    os.mkdir(odir)
+    tiles = point_ops.merge_tiles(files, odir, 10, lowest_z_only=True, workers=2, max_reads=max_reads)
+    assert len(tiles) == 20
+    assert points_of(tiles) == lowest(x, y, z)
+    # every tile holds the points inside its bounds only
+    for t in tiles:
+        (min_x, max_x, min_y, max_y), buffered = point_ops.tile_bounds(t)
+        tx, ty, _ = LasReader(t).xyz()
+        assert not buffered and (tx >= min_x).all() and (tx < max_x).all() and (ty >= min_y).all() and \
+            (ty < max_y).all()
+
+
+def test_merge_tiles_keeps_duplicates_without_lowest_z(tmp_path, duplicated):
+    files, (x, y, z) = duplicated
+    odir = str(tmp_path / 'merged') + '/'
+    os.mkdir(odir)
+    tiles = point_ops.merge_tiles(files, odir, 10)
+    assert points_of(tiles) == sorted(zip(*(np.round(v, 2) for v in (x, y, z))))
+
+
+def test_remove_buffer(tmp_path, duplicated):
+    files, _ = duplicated
+    buffered, plain = str(tmp_path / 'buffered') + '/', str(tmp_path / 'plain') + '/'
+    os.mkdir(buffered)
+    os.mkdir(plain)
+    point_ops.merge_tiles(files, plain, 10)
+    for t in point_ops.merge_tiles(files, buffered, 10, buffer=2):
+        bounds, flag = point_ops.tile_bounds(t)
+        assert flag and point_ops.tile_bounds(plain + os.path.basename(t))[0] == bounds
+        ofilename = str(tmp_path / 'out.las')
+        count = point_ops.remove_buffer(t, ofilename)
+        assert count < LasReader(t).header.point_count
+        assert points_of([ofilename]) == points_of([plain + os.path.basename(t)])
+        assert point_ops.tile_bounds(ofilename) == (bounds, False)
+
+
+def test_remove_buffer_needs_tile_bounds(tmp_path, make_las):
+    filename = make_las(tmp_path / 'a.las', [0, 1], [0, 1], [0, 0])
+    with pytest.raises(Exception, match='has no tile bounds'):
+        point_ops.remove_buffer(filename, str(tmp_path / 'b.las'))
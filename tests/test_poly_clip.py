@@ -0,0 +1,108 @@
+import struct
+import numpy as np
+import pytest
+import poly_clip
+from las_io import read_points
+
+
+def write_shapefile(filename, polygons):
+    # writes a polygon shapefile, polygons is a list of lists of rings ((n, 2) vertex arrays)
+    records = b''
+    for number, rings in enumerate(polygons, 1):
+        rings = [np.vstack([r, r[:1]]).astype('<f8') for r in map(np.asarray, rings)]
+        points = np.vstack(rings)
+        parts = np.cumsum([0] + [len(r) for r in rings[:-1]])
+        content = struct.pack('<i4dii', 5, *(points.min(0).tolist() + points.max(0).tolist()), len(rings), len(points))
+        content += struct.pack('<%ii' % len(parts), *parts) + points.tobytes()
+        records += struct.pack('>ii', number, len(content) // 2) + content
+    header = struct.pack('>i20xi', 9994, (100 + len(records)) // 2) + struct.pack('<ii8d', 1000, 5, *([0.0] * 8))
+    with open(filename, 'wb') as f:
+        f.write(header + records)
+    return str(filename)
+
+
+def square(x0, y0, size):
+    return np.array([(x0, y0), (x0, y0 + size), (x0 + size, y0 + size), (x0 + size, y0)], dtype=float)
+
+
+def brute_force(polygons, x, y):
+    # inside any polygon if a ray in +x direction crosses an odd number of the edges of one of its polygons
+    inside = np.zeros(len(x), dtype=bool)
+    for rings in polygons:
+        crossings = np.zeros(len(x), dtype=int)
+        for ring in rings:
+            for (x0, y0), (x1, y1) in zip(ring, np.roll(ring, -1, axis=0)):
+                if y0 == y1:
+                    continue
+                straddles = (y0 > y) != (y1 > y)
+                crossings += straddles & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+        inside |= crossings % 2 == 1
+    return inside
+
+
+def index_of(polygons, **kwargs):
+    return poly_clip.PolygonIndex([(i + 1, [np.asarray(r, dtype=float) for r in rings])
+                                   for i, rings in enumerate(polygons)], **kwargs)
+
+
+def test_donut():
+    index = index_of([[square(0, 0, 10), square(3, 3, 4)]])
+    x, y = np.array([1, 5, 8, 5, 11, -1]), np.array([1, 5, 5, 8.5, 5, 5])
+    assert list(index.contains(x, y)) == [True, False, True, True, False, False]
+
+
+def test_points_on_shared_edges_belong_to_one_polygon():
+    # two squares sharing the edge x = 10, points on their edges and corners
+    left, right = index_of([[square(0, 0, 10)]]), index_of([[square(10, 0, 10)]])
+    x, y = np.array([10, 10, 10, 0, 20, 5, 5]), np.array([0, 5, 10, 5, 5, 0, 10])
+    assert not (left.contains(x, y) & right.contains(x, y)).any()
+    assert list(left.contains(x, y) | right.contains(x, y)) == [True, True, False, True, False, True, False]
+
+
+def test_multiple_polygons():
+    polygons = [[square(0, 0, 10)], [square(20, 0, 5)], [square(2, 2, 2)]]
+    index = index_of(polygons)
+    x, y = np.array([1, 3, 22, 15, 30]), np.array([1, 3, 2, 2, 2])
+    # overlapping polygons (the third lies inside the first) do not cancel each other
+    assert list(index.contains(x, y)) == [True, True, True, False, False]
+
+
+def test_empty_index():
+    index = index_of([])
+    assert index.edges == 0 and not index.contains(np.array([0.0]), np.array([0.0])).any()
+
+
+@pytest.mark.parametrize('edges_per_band, chunk_pairs', [(8, 2 ** 22), (1, 7), (1000, 2 ** 22)])
+def test_against_brute_force(edges_per_band, chunk_pairs):
+    # star shaped polygons with holes, some of them overlapping, and points on their vertices
+    rng = np.random.default_rng(1)
+    polygons = []
+    for k in range(6):
+        angles = np.sort(rng.uniform(0, 2 * np.pi, 40))
+        cx, cy = rng.uniform(0, 100, 2)
+        outer = np.c_[cx + rng.uniform(5, 20, 40) * np.cos(angles), cy + rng.uniform(5, 20, 40) * np.sin(angles)]
+        hole = np.c_[cx + 2 * np.cos(angles[::4]), cy + 2 * np.sin(angles[::4])][::-1]
+        polygons.append([outer, hole])
+    x, y = rng.uniform(-10, 110, 20000), rng.uniform(-10, 110, 20000)
+    x, y = np.r_[x, polygons[0][0][:, 0]], np.r_[y, polygons[0][0][:, 1]]
+    index = index_of(polygons, edges_per_band=edges_per_band)
+    inside = index.contains(x, y, chunk_pairs=chunk_pairs)
+    assert inside.any() and np.array_equal(inside, brute_force(polygons, x, y))
+
+
+def test_clip_file(tmp_path, make_las):
+    shp = write_shapefile(tmp_path / 'poly.shp', [[square(0, 0, 10), square(3, 3, 4)], [square(20, 0, 5)]])
+    rng = np.random.default_rng(2)
+    x, y = rng.uniform(-5, 30, 2000).round(2), rng.uniform(-5, 15, 2000).round(2)
+    filename = make_las(tmp_path / 'a.las', x, y, np.zeros(len(x)))
+    index = poly_clip.polygon_index(shp)
+    assert poly_clip.polygon_index(shp) is index
+    inside = str(tmp_path / 'inside.las')
+    outside = str(tmp_path / 'outside.las')
+    counts = poly_clip.clip_file(filename, index, inside, outside, chunk_points=300)
+    expected = brute_force([[square(0, 0, 10), square(3, 3, 4)], [square(20, 0, 5)]], x, y)
+    assert counts == (expected.sum(), (~expected).sum())
+    for ofilename, selected in ((inside, expected), (outside, ~expected)):
+        h, points = read_points(ofilename)
+        px = points['X'] * h.scale[0] + h.offset[0]
+        assert sorted(np.round(px, 2)) == sorted(x[selected])
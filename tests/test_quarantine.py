@@ -0,0 +1,97 @@
+import os
+import json
+import shutil
+import pytest
+import quarantine
+import manifest
+from pipeline import Stage
+
+
+calls = {}
+
+
+def copy_tile(filename, ofilename, failures=0):
+    # copies filename, raising on the first failures calls per tile
+    calls[filename] = calls.get(filename, 0) + 1
+    if calls[filename] <= failures:
+        raise ValueError('failure %i' % calls[filename])
+    shutil.copyfile(filename, ofilename)
+
+
+def truncate_tile(filename, ofilename, truncate=True):
+    # writes an incomplete output if truncate, else a copy
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open(ofilename, 'wb') as f:
+        f.write(data[:-10] if truncate else data)
+
+
+@pytest.fixture
+def tiles(tmp_path, make_las):
+    calls.clear()
+    (tmp_path / 'out').mkdir()
+    return [make_las(tmp_path / ('tile_%i.las' % k), [k, k + 1, k + 2], [0, 1, 2], [0, 0, 0]) for k in range(2)]
+
+
+def task(filename, *args):
+    # (input, output, args) of a native step writing to out/
+    ofilename = os.path.join(os.path.dirname(filename), 'out', os.path.basename(filename))
+    return filename, ofilename, (filename, ofilename) + args
+
+
+def test_check_output(tiles):
+    assert quarantine.check_output(tiles[0], tiles[0] + '.missing') == 'no output'
+    assert quarantine.check_output(tiles[0], tiles[1]) is None
+    truncate_tile(tiles[0], tiles[0] + '.out')
+    assert quarantine.check_output(tiles[0], tiles[0] + '.out') == 'truncated output'
+
+
+def test_retried_tile_succeeds(tiles):
+    failed = quarantine.run_native(copy_tile, [task(tiles[0], 1), task(tiles[1])], backoff=0)
+    assert failed == {}
+    assert calls[tiles[0]] == 2
+    assert all(os.path.isfile(task(t)[1]) for t in tiles)
+
+
+def test_failing_tile_is_quarantined(tiles):
+    failed = quarantine.run_native(copy_tile, [task(tiles[0], 10), task(tiles[1])], retries=2, backoff=0)
+    assert list(failed) == [tiles[0]] and 'ValueError' in failed[tiles[0]]
+    assert calls[tiles[0]] == 3
+    assert not os.path.isfile(task(tiles[0])[1])
+
+
+def test_incomplete_output_is_quarantined_and_removed(tiles):
+    failed = quarantine.run_native(truncate_tile, [task(tiles[0]), task(tiles[1], False)], retries=1, backoff=0)
+    assert failed == {tiles[0]: 'truncated output'}
+    assert not os.path.isfile(task(tiles[0])[1]) and os.path.isfile(task(tiles[1])[1])
+
+
+def test_single_failed_tile_raises(tiles):
+    with pytest.raises(Exception, match='All 1 tile'):
+        quarantine.run_native(copy_tile, [task(tiles[0], 10)], retries=1, backoff=0)
+
+
+def test_all_failed_tiles_raise(tiles):
+    with pytest.raises(Exception, match='All 2 tile'):
+        quarantine.run_native(copy_tile, [task(tiles[0], 10), task(tiles[1], 10)], retries=0, backoff=0)
+
+
+def test_record_and_prune(tmp_path, tiles):
+    root = str(tmp_path)
+    quarantine.record(root, 'ground', {tiles[0]: 'no output'})
+    quarantine.record(root, 'height', {tiles[1]: 'no output'})
+    assert quarantine.quarantined(root) == {'ground': {'tile_0.las': 'no output'},
+                                            'height': {'tile_1.las': 'no output'}}
+    quarantine.prune(root, ['ground'])
+    quarantine.record(root, 'ground', {})
+    assert not os.path.isfile(os.path.join(root, quarantine.QUARANTINE_NAME))
+
+
+def test_quarantined_stage_is_not_up_to_date(tmp_path, tiles):
+    root = str(tmp_path)
+    shutil.copyfile(tiles[0], os.path.join(root, 'out', 'tile_0.las'))
+    stage = Stage('ground', None, outputs=['out'])
+    manifest.write_manifests(stage, root, {'quarantined': ['tile_1.las']})
+    assert manifest.up_to_date(stage, root) == (False, '1 quarantined tile(s)')
+    manifest.write_manifests(stage, root, {'quarantined': []})
+    assert manifest.up_to_date(stage, root) == (True, {'quarantined': []})
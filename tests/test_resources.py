@@ -0,0 +1,50 @@
+import resources
+import profiling
+from resources import MB, Planner, command_points, measured_memory, memory_rates
+
+
+def command(tool, peak_mb, parent_mb, points):
+    return {'command': '/lastools/%s.exe -i tile.las' % tool, 'exit_code': 0, 'max_rss_mb': peak_mb,
+            'parent_rss_mb': parent_mb, 'points': points}
+
+
+def test_peaks_inherited_from_the_parent_are_left_out():
+    records = [{'stage': 'height', 'commands': [command('lasheight', 505, 500, 1000000)]}]
+    assert memory_rates(records) == {}
+
+
+def test_rate_per_point_beyond_the_base_memory():
+    base = resources.TOOL_MEMORY['lasheight'][0]
+    records = [{'stage': 'height', 'commands': [command('lasheight', 1050, 500, 1000000),
+                                                command('lasheight', 550, 500, 1000000)]}]
+    assert memory_rates(records) == {'lasheight': (1050 * MB - base) / 1000000.0}
+
+
+def test_measured_rate_is_scaled_to_the_points_of_the_largest_tile(tmp_path, make_las):
+    profiling.write_profile([{'stage': 'height', 'wall': 1, 'skipped': False, 'user': 0, 'system': 0,
+                              'max_rss_mb': 0, 'bytes_read': 0, 'bytes_written': 0, 'points_in': 0,
+                              'points_per_sec': 0, 'commands': [command('lasheight', 1050, 500, 1000000)]}],
+                            str(tmp_path), 1.0)
+    tile = make_las(tmp_path / 'tile.las', range(100), range(100), [0] * 100)
+    planner = Planner(1, str(tmp_path))
+    base = resources.TOOL_MEMORY['lasheight'][0]
+    assert planner.process_memory('lasheight', [tile]) == base + 100 * (1050 * MB - base) / 1000000.0
+    # other tools keep the estimate of TOOL_MEMORY
+    assert planner.process_memory('lasclip', [tile]) == 30 * MB + 40 * 100
+
+
+def test_skipped_rerun_keeps_earlier_measurements(tmp_path):
+    profiling.write_profile([{'stage': 'height', 'wall': 1, 'skipped': False, 'user': 0, 'system': 0,
+                              'max_rss_mb': 0, 'bytes_read': 0, 'bytes_written': 0, 'points_in': 0,
+                              'points_per_sec': 0, 'commands': [command('lasheight', 1050, 500, 1000000)]}],
+                            str(tmp_path), 1.0)
+    measured = measured_memory(str(tmp_path))
+    assert measured
+    profiling.write_profile([], str(tmp_path), 0.1)
+    assert measured_memory(str(tmp_path)) == measured
+
+
+def test_command_points(tmp_path, make_las):
+    tile = make_las(tmp_path / 'tile.las', range(7), range(7), [0] * 7)
+    assert command_points('lasheight.exe -i %s -odir out -olas' % tile) == 7
+    assert command_points('lastile.exe -lof list.txt -o tile.las') is None
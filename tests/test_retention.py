@@ -0,0 +1,152 @@
+import os
+import glob
+import time
+import shutil
+import numpy as np
+import pytest
+import manifest
+import retention
+from pipeline import Stage, StageGraph
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def copy_stage(root, name, source, target, ran):
+    # a stage copying the .las files of source to target
+    def func(cores):
+        ran.append(name)
+        os.makedirs(os.path.join(root, target), exist_ok=True)
+        for f in glob.glob(os.path.join(root, source, '*.las')):
+            shutil.copyfile(f, os.path.join(root, target, os.path.basename(f)))
+    return func
+
+
+def project_graph(root, ran, mode='keep', step=1, **kwargs):
+    # tile -> ground -> merge, the merged outputs are the final product
+    graph = StageGraph(root)
+    for name, source, target in (('tile', 'in', 'tiled'), ('ground', 'tiled', 'ground'), ('merge', 'ground', 'merged')):
+        params = {'step': step} if name == 'ground' else {}
+        graph.add(Stage(name, copy_stage(root, name, source, target, ran), inputs=[source], outputs=[target],
+                        params=params))
+    graph.retention = retention.Retention(graph, mode, **kwargs)
+    return graph
+
+
+@pytest.fixture
+def project(tmp_path, make_las):
+    # project directory with one input tile, returns the root and the size of one copy of the point cloud
+    os.mkdir(str(tmp_path / 'in'))
+    filename = make_las(tmp_path / 'in' / 'a.las', np.arange(100.0), np.arange(100.0), np.zeros(100))
+    return str(tmp_path), os.path.getsize(filename)
+
+
+def files_of(root, directory):
+    return sorted(os.path.basename(f) for f in glob.glob(os.path.join(root, directory, '*.la[sz]')))
+
+
+def compress_copy(files, delay=0, ratio=0.1):
+    # writes a .laz stand-in of a tenth of the size next to every .las file
+    time.sleep(delay)
+    for f in files:
+        with open(f, 'rb') as src, open(os.path.splitext(f)[0] + '.laz', 'wb') as dst:
+            dst.write(src.read()[:int(os.path.getsize(f) * ratio)])
+
+
+def test_delete(project):
+    root, size = project
+    ran = []
+    project_graph(root, ran, 'delete', copy_size=size).run(2)
+    assert ran == ['tile', 'ground', 'merge']
+    assert files_of(root, 'tiled') == files_of(root, 'ground') == [] and files_of(root, 'merged') == ['a.las']
+    graph = project_graph(root, ran)
+    assert manifest.retired(graph.stage('tile'), root) and manifest.retired(graph.stage('ground'), root)
+    assert not manifest.retired(graph.stage('merge'), root)
+
+
+def test_compress_and_keep(project):
+    root, size = project
+    ran = []
+    project_graph(root, ran, 'compress', copy_size=size, keep=['ground'], compress=compress_copy).run(2)
+    assert files_of(root, 'tiled') == ['a.laz'] and files_of(root, 'ground') == ['a.las']
+    with pytest.raises(Exception, match='needs a compression function'):
+        project_graph(root, ran, 'compress')
+    with pytest.raises(Exception, match='Unknown retention mode'):
+        project_graph(root, ran, 'archive')
+
+
+def test_budget_refusal(project):
+    root, size = project
+    ran = []
+    # three copies at once without retention, two with outputs deleted as soon as they are read
+    with pytest.raises(Exception, match='exceeds the disk budget'):
+        project_graph(root, ran, 'keep', copy_size=size, budget=2.5 * size).run(2)
+    assert ran == []
+    project_graph(root, ran, 'delete', copy_size=size, budget=2.5 * size).run(2)
+    assert ran == ['tile', 'ground', 'merge']
+
+
+def test_admit_waits_for_retirement(project):
+    root, size = project
+    ran = []
+    graph = project_graph(root, ran, 'compress', copy_size=size, budget=2.2 * size,
+                          compress=lambda files: compress_copy(files, delay=0.5))
+    retire = graph.retention.retire
+    retired = []
+
+    def record(stage):
+        retire(stage)
+        retired.append((stage.name, list(ran)))
+    graph.retention.retire = record
+    graph.run(2)
+    # merge only fits into the budget once the tiles are compressed
+    assert retired[0] == ('tile', ['tile', 'ground'])
+    assert ran == ['tile', 'ground', 'merge']
+
+
+def test_admit_and_flush(project):
+    root, size = project
+    ran = []
+    graph = project_graph(root, ran, 'delete', copy_size=size, budget=2.5 * size)
+    graph.retention.check(graph.stale())
+    tile, ground, merge = graph.stages
+    assert graph.retention.admit(tile, [])
+    # a stage running next to tile would not fit
+    assert not graph.retention.admit(ground, [tile, merge])
+    graph.run(2)
+    graph.retention.flush()
+
+
+def test_retired_stage_re_runs_for_stale_consumer(project):
+    root, size = project
+    ran = []
+    project_graph(root, ran, 'delete', copy_size=size).run(2)
+    # nothing changed: the retired outputs are not needed
+    graph = project_graph(root, ran, 'delete', copy_size=size)
+    assert graph.stale() == set()
+    graph.run(2)
+    assert ran == ['tile', 'ground', 'merge'] and graph.skipped == ['tile', 'ground', 'merge']
+    # ground changed: the deleted tiles it reads are written again
+    graph = project_graph(root, ran, 'delete', copy_size=size, step=2)
+    assert graph.stale() == {'tile', 'ground', 'merge'}
+    graph.run(2)
+    assert ran[3:] == ['tile', 'ground', 'merge'] and files_of(root, 'merged') == ['a.las']
+
+
+def test_retired_inputs(tmp_path):
+    root = str(tmp_path)
+    write(os.path.join(root, 'in', 'a.las'), 'input')
+    write(os.path.join(root, 'out', 'a.las'), 'output')
+    stage = Stage('clip', None, inputs=['in'], outputs=['out'])
+    manifest.write_manifests(stage, root, {})
+    merge = Stage('merge', None, inputs=['out'], outputs=['merged'])
+    write(os.path.join(root, 'merged', 'all.las'), 'merged')
+    manifest.write_manifests(merge, root, {})
+    # the outputs of clip are deleted once merge ran, merge stays up to date
+    manifest.mark_retired(stage, root, 'delete')
+    os.remove(os.path.join(root, 'out', 'a.las'))
+    assert manifest.retired(stage, root)
+    assert manifest.up_to_date(merge, root) == (True, {})
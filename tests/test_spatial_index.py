@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import spatial_index
+
+
+def random_boxes(rng, n):
+    # boxes of 0 - 20 m (some of them degenerate) within 0 - 200 m
+    lo = rng.uniform(0, 200, (n, 2)).round(1)
+    size = np.where(rng.random((n, 1)) < 0.1, 0, rng.uniform(0, 20, (n, 2)).round(1))
+    return np.c_[lo, lo + size]
+
+
+def brute_force(boxes, box):
+    x0, y0, x1, y1 = box
+    return np.flatnonzero((boxes[:, 0] <= x1) & (boxes[:, 2] >= x0) & (boxes[:, 1] <= y1) & (boxes[:, 3] >= y0))
+
+
+@pytest.mark.parametrize('n', [0, 1, 16, 17, 1000])
+@pytest.mark.parametrize('node_size', [2, 16])
+def test_query_against_brute_force(n, node_size):
+    rng = np.random.default_rng(n)
+    boxes = random_boxes(rng, n)
+    index = spatial_index.BoxIndex(boxes, node_size)
+    assert len(index) == n
+    queries = list(random_boxes(rng, 200)) + [(-10, -10, 300, 300), (500, 500, 600, 600)]
+    # boxes touching the query box at an edge or a corner only
+    queries += [(b[2], b[3], b[2] + 5, b[3] + 5) for b in boxes[:20]]
+    for q in queries:
+        found = index.query(q)
+        assert found.dtype.kind == 'i' and np.array_equal(found, brute_force(boxes, q))
+
+
+def test_file_index(tmp_path, make_las):
+    files = [make_las(tmp_path / ('%i.las' % k), [10 * k, 10 * k + 5], [0, 5], [0, 0]) for k in range(5)]
+    index = spatial_index.file_index(files)
+    assert list(index.query((12, 1, 26, 2))) == [1, 2]
+    assert spatial_index.tile_range((12, 1, 26, 2), 10, margin=2) == (1, -1, 2, 0)
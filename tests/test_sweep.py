@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import stat
+import numpy as np
+import pytest
+import sweep
+
+
+GRID = {'step': ['1', '2'], 'bulge': ['0.5'], 'spike': ['1'], 'down_spike': ['1'], 'offset': ['0.05']}
+
+
+@pytest.fixture
+def project(tmp_path, make_las):
+    tiled = tmp_path / '01_tiled'
+    tiled.mkdir()
+    rng = np.random.default_rng(0)
+    for k in range(3):
+        x, y = rng.uniform(0, 20, 2000) + 20 * k, rng.uniform(0, 20, 2000)
+        make_las(tiled / ('tile_%i.las' % k), x, y, 0.1 * x + rng.normal(0, 0.02, len(x)))
+    return str(tmp_path) + '/'
+
+
+@pytest.fixture
+def failing_lastools(tmp_path):
+    # lasground_new stand-in copying its input, except for step 2
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    script = bindir / 'lasground_new.exe'
+    script.write_text('#!%s\n' % sys.executable + '\n'.join([
+        'import sys, shutil, os',
+        'args = sys.argv[1:]',
+        'if args[args.index("-step") + 1] == "2":',
+        '    sys.exit(1)',
+        'src = args[args.index("-i") + 1]',
+        'shutil.copyfile(src, os.path.join(args[args.index("-odir") + 1], os.path.basename(src)))']) + '\n')
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return str(bindir) + '/'
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='the stand-in is a POSIX script')
+def test_failed_sets_are_left_out_and_the_others_cached(project, failing_lastools):
+    results = sweep.parameter_sweep(failing_lastools, project, '', GRID, tiles=2, cores=2)
+    assert [r['params']['step'] for r in results] == ['1']
+    with open(os.path.join(project, sweep.SWEEP_NAME, sweep.CACHE_NAME)) as f:
+        cache = json.load(f)
+    assert len(cache) == 2 and all(k.startswith('step1_') for k in cache)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='the stand-in is a POSIX script')
+def test_all_sets_failing_raises(project, failing_lastools):
+    with pytest.raises(Exception):
+        sweep.parameter_sweep(failing_lastools, project, '', dict(GRID, step=['2']), tiles=1, cores=1)
+
+
+def test_pmf_sweep(project):
+    results = sweep.parameter_sweep('', project, '', GRID, tiles=2, cores=2, ground_engine='pmf')
+    assert [r['params']['step'] for r in results] == ['1', '2']
+    # a sloped plane is all ground
+    assert all(r['ground_fraction'] > 0.95 for r in results)
+    assert os.path.isdir(os.path.join(project, sweep.SWEEP_NAME, 'pmf_' + sweep.set_name(results[0]['params'])))
+    # a second sweep only reads the cache
+    assert sweep.parameter_sweep('', project, '', GRID, tiles=2, cores=2, ground_engine='pmf') == results
+
+
+def test_unknown_engine(project):
+    with pytest.raises(Exception):
+        sweep.parameter_sweep('', project, '', GRID, ground_engine='lasground')
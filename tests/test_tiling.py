@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import tiling
+from point_ops import TileLocator
+
+
+def fullest_tile(x, y, size, buffer):
+    # largest number of points in a tile aligned to multiples of size, including the buffer
+    fullest = 0
+    for tx in np.unique(np.floor(x / size)):
+        for ty in np.unique(np.floor(y / size)):
+            lo_x, lo_y = tx * size - buffer, ty * size - buffer
+            inside = (x >= lo_x) & (x < lo_x + size + 2 * buffer) & (y >= lo_y) & (y < lo_y + size + 2 * buffer)
+            fullest = max(fullest, inside.sum())
+    return fullest
+
+
+@pytest.fixture
+def skewed(tmp_path, make_las):
+    # a sparse background over 400 x 400 m and a dense 60 x 60 m cluster, in two files
+    rng = np.random.default_rng(0)
+    bx, by = rng.uniform(0, 400, 20000), rng.uniform(0, 400, 20000)
+    cx, cy = rng.uniform(250, 310, 50000), rng.uniform(100, 160, 50000)
+    files = [make_las(tmp_path / 'background.las', bx, by, np.zeros(len(bx))),
+             make_las(tmp_path / 'cluster.las', cx, cy, np.zeros(len(cx)))]
+    return files, np.r_[bx, cx], np.r_[by, cy]
+
+
+def test_density_raster(skewed):
+    files, x, y = skewed
+    raster = tiling.DensityRaster(files)
+    assert raster.sampled and raster.total == pytest.approx(len(x))
+    assert raster.counts.shape == (raster.ny, raster.nx)
+    # the cell of the cluster is far denser than the mean
+    assert raster.counts.max() > 50 * raster.total / raster.counts.size
+
+
+def test_planned_size_respects_max_points(skewed):
+    files, x, y = skewed
+    size = tiling.plan_tile_size(files, max_points=20000, buffer=5)
+    assert size % 10 == 0 and size >= 10
+    assert fullest_tile(x, y, size, 5) <= 20000
+    # the sparse background alone would allow far larger tiles
+    assert size < tiling.plan_tile_size(files[:1], max_points=20000, buffer=5)
+
+
+def test_header_only_density(skewed, tmp_path):
+    files, x, y = skewed
+    laz = str(tmp_path / 'cluster.laz')
+    with open(files[1], 'rb') as src, open(laz, 'wb') as dst:
+        dst.write(src.read())
+    raster = tiling.DensityRaster([files[0], laz])
+    assert not raster.sampled and raster.total == pytest.approx(len(x))
+    # the points of the .laz file are spread over its bounding box
+    assert raster.counts.max() < 2 * 50000 * raster.cell ** 2 / 3600
+
+
+def containing(tiles, x, y):
+    # number of tiles containing every point (x, y)
+    t = np.array(tiles)
+    return ((x[:, None] >= t[:, 0]) & (x[:, None] < t[:, 1]) & (y[:, None] >= t[:, 2]) &
+            (y[:, None] < t[:, 3])).sum(1)
+
+
+def test_quadtree_covers_extent_once(skewed):
+    files, x, y = skewed
+    tiles = tiling.plan_quadtree(files, max_points=20000, buffer=5)
+    assert tiles == sorted(tiles)
+    for min_x, max_x, min_y, max_y in tiles:
+        size = max_x - min_x
+        assert max_y - min_y == size and min_x % size == 0 and min_y % size == 0
+    # every point and every spot of the bounding box lies in exactly one tile
+    gx, gy = (v.ravel() for v in np.meshgrid(np.arange(0, 400, 2.5) + 0.1, np.arange(0, 400, 2.5) + 0.1))
+    assert (containing(tiles, gx, gy) == 1).all()
+    assert (containing(tiles, x, y) == 1).all()
+
+
+def test_quadtree_respects_max_points(skewed):
+    files, x, y = skewed
+    tiles = tiling.plan_quadtree(files, max_points=20000, buffer=5)
+    sizes = {t[1] - t[0] for t in tiles}
+    # small tiles in the cluster, large ones in the background
+    assert len(sizes) > 1 and len(tiles) < (400 / min(sizes)) ** 2 / 4
+    buffered = [(a - 5, b + 5, c - 5, d + 5) for a, b, c, d in tiles]
+    counts = [containing([t], x, y).sum() for t in buffered]
+    assert max(counts) <= 20000
+
+
+def test_tile_locator(skewed):
+    files, x, y = skewed
+    tiles = tiling.plan_quadtree(files, max_points=20000, buffer=5)
+    index = TileLocator(tiles).locate(np.r_[x, -1000], np.r_[y, -1000])
+    assert index[-1] == -1
+    t = np.array(tiles)[index[:-1]]
+    assert ((x >= t[:, 0]) & (x < t[:, 1]) & (y >= t[:, 2]) & (y < t[:, 3])).all()
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import numpy as np
+import pytest
+import ground
+import quarantine
+from las_io import read_header
+import LiDAR_processing_GUI as gui
+
+STANDINS = os.path.join(os.path.dirname(os.path.abspath(gui.__file__)), 'benchmarks', 'lastools', '')
+
+
+def recording_ground(filename, ofilename, *args):
+    # ground.classify_ground, recording the process it ran in and when next to the output
+    start = time.time()
+    ground.classify_ground(filename, ofilename, *args)
+    with open(ofilename + '.run', 'w') as f:
+        f.write('%i %f %f' % (os.getpid(), start, time.time()))
+
+
+def workflow(lidardir, **kwargs):
+    # runs the workflow on the coarse setting only, with the native engines and the stand-ins of LAStools
+    gui.lidar_workflow(STANDINS, lidardir, '', 4, '', True, *([3, 1, 1, 1, 0.1] * 2), ground_engine='pmf',
+                       height_engine='grid', classify_engine='eigen', **kwargs)
+
+
+@pytest.fixture
+def project(tmp_path, make_las, monkeypatch):
+    # a 200 x 200 m project tiled into tiles of 100 m
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(0, 200, 40000), rng.uniform(0, 200, 40000)
+    make_las(tmp_path / 'a.las', x, y, rng.normal(0, 0.05, len(x)))
+    monkeypatch.setattr(gui, 'plan_tile_size', lambda *args, **kwargs: 100)
+    return str(tmp_path) + '/'
+
+
+def test_per_tile_native_steps_run_in_parallel(tmp_path, project, monkeypatch):
+    monkeypatch.setattr(gui, 'classify_ground', recording_ground)
+    workflow(project, per_tile=True)
+    runs = []
+    for directory, _, files in os.walk(str(tmp_path)):
+        for f in files:
+            if f.endswith('.run'):
+                with open(os.path.join(directory, f)) as run:
+                    pid, start, end = run.read().split()
+                runs.append((int(pid), float(start), float(end)))
+    # every tile in a worker process, some of them at the same time
+    assert len(runs) == len(gui.las_files(str(tmp_path / '01_tiled') + '/')) > 1
+    assert os.getpid() not in {pid for pid, _, _ in runs} and len({pid for pid, _, _ in runs}) > 1
+    runs.sort(key=lambda r: r[1])
+    assert any(b[1] < a[2] for a, b in zip(runs, runs[1:]))
+
+
+def test_preview_after_a_run_with_retention(project):
+    # the full run deletes the tiles once the ground classification read them
+    workflow(project, retention='delete')
+    assert gui.las_files(project + '01_tiled/') == []
+    workflow(project, preview=2)
+    with open(project + gui.PREVIEW_NAME + '/' + gui.PREVIEW_SUMMARY) as f:
+        summary = json.load(f)
+    assert len(summary['tiles']) == 2 and summary['total_tiles'] > 2
+    assert len(gui.las_files(project + gui.PREVIEW_NAME + '/01_tiled/')) == 2
+
+
+def test_separate_classes_with_las2las(tmp_path, make_las, monkeypatch):
+    # files LAStools has to read (such as .laz) are split by las2las, one file fails
+    files = [make_las(tmp_path / ('tile_%i.las' % k), [0, 1, 2, 3], [0, 1, 2, 3], [0, 0, 0, 0],
+                      classification=[1, 2, 2, 5 + k]) for k in range(2)]
+    with open(files[1], 'rb') as f:
+        data = f.read()
+    files.append(str(tmp_path / 'broken.las'))
+    with open(files[2], 'wb') as f:
+        f.write(data[:-20])
+    monkeypatch.setattr(gui, 'readable', lambda filename: False)
+    monkeypatch.setattr(quarantine, 'BACKOFF', 0)
+    podir = str(tmp_path / 'separated')
+    failed = gui.separate_classes(STANDINS, files, podir, 2)
+    assert list(failed) == [files[2]]
+    # the outputs of the broken file are removed from all classes
+    assert all(sorted(os.listdir(os.path.join(podir, c))) == ['tile_0.las', 'tile_1.las'] for c in gui.CLASSES)
+    assert [[read_header(os.path.join(podir, c, t)).point_count for c in gui.CLASSES]
+            for t in ('tile_0.las', 'tile_1.las')] == [[1, 2, 1, 0], [1, 2, 0, 1]]
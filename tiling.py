@@ -0,0 +1,293 @@
+"""
+Tile size planning for lastile.
+
+LAStools processes tiles of at most 1.5M points without a license. Instead of tiling, checking the largest tile and
+re-tiling with a smaller tile size, the tile size is computed up front from a density raster of all input files. The
+raster is built from a strided sample of the point records (.las) or, if the points cannot be read (.laz), from the
+point count and bounding box in the file header.
+
+With one tile size for all tiles, the densest spot sets the size everywhere and sparse areas end up in many nearly
+empty tiles, each of which costs a process start per step. plan_quadtree instead plans tiles of different sizes that
+are split only where they would hold too many points (written by point_ops.tile_files).
+"""
+
+import logging
+import numpy as np
+from las_io import read_header, sample_xy, sample_z
+
+
+logger = logging.getLogger(__name__)
+
+
+class DensityRaster:
+    """
+    Estimated number of points per raster cell over the union of the bounding boxes of a set of files
+
+    Args:
+        files (list): .las/.laz files
+        max_cells (int): upper limit for the number of raster cells
+        sample (int): maximum number of points sampled per file (0 to use headers only)
+    """
+
+    def __init__(self, files, max_cells=4000000, sample=50000):
+        headers = [read_header(f) for f in files]
+        headers = [h for h in headers if h.point_count > 0]
+        if not headers:
+            msg = 'No points in any of the input files'
+            logger.error(msg)
+            raise Exception(msg)
+
+        self.x0 = min(h.mins[0] for h in headers)
+        self.y0 = min(h.mins[1] for h in headers)
+        x1 = max(h.maxs[0] for h in headers)
+        y1 = max(h.maxs[1] for h in headers)
+        self.cell = max(np.sqrt((x1 - self.x0) * (y1 - self.y0) / max_cells), 0.5)
+        self.nx = int((x1 - self.x0) // self.cell) + 1
+        self.ny = int((y1 - self.y0) // self.cell) + 1
+        self.counts = np.zeros((self.ny, self.nx))
+        # cells overlapping the bounding box of any file, i.e. cells that may hold points (also if none were sampled)
+        self.covered = np.zeros((self.ny, self.nx), dtype=bool)
+        # True if every file contributed a sampled histogram, i.e. the raster reflects density variations
+        self.sampled = True
+
+        for h in headers:
+            i, j = self._index(np.array([h.mins[0], h.maxs[0]]), np.array([h.mins[1], h.maxs[1]]))
+            self.covered[j[0]:j[1] + 1, i[0]:i[1] + 1] = True
+            xy = sample_xy(h.filename, sample) if sample else None
+            if xy is not None:
+                self._add_sample(h, *xy)
+            else:
+                self.sampled = False
+                self._add_uniform(h)
+
+        # summed area tables with a leading row/column of zeros
+        self._sat = np.zeros((self.ny + 1, self.nx + 1))
+        self._sat[1:, 1:] = self.counts.cumsum(0).cumsum(1)
+        self._covered_sat = np.zeros((self.ny + 1, self.nx + 1))
+        self._covered_sat[1:, 1:] = self.covered.cumsum(0).cumsum(1)
+
+    def _index(self, x, y):
+        i = np.clip(((x - self.x0) // self.cell).astype(int), 0, self.nx - 1)
+        j = np.clip(((y - self.y0) // self.cell).astype(int), 0, self.ny - 1)
+        return i, j
+
+    def _add_sample(self, h, x, y):
+        i, j = self._index(x, y)
+        hist = np.bincount(j * self.nx + i, minlength=self.nx * self.ny).reshape(self.ny, self.nx)
+        self.counts += hist * (h.point_count / float(len(x)))
+
+    def _add_uniform(self, h):
+        # spread the points of the file over the cells by their overlap with the bounding box
+        def overlap(lo, hi, origin, n):
+            edges = origin + np.arange(n + 1) * self.cell
+            length = np.clip(np.minimum(edges[1:], hi) - np.maximum(edges[:-1], lo), 0, None)
+            if length.sum() == 0:
+                length[int(np.clip((lo - origin) // self.cell, 0, n - 1))] = 1
+            return length / length.sum()
+
+        wx = overlap(h.mins[0], h.maxs[0], self.x0, self.nx)
+        wy = overlap(h.mins[1], h.maxs[1], self.y0, self.ny)
+        self.counts += np.outer(wy, wx) * h.point_count
+
+    @property
+    def total(self):
+        """estimated total number of points"""
+        return self.counts.sum()
+
+    def _box_sum(self, sat, x0, y0, x1, y1):
+        # sum over the cells overlapping boxes (arrays of bounds); cells partly in a box count fully
+        i0 = np.clip(np.floor((x0 - self.x0) / self.cell), 0, self.nx).astype(int)
+        i1 = np.clip(np.ceil((x1 - self.x0) / self.cell), 0, self.nx).astype(int)
+        j0 = np.clip(np.floor((y0 - self.y0) / self.cell), 0, self.ny).astype(int)
+        j1 = np.clip(np.ceil((y1 - self.y0) / self.cell), 0, self.ny).astype(int)
+        return sat[j1, i1] - sat[j0, i1] - sat[j1, i0] + sat[j0, i0]
+
+    def box_points(self, x0, y0, x1, y1):
+        """returns the estimated number of points in boxes (arrays of bounds), erring on the safe side"""
+        return self._box_sum(self._sat, x0, y0, x1, y1)
+
+    def box_covered(self, x0, y0, x1, y1):
+        """returns True for boxes (arrays of bounds) overlapping the bounding box of any file"""
+        return self._box_sum(self._covered_sat, x0, y0, x1, y1) > 0
+
+    def max_tile_points(self, tile_size, buffer=0):
+        """
+        Returns the estimated number of points in the fullest tile
+
+        Tiles are aligned to multiples of tile_size (as done by lastile) and include a buffer of the given width.
+        Cells that are only partly covered by a tile are counted fully, so the estimate errs on the safe side.
+        """
+        sat = self._sat
+
+        def bounds(origin, n):
+            first = np.floor(origin / tile_size)
+            last = np.floor((origin + n * self.cell) / tile_size)
+            lo = np.arange(first, last + 1) * tile_size - buffer
+            i0 = np.clip(np.floor((lo - origin) / self.cell), 0, n).astype(int)
+            i1 = np.clip(np.ceil((lo + tile_size + 2 * buffer - origin) / self.cell), 0, n).astype(int)
+            return i0, i1
+
+        i0, i1 = bounds(self.x0, self.nx)
+        j0, j1 = bounds(self.y0, self.ny)
+        counts = (sat[j1][:, i1] - sat[j0][:, i1] - sat[j1][:, i0] + sat[j0][:, i0])
+        return counts.max()
+
+
+def plan_tile_size(files, max_points=1500000, buffer=5, headroom=None, sample=50000, min_size=10, raster=None):
+    """
+    Returns the largest tile size (multiple of 10) for which no tile is estimated to exceed max_points
+
+    Args:
+        files (list): .las/.laz files to be tiled
+        max_points (int): maximum number of points per tile (including the buffer)
+        buffer (float): width of the tile buffer
+        headroom (float): fraction of max_points the estimate may reach. Defaults to 0.9 if all files could be sampled
+            and to 0.5 if the density of some files is only known from their header.
+        sample (int): maximum number of points sampled per file for the density raster
+        min_size (int): smallest tile size to return
+        raster (DensityRaster): density raster of files, if already built
+    """
+    raster = raster or DensityRaster(files, sample=sample)
+    if headroom is None:
+        headroom = 0.9 if raster.sampled else 0.5
+    limit = max_points * headroom
+
+    # start at the size that holds the limit at the mean density of the whole area, then shrink until all tiles fit
+    mean_density = raster.total / (raster.nx * raster.ny * raster.cell ** 2)
+    size = max(min_size, round(2 * np.sqrt(limit / mean_density), -1))
+    while size > min_size and raster.max_tile_points(size, buffer) > limit:
+        size = max(min_size, round(min(size - 10, size * 0.95), -1))
+
+    logger.info('Planned tile size %i (fullest tile ~%i points)' % (size, raster.max_tile_points(size, buffer)))
+    return int(size)
+
+
+def plan_quadtree(files, max_points=1500000, buffer=5, headroom=None, sample=50000, min_size=10, raster=None):
+    """
+    Returns square tiles of different sizes, none of which is estimated to exceed max_points
+
+    Unlike plan_tile_size, which shrinks all tiles until the fullest one fits, the area is split like a quadtree: a
+    tile is only split into four where it is estimated to hold too many points (including its buffer), so sparse areas
+    get few large tiles and dense areas small ones. Every tile is aligned to multiples of its size. Tiles outside the
+    bounding boxes of all files are left out.
+
+    Args:
+        files (list): .las/.laz files to be tiled
+        max_points (int): maximum number of points per tile (including the buffer)
+        buffer (float): width of the tile buffer
+        headroom (float): fraction of max_points the estimate may reach (see plan_tile_size)
+        sample (int): maximum number of points sampled per file for the density raster
+        min_size (int): smallest tile size (doubled until it is at least a raster cell and the buffer)
+        raster (DensityRaster): density raster of files, if already built
+
+    Returns list of tile bounds (min x, max x, min y, max y), sorted by min x and min y.
+    """
+    raster = raster or DensityRaster(files, sample=sample)
+    if headroom is None:
+        headroom = 0.9 if raster.sampled else 0.5
+    limit = max_points * headroom
+
+    # the raster cannot tell tiles smaller than a cell apart
+    smallest = float(min_size)
+    while smallest < max(raster.cell, buffer):
+        smallest *= 2
+    x1, y1 = raster.x0 + raster.nx * raster.cell, raster.y0 + raster.ny * raster.cell
+    size = smallest
+    while size < max(x1 - raster.x0, y1 - raster.y0):
+        size *= 2
+
+    # the roots: tiles of the largest size covering the area, split level by level
+    gx, gy = np.meshgrid(np.arange(np.floor(raster.x0 / size), np.floor(x1 / size) + 1) * size,
+                         np.arange(np.floor(raster.y0 / size), np.floor(y1 / size) + 1) * size)
+    x, y = gx.ravel(), gy.ravel()
+    tiles = []
+    while len(x):
+        keep = raster.box_covered(x, y, x + size, y + size)
+        x, y = x[keep], y[keep]
+        split = raster.box_points(x - buffer, y - buffer, x + size + buffer, y + size + buffer) > limit
+        if size / 2 < smallest:
+            split[:] = False
+        tiles += [(a, a + size, b, b + size) for a, b in zip(x[~split], y[~split])]
+        half = size / 2
+        x = np.concatenate([x[split], x[split] + half, x[split], x[split] + half])
+        y = np.concatenate([y[split], y[split], y[split] + half, y[split] + half])
+        size = half
+
+    tiles.sort()
+    t = np.array(tiles)
+    fullest = raster.box_points(t[:, 0] - buffer, t[:, 2] - buffer, t[:, 1] + buffer, t[:, 3] + buffer).max()
+    logger.info('Planned %i tiles of size %g - %g (fullest tile ~%i points)' % (
+        len(tiles), (t[:, 1] - t[:, 0]).min(), (t[:, 1] - t[:, 0]).max(), fullest))
+    return tiles
+
+
+def tile_stats(filename, sample=5000, bins=32):
+    """
+    Returns the point density (points per square unit of the bounding box) and the relief of a tile
+
+    The relief is the range between the 5th and the 95th percentile of the elevations, read from a coarse histogram of
+    a strided sample of the points (so single outliers do not count), or the z range of the header if the points cannot
+    be read (.laz).
+    """
+    h = read_header(filename)
+    area = max((h.maxs[0] - h.mins[0]) * (h.maxs[1] - h.mins[1]), 1e-6)
+    z = sample_z(filename, sample) if sample else None
+    if z is None or len(z) == 0:
+        return h.point_count / area, h.maxs[2] - h.mins[2]
+    counts, edges = np.histogram(z, bins=bins)
+    cumulative = np.cumsum(counts) / float(len(z))
+    lo = edges[np.searchsorted(cumulative, 0.05)]
+    hi = edges[np.searchsorted(cumulative, 0.95) + 1]
+    return h.point_count / area, hi - lo
+
+
+def stratified_sample(files, count, strata=3, sample=5000):
+    """
+    Returns count tiles that represent all of files: spread over the combinations of low, medium and high point density
+    and relief, and in space
+
+    The tiles are sorted into strata x strata classes by the quantiles of their density and relief (see tile_stats).
+    Every class gets a share of count proportional to its number of tiles (at least one while count allows), the
+    largest classes first. Within a class, the tiles farthest from the tiles picked so far are taken.
+
+    Args:
+        files (list): tiles (.las/.laz)
+        count (int): number of tiles to pick
+        strata (int): number of density and relief classes
+        sample (int): maximum number of points sampled per tile for its relief
+    """
+    files = sorted(files)
+    if count >= len(files):
+        return files
+    stats = np.array([tile_stats(f, sample) for f in files])
+    headers = [read_header(f) for f in files]
+    centers = np.array([((h.mins[0] + h.maxs[0]) / 2, (h.mins[1] + h.maxs[1]) / 2) for h in headers])
+
+    def classes(values):
+        edges = np.quantile(values, np.linspace(0, 1, strata + 1)[1:-1])
+        return np.searchsorted(edges, values, side='right')
+
+    label = classes(stats[:, 0]) * strata + classes(stats[:, 1])
+    groups = [np.flatnonzero(label == g) for g in np.unique(label)]
+    groups.sort(key=len, reverse=True)
+
+    # one tile per class (the largest classes first) while count allows, the rest in proportion to the class sizes
+    sizes = np.array([len(g) for g in groups])
+    shares = sizes * count / float(len(files))
+    picks = (np.arange(len(groups)) < count).astype(int)
+    for _ in range(count - picks.sum()):
+        picks[np.argmax(np.where(picks < sizes, shares - picks, -np.inf))] += 1
+
+    chosen = []
+    for group, n in zip(groups, picks):
+        group = list(group)
+        for _ in range(n):
+            if chosen:
+                distance = np.min(np.linalg.norm(centers[group][:, None] - centers[chosen][None], axis=2), axis=1)
+            else:
+                # start with the tile closest to the center of the area
+                distance = -np.linalg.norm(centers[group] - centers.mean(axis=0), axis=1)
+            chosen.append(group.pop(int(np.argmax(distance))))
+    picked = [files[i] for i in sorted(chosen)]
+    logger.info('Sampled %i of %i tiles from %i density/relief classes' % (len(picked), len(files), len(groups)))
+    return picked